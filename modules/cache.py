@@ -0,0 +1,813 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+import sys
+import os
+import time
+import json
+import mmap
+import errno
+import collections
+import logging
+
+from email.utils import parsedate_tz, mktime_tz
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+from proxyx import common, eventloop
+
+# a shared (rfc7234) cache of complete responses, bounded by the bytes it
+# holds. only what is explicitly fresh is kept, stale entries are never
+# revalidated, they go on the next lookup or when evicted
+
+CACHEABLE_STATUS = (200, 203, 300, 301, 404, 410)
+
+# not forwarded from a stored response, rfc7230 6.1
+HOP_BY_HOP = (b'connection', b'keep-alive', b'proxy-connection', b'te',
+			b'trailer', b'transfer-encoding', b'upgrade', b'age')
+
+# the disk tier appends bodies to segment files of about this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+INDEX = 'index'
+
+try:
+	_view = buffer # python 2, mmap has no new style buffer interface
+except NameError:
+	def _view(obj, offset, size):
+		return memoryview(obj)[offset:offset + size]
+
+_sendfile = getattr(os, 'sendfile', None)
+
+
+def _get(headers, name):
+	value = None
+	for k, v in headers:
+		if k.lower() == name:
+			value = v
+	return value
+
+
+def _cache_control(value):
+	# {directive: argument or None}
+	directives = {}
+	for item in (value or b'').split(b','):
+		name, _, arg = item.strip().partition(b'=')
+		if name:
+			directives[name.lower()] = arg.strip(b'"') or None
+	return directives
+
+
+def _seconds(value):
+	try:
+		return max(0, int(value))
+	except (TypeError, ValueError):
+		return None
+
+
+def _date(value):
+	# from the origin, None when it is not a date this can use
+	if value is None:
+		return None
+	if not isinstance(value, str):
+		value = value.decode('latin-1')
+	try:
+		t = parsedate_tz(value)
+		if t is None:
+			return None
+		return mktime_tz(t)
+	except (ValueError, OverflowError, TypeError):
+		return None
+
+
+class Entry(object):
+	def __init__(self, head, body, vary, stored_at, age, expires_at):
+		self.head = head # status line and end to end headers, no blank line
+		self.body = body # bytes, a FileRegion on disk
+		self.vary = vary # ((name, value), ...) of the request it answered
+		self.stored_at = stored_at
+		self.age = age # the Age it had when stored
+		self.expires_at = expires_at
+		# fetched ahead of any client asking for it, until its first hit
+		self.prefetched = False
+
+	@property
+	def size(self):
+		return len(self.head) + len(self.body)
+
+
+class ResponseCache(object):
+	"""LRU of responses to GET, keyed on the absolute url and the request
+	headers the response varies on. This class is not thread safe"""
+
+	def __init__(self, max_bytes, max_object, stats=None):
+		self._max_bytes = max_bytes
+		self._max_object = min(max_object, max_bytes)
+		# (method, url, vary) -> Entry, least recently used first
+		self._entries = collections.OrderedDict()
+		# (method, url) -> [header names it varies on, entries]
+		self._vary = {}
+		self._size = 0
+		if stats is None:
+			stats = {}
+		self.stats = stats
+		for k in ('cache_hits', 'cache_misses', 'cache_stores',
+				'cache_evictions', 'cache_bytes_saved', 'cache_disk_hits',
+				'prefetch_used_bytes'):
+			stats.setdefault(k, 0)
+		stats.setdefault('cache_hit_ratio', 0.0)
+		# a DiskCache behind this one, looked up on a miss and written
+		# through on every store
+		self.disk = None
+
+	def __len__(self):
+		return len(self._entries)
+
+	@property
+	def size(self):
+		return self._size
+
+	def key(self, request, address):
+		"""(method, absolute url) of a request the cache may take part in,
+		None for the ones that always go to the origin"""
+		if request.method != b'GET':
+			return None
+		headers = request.headers
+		if _get(headers, b'content-length') not in (None, b'0') or \
+				_get(headers, b'transfer-encoding') is not None:
+			return None
+		# conditional and partial requests are left to the origin
+		for name in (b'range', b'if-match', b'if-none-match',
+				b'if-modified-since', b'if-unmodified-since', b'if-range'):
+			if _get(headers, name) is not None:
+				return None
+		if b'no-store' in _cache_control(_get(headers, b'cache-control')):
+			return None
+		path = request.uri
+		if path.lower().startswith(b'http://'):
+			i = path.find(b'/', 7)
+			path = b'/' if i == -1 else path[i:]
+		host, port = address
+		if host.find(b':') != -1:
+			host = b'[' + host + b']'
+		return (b'GET', b'http://' + host.lower() + b':' + str(port).encode() + path)
+
+	def lookup(self, key, request, now):
+		"""[head, body] to send for a fresh hit, else None"""
+		entry = None
+		cc = _cache_control(_get(request.headers, b'cache-control'))
+		# Pragma only counts without a Cache-Control (rfc7234 5.4)
+		cc_bypass = b'no-cache' in cc or cc.get(b'max-age') == b'0' or \
+			(b'no-cache' in (_get(request.headers, b'pragma') or b'') and
+				_get(request.headers, b'cache-control') is None)
+		if cc_bypass:
+			# the client wants it from the origin
+			pass
+		else:
+			full_key, entry = self._find(key, request.headers, now)
+			if entry is not None:
+				# most recently used
+				del self._entries[full_key]
+				self._entries[full_key] = entry
+			elif self.disk is not None:
+				entry = self.disk.lookup(key, request.headers, now)
+				if entry is not None:
+					self.stats['cache_disk_hits'] += 1
+		stats = self.stats
+		if entry is None:
+			stats['cache_misses'] += 1
+			stats['cache_hit_ratio'] = stats['cache_hits'] / (stats['cache_hits'] + stats['cache_misses'])
+			return None
+		head = entry.head + b'Age: ' + str(int(now - entry.stored_at + entry.age)).encode() + b'\r\n'
+		if request.version == b'HTTP/1.0':
+			if request.keep_alive:
+				head += b'Connection: keep-alive\r\n'
+		elif not request.keep_alive:
+			head += b'Connection: close\r\n'
+		head += b'\r\n'
+		stats['cache_hits'] += 1
+		stats['cache_bytes_saved'] += len(head) + len(entry.body)
+		if entry.prefetched:
+			entry.prefetched = False
+			stats['prefetch_used_bytes'] += entry.size
+		stats['cache_hit_ratio'] = stats['cache_hits'] / (stats['cache_hits'] + stats['cache_misses'])
+		return [head, entry.body]
+
+	def _find(self, key, request_headers, now):
+		# (full key, fresh entry in memory or None)
+		if key not in self._vary:
+			return None, None
+		names = self._vary[key][0]
+		full_key = key + (tuple((name, _get(request_headers, name)) for name in names),)
+		entry = self._entries.get(full_key, None)
+		if entry is not None and now >= entry.expires_at:
+			self._remove(full_key)
+			entry = None
+		return full_key, entry
+
+	def fresh(self, key, request_headers, now):
+		"""whether a request would be a hit, without counting it as one"""
+		if self._find(key, request_headers, now)[1] is not None:
+			return True
+		return self.disk is not None and \
+			self.disk.lookup(key, request_headers, now) is not None
+
+	def storable(self, request_headers, response, now):
+		"""whether a response whose head is in may be stored, decided before
+		its body is kept"""
+		if response.request_method != b'GET' or response.status not in CACHEABLE_STATUS:
+			return False
+		if response.get_header(b'transfer-encoding') is not None:
+			# stored as received, only Content-Length bodies are replayed
+			return False
+		length = _seconds(response.get_header(b'content-length'))
+		if length is None or len(response.head) + length > self._max_object:
+			return False
+		if b'no-store' in _cache_control(_get(request_headers, b'cache-control')):
+			return False
+		cc = _cache_control(response.get_header(b'cache-control'))
+		if b'no-store' in cc or b'private' in cc or b'no-cache' in cc:
+			return False
+		if _get(request_headers, b'authorization') is not None and \
+				b'public' not in cc and b's-maxage' not in cc:
+			return False
+		if response.get_header(b'set-cookie') is not None:
+			return False
+		if b'*' in (response.get_header(b'vary') or b''):
+			return False
+		return self._lifetime(response, now) > 0
+
+	def _lifetime(self, response, now):
+		cc = _cache_control(response.get_header(b'cache-control'))
+		for directive in (b's-maxage', b'max-age'):
+			if directive in cc:
+				return _seconds(cc[directive]) or 0
+		expires = response.get_header(b'expires')
+		if expires is None:
+			# no heuristic freshness
+			return 0
+		expires = _date(expires)
+		if expires is None:
+			# invalid dates mean already expired
+			return 0
+		date = _date(response.get_header(b'date'))
+		return expires - (now if date is None else date)
+
+	def store(self, key, request_headers, response, data, now, prefetched=False):
+		"""data is the complete response as received, the last message in
+		it is the one response describes"""
+		lifetime = self._lifetime(response, now)
+		age = _seconds(response.get_header(b'age')) or 0
+		if lifetime <= age:
+			return
+		length = int(response.get_header(b'content-length'))
+		body = data[len(data) - length:] if length else b''
+		lines = [response.head.split(b'\r\n', 1)[0]]
+		for name, value in response.headers:
+			if name.lower() not in HOP_BY_HOP:
+				lines.append(name + b': ' + value)
+		head = b'\r\n'.join(lines) + b'\r\n'
+		names = tuple(sorted(set(name.strip().lower() for name in
+					(response.get_header(b'vary') or b'').split(b',') if name.strip())))
+		vary = tuple((name, _get(request_headers, name)) for name in names)
+		entry = Entry(head, body, vary, now, age, now + lifetime - age)
+		entry.prefetched = prefetched
+		if entry.size > self._max_object:
+			return
+		if key in self._vary and self._vary[key][0] != names:
+			# what the response varies on changed, the old variants go
+			for full_key in list(self._entries.keys()):
+				if full_key[:2] == key:
+					self._remove(full_key)
+		full_key = key + (vary,)
+		if full_key in self._entries:
+			self._remove(full_key)
+		self._vary.setdefault(key, [names, 0])[1] += 1
+		self._entries[full_key] = entry
+		self._size += entry.size
+		self.stats['cache_stores'] += 1
+		while self._size > self._max_bytes:
+			self._remove(next(iter(self._entries)))
+			self.stats['cache_evictions'] += 1
+		if self.disk is not None:
+			try:
+				self.disk.store(key, names, entry)
+			except (OSError, IOError) as e:
+				# e.g. the disk is full, the memory entry is there all the same
+				logging.error('disk cache: %s', e)
+
+	def _remove(self, full_key):
+		entry = self._entries.pop(full_key)
+		self._size -= entry.size
+		key = full_key[:2]
+		vary = self._vary[key]
+		vary[1] -= 1
+		if not vary[1]:
+			del self._vary[key]
+
+	def clear(self):
+		# memory only, the disk tier stays
+		self._entries.clear()
+		self._vary = {}
+		self._size = 0
+
+
+class Segment(object):
+	"""an append only file of response bodies"""
+
+	def __init__(self, path, number):
+		self.path = path
+		self.number = number
+		self.keys = set() # of the entries whose body is in it
+		self._file = open(path, 'ab+')
+		self.size = os.fstat(self._file.fileno()).st_size
+		self._map = None
+		# a write failed, part of it may be in: nothing more goes after it
+		self.failed = False
+
+	def fileno(self):
+		return self._file.fileno()
+
+	def append(self, data):
+		offset = self.size
+		try:
+			self._file.write(data)
+			self._file.flush()
+		except (OSError, IOError):
+			self.failed = True
+			raise
+		self.size += len(data)
+		return offset
+
+	def view(self, offset, size):
+		if self._map is None or len(self._map) < offset + size:
+			# appended to since it was mapped
+			self._map = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+		return _view(self._map, offset, size)
+
+	def close(self):
+		self._map = None
+		self._file.close()
+
+
+class FileRegion(object):
+	"""length bytes of a segment from offset, queued for a client like bytes
+	and written to it by the kernel. an evicted segment is only unlinked,
+	regions still queued keep it open"""
+
+	__slots__ = ('segment', 'offset', 'length')
+
+	def __init__(self, segment, offset, length):
+		self.segment = segment
+		self.offset = offset
+		self.length = length
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, s):
+		# what is left after a partial send, region[sent:]
+		return FileRegion(self.segment, self.offset + s.start, self.length - s.start)
+
+	def send(self, sock):
+		"""like sock.send(), returns how many bytes went out"""
+		global _sendfile
+		if _sendfile is not None:
+			try:
+				n = _sendfile(sock.fileno(), self.segment.fileno(), self.offset,
+							self.length)
+			except (OSError, IOError) as e:
+				if eventloop.errno_from_exception(e) not in (errno.EINVAL, errno.ENOSYS):
+					raise
+				# not for this file system, mapped from now on
+				_sendfile = None
+			else:
+				if not n:
+					raise IOError(errno.EIO, 'cache segment %s truncated' %
+								self.segment.path)
+				return n
+		return sock.send(self.segment.view(self.offset, self.length))
+
+
+def _latin1(s):
+	# bytes <-> json strings
+	return s.decode('latin-1') if s is not None else None
+
+
+def _bytes(s):
+	return s.encode('latin-1') if s is not None else None
+
+
+class DiskCache(object):
+	"""the second tier: bodies in append only segment files and what
+	describes them in an index file, both under path so that the cache
+	survives a restart. space goes back a whole segment at a time, oldest
+	first. This class is not thread safe"""
+
+	def __init__(self, path, max_bytes, segment_size=SEGMENT_SIZE, stats=None,
+				now=None):
+		self._path = path
+		self._max_bytes = max_bytes
+		self._segment_size = segment_size
+		# (method, url, vary) -> Entry with a FileRegion body
+		self._entries = {}
+		# (method, url) -> [header names it varies on, entries]
+		self._vary = {}
+		self._segments = collections.OrderedDict() # number -> Segment, oldest first
+		self._size = 0
+		self._index = None
+		self._records = 0 # in the index file, live or not
+		if stats is None:
+			stats = {}
+		self.stats = stats
+		for k in ('cache_disk_stores', 'cache_disk_evictions'):
+			stats.setdefault(k, 0)
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self._load(time.time() if now is None else now)
+
+	def __len__(self):
+		return len(self._entries)
+
+	@property
+	def size(self):
+		return self._size
+
+	def _load(self, now):
+		numbers = []
+		for name in os.listdir(self._path):
+			if name.endswith('.seg') and name[:-4].isdigit():
+				numbers.append(int(name[:-4]))
+		for number in sorted(numbers):
+			self._segments[number] = Segment(self._segment_path(number), number)
+		index_path = os.path.join(self._path, INDEX)
+		if os.path.exists(index_path):
+			with open(index_path, 'rb') as f:
+				for line in f:
+					try:
+						record = json.loads(line.decode('utf-8'))
+					except ValueError:
+						# the last record, cut short
+						continue
+					self._load_record(record, now)
+		# segments nothing refers to any more
+		for number, segment in list(self._segments.items()):
+			if not segment.keys:
+				self._drop_segment(number)
+		self._size = sum(segment.size for segment in self._segments.values())
+		self._evict()
+		self._rewrite_index()
+		logging.info('disk cache %s: %d responses, %d bytes', self._path,
+					len(self._entries), self._size)
+
+	def _load_record(self, record, now):
+		segment = self._segments.get(record['segment'], None)
+		offset, length = record['offset'], record['length']
+		if segment is None or offset + length > segment.size or \
+				now >= record['expires_at']:
+			return
+		key = (_bytes(record['method']), _bytes(record['url']))
+		names = tuple(_bytes(name) for name in record['names'])
+		vary = tuple((_bytes(name), _bytes(value)) for name, value in record['vary'])
+		entry = Entry(_bytes(record['head']), FileRegion(segment, offset, length),
+					vary, record['stored_at'], record['age'], record['expires_at'])
+		self._add(key, names, entry)
+
+	def _record(self, key, names, entry):
+		region = entry.body
+		return json.dumps({
+			'method': _latin1(key[0]),
+			'url': _latin1(key[1]),
+			'names': [_latin1(name) for name in names],
+			'vary': [[_latin1(name), _latin1(value)] for name, value in entry.vary],
+			'head': _latin1(entry.head),
+			'segment': region.segment.number,
+			'offset': region.offset,
+			'length': region.length,
+			'stored_at': entry.stored_at,
+			'age': entry.age,
+			'expires_at': entry.expires_at,
+		}).encode('utf-8') + b'\n'
+
+	def _rewrite_index(self):
+		# only the live entries, then appended to
+		if self._index:
+			self._index.close()
+		index_path = os.path.join(self._path, INDEX)
+		with open(index_path + '.tmp', 'wb') as f:
+			for full_key, entry in self._entries.items():
+				f.write(self._record(full_key[:2], self._vary[full_key[:2]][0], entry))
+		os.rename(index_path + '.tmp', index_path)
+		self._index = open(index_path, 'ab')
+		self._records = len(self._entries)
+
+	def _segment_path(self, number):
+		return os.path.join(self._path, '%08d.seg' % number)
+
+	def _add(self, key, names, entry):
+		full_key = key + (entry.vary,)
+		if full_key in self._entries:
+			self._remove(full_key)
+		vary = self._vary.setdefault(key, [names, 0])
+		vary[0] = names
+		vary[1] += 1
+		self._entries[full_key] = entry
+		entry.body.segment.keys.add(full_key)
+
+	def _remove(self, full_key):
+		entry = self._entries.pop(full_key)
+		entry.body.segment.keys.discard(full_key)
+		key = full_key[:2]
+		vary = self._vary[key]
+		vary[1] -= 1
+		if not vary[1]:
+			del self._vary[key]
+
+	def _drop_segment(self, number):
+		segment = self._segments.pop(number)
+		for full_key in list(segment.keys):
+			self._remove(full_key)
+		self._size -= segment.size
+		try:
+			os.unlink(segment.path)
+		except OSError as e:
+			logging.warn('disk cache: %s', e)
+
+	def _evict(self):
+		# the segment being appended to stays
+		while self._size > self._max_bytes and len(self._segments) > 1:
+			self._drop_segment(next(iter(self._segments)))
+			self.stats['cache_disk_evictions'] += 1
+
+	def lookup(self, key, request_headers, now):
+		"""the Entry of a fresh response, else None"""
+		vary = self._vary.get(key, None)
+		if vary is None:
+			return None
+		full_key = key + (tuple((name, _get(request_headers, name)) for name in vary[0]),)
+		entry = self._entries.get(full_key, None)
+		if entry is not None and now >= entry.expires_at:
+			# its bytes go with its segment
+			self._remove(full_key)
+			entry = None
+		return entry
+
+	def store(self, key, names, entry):
+		"""entry is a memory one, its body is appended to a segment. the
+		writes go to the page cache, they are not synced"""
+		body = entry.body
+		number = next(reversed(self._segments), None)
+		if number is None or self._segments[number].failed or \
+				self._segments[number].size + len(body) > self._segment_size:
+			number = 0 if number is None else number + 1
+			self._segments[number] = Segment(self._segment_path(number), number)
+		segment = self._segments[number]
+		offset = segment.append(body)
+		self._size += len(body)
+		entry = Entry(entry.head, FileRegion(segment, offset, len(body)), entry.vary,
+					entry.stored_at, entry.age, entry.expires_at)
+		self._add(key, names, entry)
+		self._index.write(self._record(key, names, entry))
+		self._index.flush()
+		self._records += 1
+		self.stats['cache_disk_stores'] += 1
+		self._evict()
+		if self._records > 2 * len(self._entries) + 1024:
+			self._rewrite_index()
+
+	def close(self):
+		if self._index:
+			self._index.close()
+			self._index = None
+		for segment in self._segments.values():
+			segment.close()
+
+
+def test():
+	from modules import httpx
+
+	def exchange(request, response, address=(b'example.com', 80)):
+		# parsed request and response, the response bytes
+		req = httpx.HTTPX()
+		req.feed(request)
+		resp = httpx.HTTPX(response=True)
+		resp.request_method = req.method
+		resp.feed(response)
+		return req, resp
+
+	def ok(headers, body=b'hello'):
+		return (b'HTTP/1.1 200 OK\r\n' + headers + b'Content-Length: %d\r\n\r\n' % len(body) +
+			body)
+
+	get = b'GET /a HTTP/1.1\r\nHost: example.com\r\n\r\n'
+	cache = ResponseCache(max_bytes=1024, max_object=512)
+
+	# stored, served with its Age, end to end headers only
+	response = ok(b'Cache-Control: max-age=60\r\nConnection: keep-alive\r\nX-A: 1\r\n')
+	req, resp = exchange(get, response)
+	key = cache.key(req, (b'example.com', 80))
+	assert key == (b'GET', b'http://example.com:80/a')
+	assert cache.lookup(key, req, 100) is None
+	assert cache.storable(req.headers, resp, 0)
+	cache.store(key, req.headers, resp, response, 100)
+	hit = b''.join(cache.lookup(key, req, 110))
+	assert hit == (b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nX-A: 1\r\n'
+				b'Content-Length: 5\r\nAge: 10\r\n\r\nhello'), hit
+	# an absolute-form request hits the same entry
+	req, _ = exchange(b'GET http://Example.com/a HTTP/1.0\r\n\r\n', response)
+	hit = b''.join(cache.lookup(key, req, 110))
+	assert hit.endswith(b'\r\n\r\nhello') and b'Connection' not in hit
+	assert cache.stats['cache_hits'] == 2 and cache.stats['cache_misses'] == 1
+	assert cache.stats['cache_bytes_saved'] > 10
+	assert cache.stats['cache_hit_ratio'] == 2 / 3
+
+	# expired, and clients asking for the origin
+	assert cache.lookup(key, req, 160) is None and len(cache) == 0
+	cache.store(key, req.headers, resp, response, 200)
+	req, _ = exchange(b'GET /a HTTP/1.1\r\nCache-Control: no-cache\r\n\r\n', response)
+	assert cache.lookup(key, req, 200) is None
+	req, _ = exchange(b'GET /a HTTP/1.1\r\nPragma: no-cache\r\n\r\n', response)
+	assert cache.lookup(key, req, 200) is None
+	# Cache-Control overrides it
+	req, _ = exchange(b'GET /a HTTP/1.1\r\nCache-Control: max-age=60\r\n'
+					b'Pragma: no-cache\r\n\r\n', response)
+	assert cache.lookup(key, req, 200) is not None
+	req, _ = exchange(b'GET /a HTTP/1.1\r\nRange: bytes=0-1\r\n\r\n', response)
+	assert cache.key(req, (b'example.com', 80)) is None
+	req, _ = exchange(b'POST /a HTTP/1.1\r\nContent-Length: 0\r\n\r\n', response)
+	assert cache.key(req, (b'example.com', 80)) is None
+
+	# Expires relative to Date
+	response = ok(b'Date: Sun, 06 Nov 1994 08:49:37 GMT\r\n'
+				b'Expires: Sun, 06 Nov 1994 08:50:37 GMT\r\n')
+	req, resp = exchange(get, response)
+	assert cache._lifetime(resp, 0) == 60 and cache.storable(req.headers, resp, 0)
+	response = ok(b'Expires: 0\r\n')
+	req, resp = exchange(get, response)
+	assert not cache.storable(req.headers, resp, 0)
+	# dates out of range or not even text are invalid ones, expired
+	for headers in (b'Expires: Thu, 01 Jan 99999999999999999999 00:00:00 GMT\r\n',
+			b'Expires: Thu, 01 Jan 10000 00:00:00 GMT\r\n',
+			b'Expires: \xff\xfe\r\n'):
+		req, resp = exchange(get, ok(headers))
+		assert not cache.storable(req.headers, resp, 0), headers
+	# a bad Date is as if there was none
+	req, resp = exchange(get, ok(b'Date: \xe9\xff\r\nExpires: Sun, 06 Nov 1994 08:50:37 GMT\r\n'))
+	assert cache._lifetime(resp, 0) == 784111837, cache._lifetime(resp, 0)
+
+	# not stored
+	for headers in (b'', b'Cache-Control: no-store, max-age=60\r\n',
+			b'Cache-Control: private, max-age=60\r\n',
+			b'Cache-Control: max-age=60\r\nSet-Cookie: a=b\r\n',
+			b'Cache-Control: max-age=60\r\nVary: *\r\n',
+			b'Cache-Control: max-age=60\r\nTransfer-Encoding: chunked\r\n'):
+		req, resp = exchange(get, ok(headers))
+		assert not cache.storable(req.headers, resp, 0), headers
+	req, resp = exchange(get, ok(b'Cache-Control: max-age=60\r\n', b'x' * 600))
+	assert not cache.storable(req.headers, resp, 0)
+	req, resp = exchange(b'GET /a HTTP/1.1\r\nAuthorization: x\r\n\r\n',
+						ok(b'Cache-Control: max-age=60\r\n'))
+	assert not cache.storable(req.headers, resp, 0)
+
+	# Vary
+	cache.clear()
+	for lang in (b'en', b'fr'):
+		response = ok(b'Cache-Control: max-age=60\r\nVary: Accept-Language\r\n', lang)
+		req, resp = exchange(b'GET /v HTTP/1.1\r\nAccept-Language: ' + lang + b'\r\n\r\n',
+							response)
+		key = cache.key(req, (b'example.com', 80))
+		cache.store(key, req.headers, resp, response, 0)
+	for lang in (b'fr', b'en'):
+		req, _ = exchange(b'GET /v HTTP/1.1\r\nAccept-Language: ' + lang + b'\r\n\r\n', b'')
+		assert cache.lookup(key, req, 1)[1] == lang
+	req, _ = exchange(b'GET /v HTTP/1.1\r\nAccept-Language: de\r\n\r\n', b'')
+	assert cache.lookup(key, req, 1) is None
+
+	# prefetched responses count as used on their first hit, fresh() counts
+	# nothing
+	response = ok(b'Cache-Control: max-age=60\r\n')
+	req, resp = exchange(b'GET /p HTTP/1.1\r\n\r\n', response)
+	key = cache.key(req, (b'example.com', 80))
+	hits = cache.stats['cache_hits']
+	assert not cache.fresh(key, req.headers, 0)
+	cache.store(key, req.headers, resp, response, 0, prefetched=True)
+	assert cache.fresh(key, req.headers, 1) and not cache.fresh(key, req.headers, 61)
+	cache.store(key, req.headers, resp, response, 0, prefetched=True)
+	assert cache.stats['cache_hits'] == hits
+	cache.lookup(key, req, 1)
+	cache.lookup(key, req, 1)
+	assert cache.stats['prefetch_used_bytes'] == len(response) - 2, cache.stats
+
+	# bounded by bytes, least recently used first
+	cache.clear()
+	keys = []
+	for i in range(5):
+		path = b'/%d' % i
+		response = ok(b'Cache-Control: max-age=60\r\n', b'x' * 200)
+		req, resp = exchange(b'GET ' + path + b' HTTP/1.1\r\n\r\n', response)
+		keys.append((cache.key(req, (b'example.com', 80)), req))
+		cache.store(keys[-1][0], req.headers, resp, response, 0)
+		if i == 2:
+			# /0 is used, /1 goes first
+			assert cache.lookup(keys[0][0], keys[0][1], 0)
+	assert cache.size <= 1024 and len(cache) == 3
+	assert [cache.lookup(k, r, 0) is not None for k, r in keys] == \
+		[True, False, False, True, True]
+	assert cache.stats['cache_evictions'] == 2
+
+	# the disk tier, written through and found again after a restart
+	import tempfile
+	import shutil
+	import socket
+
+	def send_all(region):
+		a, b = socket.socketpair()
+		while len(region):
+			region = region[region.send(a):]
+		a.close()
+		data = b''
+		while True:
+			chunk = b.recv(4096)
+			if not chunk:
+				break
+			data += chunk
+		b.close()
+		return data
+
+	def store(cache, i, now=0):
+		body = (b'%d' % i) * 400
+		response = ok(b'Cache-Control: max-age=60\r\n', body[:400])
+		req, resp = exchange(b'GET /d%d HTTP/1.1\r\n\r\n' % i, response)
+		key = cache.key(req, (b'example.com', 80))
+		cache.store(key, req.headers, resp, response, now)
+		return key, req, body[:400]
+
+	global _sendfile
+	path = tempfile.mkdtemp()
+	try:
+		stats = {}
+		cache = ResponseCache(max_bytes=1024, max_object=512, stats=stats)
+		cache.disk = DiskCache(path, max_bytes=3000, segment_size=1000, stats=stats, now=0)
+		stored = [store(cache, i) for i in range(5)]
+		assert len(cache) == 2 and len(cache.disk) == 5
+		assert stats['cache_disk_stores'] == 5 and cache.disk.size == 2000
+		# out of memory, still on disk: the body is a region of a segment
+		key, req, body = stored[0]
+		head, region = cache.lookup(key, req, 1)
+		assert isinstance(region, FileRegion) and stats['cache_disk_hits'] == 1
+		assert head.startswith(b'HTTP/1.1 200 OK\r\n') and head.endswith(b'\r\n\r\n')
+		assert send_all(region) == body
+		sendfile, _sendfile = _sendfile, None
+		try:
+			# mmap when sendfile is not there
+			assert send_all(cache.lookup(key, req, 1)[1]) == body
+		finally:
+			_sendfile = sendfile
+
+		# a record cut short by a crash is skipped, the rest is loaded
+		cache.disk.close()
+		with open(os.path.join(path, INDEX), 'ab') as f:
+			f.write(b'{"method": "GE')
+		cache = ResponseCache(max_bytes=1024, max_object=512, stats=stats)
+		cache.disk = DiskCache(path, max_bytes=3000, segment_size=1000, stats=stats, now=1)
+		assert len(cache.disk) == 5
+		for key, req, body in stored:
+			assert send_all(cache.lookup(key, req, 2)[1]) == body
+
+		# over max_bytes the oldest segment goes, with what is in it
+		stored += [store(cache, i) for i in range(5, 8)]
+		assert stats['cache_disk_evictions'] == 1 and cache.disk.size <= 3000
+		assert cache.disk.lookup(stored[0][0], stored[0][1].headers, 2) is None
+		assert cache.disk.lookup(stored[7][0], stored[7][1].headers, 2) is not None
+
+		# a failed write through, e.g. a full disk: the memory entry stays
+		# and the next body goes to a new segment
+		class Full(object):
+			def write(self, data):
+				raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+			def close(self):
+				pass
+
+		key, req, body = store(cache, 8, 2)
+		# with room for one more
+		segment = cache.disk.lookup(key, req.headers, 2).body.segment
+		real, segment._file = segment._file, Full()
+		stores = stats['cache_disk_stores']
+		key, req, body = store(cache, 9, 2)
+		segment._file = real
+		assert stats['cache_disk_stores'] == stores and segment.failed
+		assert cache._find(key, req.headers, 2)[1] is not None
+		assert cache.disk.lookup(key, req.headers, 2) is None
+		key, req, body = store(cache, 10, 2)
+		assert cache.disk.lookup(key, req.headers, 2).body.segment is not segment
+
+		# expired entries are not loaded, their segments are removed
+		cache.disk.close()
+		disk = DiskCache(path, max_bytes=3000, segment_size=1000, stats=stats, now=100)
+		assert len(disk) == 0 and disk.size == 0
+		assert not [name for name in os.listdir(path) if name.endswith('.seg')]
+		disk.close()
+	finally:
+		shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+	test()
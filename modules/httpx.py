@@ -3,227 +3,374 @@ from __future__ import absolute_import, division, print_function, with_statement
 import sys
 import os
 
-import time
-import socket
-import errno
-import struct
 import logging
-import traceback
-import random
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
 
-HTTP_INIT = 0
-HTTP_REQUEST_LINE = 1
-HTTP_REQUEST_HEADER = 2
-HTTP_REQUEST_BODY = 3
+# an incremental HTTP/1.x framer: it finds where each message ends
+# (Content-Length, chunked, close delimited, body-less responses) without
+# copying bodies, so the relay can forward bytes as they come and still
+# know the request / response boundaries
 
-HTTP_RESPONSE_STATUS_LINE = 4
-HTTP_RESPONSE_HEADER = 5
-HTTP_RESPONSE_BODY = 6
+HTTP_INIT = 0 # reading the start line and headers
+HTTP_BODY = 1 # Content-Length body
+HTTP_CHUNK_SIZE = 2
+HTTP_CHUNK_DATA = 3
+HTTP_CHUNK_END = 4 # the CRLF after chunk data
+HTTP_TRAILER = 5
+HTTP_BODY_EOF = 6 # body delimited by the connection close
+HTTP_TUNNEL = 7 # CONNECT / 101, opaque from here on
+HTTP_DONE = 8
+
+HEADER_MAX = 64 * 1024
+LINE_MAX = 4 * 1024
 
-class HTTPX(object):
-	def __init__(self):
-		self._state = HTTP_INIT
-		self._headers = []
-		self._host = ''
-		self._start = 0
-		self._pos = 0
-		self._pending_data = ''
-
-	def check_header(self):
-		if self._state >= HTTP_REQUEST_HEADER:
-			return True
-		else:
-			return False 
-
-	def get_data(self):
-		#logging.info('get_data')
-		url = ''
-		if len(self._host) > 0 and self._request_line.find(self._host) != -1:
-			url = self._request_line.replace(self._host, '/', 1)
-		
-
-		
-
-		if url.find('http://') != -1:
-			logging.info('request_line:%s', self._request_line)
-			logging.info('host:%s', self._host)
-			logging.info('url:%s', url)
-
-		data = url + '\r\n'
-		for item in self._headers:
-			data += (item + '\r\n')
-		data += '\r\n'
-		data += self._pending_data
-
-		logging.info('after:%s, %d, %d', data, len(self._host), self._request_line.find(self._host))
-
-		self._request_line = ''
-		self._headers = []
-		self._pending_data = ''
-		return data
-
-	def get_response(self):
-		data = self._response_status_line + '\r\n'
-		for item in self._headers:
-			data += (item + '\r\n')
-		data += '\r\n'
-		data += self._pending_data
-
-		self._response_status_line = ''
-		self._headers = []
-		self._pending_data = ''
-		return data
-
-
-
-	def get_host_address_and_port(self):
-		#logging.info('get_host_address_and_port')
-		host = ''
-		addr = ''
-		port = 80
-		self._host = ''
-		for item in self._headers:
-			
-			if item.find('Host:') != -1:
-				logging.debug(item)
-				host = item[6:]
-				self._host = 'http://' + host + '/'
-				break
-		if len(self._host) == 0:
-			start = self._request_line.find('//')
-			end = self.request_line.find('/', start + 2)
-			host = self._request_line[start + 2 : end]
-			self._host = 'http://' + self._request_line[start + 2 : end] + '/'
-			logging.debug('_host:%s', self._host)
-			self._headers.append('Host: ' + host)
-			
-		if host.find(':') != -1:
-			addr = host[0:host.find(':')]
-			port = int(host[host.find(':') + 1:])
-		else:
-			addr = host
-		logging.debug('%s, %d', addr, port)
-
-		return addr, port
-
-	def _parse_headers(self, buf, start):
-		index  = buf.find('\r\n', start)
-		while index != -1:
-			if index == start:
-				self._state = HTTP_REQUEST_HEADER
-				start += 2
-				break
-			#logging.debug('header:' + buf[start:index])
-			self._headers.append(buf[start:index])
-			start = index + 2
-			index = buf.find('\r\n', start)
-			#logging.debug('header:start:%d, index:%d', start, index)
-			#logging.debug('header:' + buf[start:])
-		self._pending_data = buf[start:]
-		#logging.debug('state:%d', self._state)
-
-	def _parse_response_headers(self, buf, start):
-		index  = buf.find('\r\n', start)
-		while index != -1:
-			if index == start:
-				self._state = HTTP_RESPONSE_HEADER
-				start += 2
-				break
-			#logging.debug('header:' + buf[start:index])
-			self._headers.append(buf[start:index])
-			start = index + 2
-			index = buf.find('\r\n', start)
-			#logging.debug('header:start:%d, index:%d', start, index)
-			#logging.debug('header:%s' ,buf[start:index])
-		self._pending_data = buf[start:]
-		#logging.debug('state:%d', self._state)
-
-
-	# save data in pending buf
-	def _parse_body(self, buf, start):
-		self._pending_data = buf
-
-	def _parse_response_body(self, buf, start):
-		self._pending_data = buf
-
-	def parse_request(self, buf):
-		#logging.debug('HTTPX:parse')
-		index = -1
-		data = ''
-		if len(self._pending_data) != 0:
-			data = self._pending_data + buf
-			self._pending_data = ''
-		else:
-			data = buf
 
-		# not get request line yet
-		if self._state == HTTP_INIT:
-			#logging.debug('request_line:' + data[0:data.find('\r\n')])
-			if data.find('GET') == -1 and data.find('POST') == -1:
-				return False
+class HTTPError(Exception):
+	pass
 
 
+class HTTPX(object):
+	# one per message being parsed, there may be many
+	__slots__ = ('_is_response', '_state', '_buf', '_left', 'request_method',
+				'head', 'method', 'uri', 'version', 'status', 'headers',
+				'keep_alive', 'complete')
+
+	def __init__(self, response=False):
+		self._is_response = response
+		self.reset()
 
-			index = data.find('\r\n')
-			
-			#logging.info('origin:%s', data[0:index])
-			if index != -1:
-				self._request_line = data[0:index]
-				#logging.info('request:%s', self._request_line)
-				self._state = HTTP_REQUEST_LINE
-				self._parse_headers(data, index + 2)
+	def reset(self):
+		"""ready for the next message on the same connection"""
+		self._state = HTTP_INIT
+		self._buf = b''
+		self._left = 0
+		# responses to HEAD have no body, set before the head is fed
+		self.request_method = None
+		self.head = None # start line and headers, as received
+		self.method = None
+		self.uri = None
+		self.version = None
+		self.status = None
+		self.headers = [] # [(name, value), ...]
+		self.keep_alive = False
+		self.complete = False
+
+	@property
+	def headers_complete(self):
+		return self._state != HTTP_INIT
+
+	@property
+	def tunnel(self):
+		return self._state == HTTP_TUNNEL
+
+	@property
+	def close_delimited(self):
+		return self._state == HTTP_BODY_EOF
+
+	@property
+	def buffered(self):
+		# bytes of the head fed so far while it is not complete
+		return len(self._buf) if self._state == HTTP_INIT else 0
+
+	@property
+	def idle(self):
+		# nothing of the next message received yet
+		return self._state == HTTP_INIT and not self._buf
+
+	def get_header(self, name):
+		name = name.lower()
+		value = None
+		for k, v in self.headers:
+			if k.lower() == name:
+				value = v
+		return value
+
+	def host_and_port(self):
+		"""where a request goes: the absolute-form uri, else Host"""
+		host = None
+		uri = self.uri or b''
+		if uri.lower().startswith(b'http://'):
+			end = uri.find(b'/', 7)
+			host = uri[7:] if end == -1 else uri[7:end]
+		if not host:
+			host = self.get_header(b'host')
+		if not host:
+			return None
+		port = b'80'
+		if host.startswith(b'['):
+			end = host.find(b']')
+			if host[end + 1:end + 2] == b':':
+				port = host[end + 2:]
+			host = host[1:end]
+		elif host.find(b':') != -1:
+			host, port = host[:host.find(b':')], host[host.find(b':') + 1:]
+		try:
+			n = int(port)
+		except ValueError:
+			n = 0
+		if not 0 < n <= 65535:
+			raise HTTPError('bad port %r' % port)
+		return host, n
+
+	def feed(self, data):
+		"""parse data, returns how many bytes of it belong to this message.
+		once complete is set the rest of data starts the next message.
+		data is bytes or a memoryview, bodies are not copied out of it"""
+		pos = 0
+		end = len(data)
+		while pos < end and not self.complete:
+			state = self._state
+			if state in (HTTP_INIT, HTTP_CHUNK_SIZE, HTTP_TRAILER) and \
+					isinstance(data, memoryview):
+				# lines are searched for in bytes
+				data = data.tobytes()
+			if state == HTTP_INIT:
+				pos = self._feed_head(data, pos)
+			elif state == HTTP_BODY or state == HTTP_CHUNK_DATA:
+				n = min(self._left, end - pos)
+				pos += n
+				self._left -= n
+				if not self._left:
+					if state == HTTP_BODY:
+						self._done()
+					else:
+						self._state = HTTP_CHUNK_END
+						self._left = 2
+			elif state == HTTP_CHUNK_END:
+				n = min(self._left, end - pos)
+				pos += n
+				self._left -= n
+				if not self._left:
+					self._state = HTTP_CHUNK_SIZE
+			elif state == HTTP_CHUNK_SIZE:
+				line, pos = self._feed_line(data, pos)
+				if line is not None:
+					try:
+						size = int(line.split(b';', 1)[0].strip(), 16)
+					except ValueError:
+						raise HTTPError('bad chunk size')
+					if size:
+						self._state = HTTP_CHUNK_DATA
+						self._left = size
+					else:
+						self._state = HTTP_TRAILER
+			elif state == HTTP_TRAILER:
+				line, pos = self._feed_line(data, pos)
+				if line == b'':
+					self._done()
 			else:
-				self._pending_data = data
-			return True
-
-		# already get the reqeust line
-		if self._state == HTTP_REQUEST_LINE:
-			self._parse_headers(data, 0)
-			return True
-
-		# already get all headers
-		if self._state == HTTP_REQUEST_HEADER:
-			self._parse_body(data, 0)
-			return True
-
-	def parse_response(self, buf):
-		#logging.debug('HTTPX:parse')
-		index = -1
-		data = ''
-		if len(self._pending_data) != 0:
-			data = self._pending_data + buf
-			self._pending_data = ''
+				# close delimited or tunnel
+				pos = end
+		return pos
+
+	def feed_eof(self):
+		"""the connection was closed, returns whether the message is whole"""
+		if self._state == HTTP_BODY_EOF:
+			self._done()
+		return self.complete
+
+	def _done(self):
+		self._state = HTTP_DONE
+		self.complete = True
+
+	def _feed_line(self, data, pos):
+		i = data.find(b'\n', pos)
+		if i == -1:
+			self._buf += data[pos:]
+			if len(self._buf) > LINE_MAX:
+				raise HTTPError('line too long')
+			return None, len(data)
+		line = self._buf + data[pos:i]
+		self._buf = b''
+		if line.endswith(b'\r'):
+			line = line[:-1]
+		return line, i + 1
+
+	def _feed_head(self, data, pos):
+		# the head may arrive in pieces, keep them until the empty line
+		start = len(self._buf)
+		buf = self._buf + data[pos:]
+		i = buf.find(b'\r\n\r\n')
+		if i == -1:
+			if len(buf) > HEADER_MAX:
+				raise HTTPError('header too long')
+			self._buf = buf
+			return len(data)
+		self._buf = b''
+		self.head = buf[:i + 4]
+		self._parse_head(buf[:i])
+		return pos + i + 4 - start
+
+	def _parse_head(self, head):
+		lines = head.split(b'\r\n')
+		start_line = lines[0]
+		parts = start_line.split(b' ', 2)
+		if len(parts) < 2:
+			raise HTTPError('bad start line %r' % start_line)
+		if self._is_response:
+			self.version = parts[0]
+			try:
+				self.status = int(parts[1])
+			except ValueError:
+				raise HTTPError('bad status line %r' % start_line)
 		else:
-			data = buf
-
-		# not get request line yet
-		if self._state == HTTP_INIT:
-			#logging.debug('request_line:' + data[0:data.find('\r\n')])
-			index = data.find('\r\n')
-			if index != -1:
-				self._response_status_line = data[0:index]
-				self._state = HTTP_RESPONSE_STATUS_LINE
-				self._parse_response_headers(data, index + 2)
-			else:
-				self._pending_data = data
+			if len(parts) < 3:
+				raise HTTPError('bad request line %r' % start_line)
+			self.method, self.uri, self.version = parts
+		if not self.version.startswith(b'HTTP/'):
+			raise HTTPError('bad version in %r' % start_line)
+		headers = self.headers
+		for line in lines[1:]:
+			if line[:1] in (b' ', b'\t') and headers:
+				# obsolete line folding
+				headers[-1] = (headers[-1][0], headers[-1][1] + b' ' + line.strip())
+				continue
+			i = line.find(b':')
+			if i <= 0:
+				raise HTTPError('bad header %r' % line)
+			headers.append((line[:i].strip(), line[i + 1:].strip()))
+		self._frame()
+
+	def _frame(self):
+		connection = (self.get_header(b'connection') or b'').lower()
+		if not self._is_response and not connection:
+			connection = (self.get_header(b'proxy-connection') or b'').lower()
+		if self.version == b'HTTP/1.0':
+			self.keep_alive = b'keep-alive' in connection
+		else:
+			self.keep_alive = b'close' not in connection
+		te = self.get_header(b'transfer-encoding')
+		length = self.get_header(b'content-length')
+		status = self.status
+		if self._is_response:
+			if status == 101 or (self.request_method == b'CONNECT' and
+					200 <= status < 300):
+				self._state = HTTP_TUNNEL
+				self.keep_alive = False
+				return
+			if self.request_method == b'HEAD' or 100 <= status < 200 or \
+					status in (204, 304):
+				self._done()
+				return
+		elif self.method == b'CONNECT':
+			self._state = HTTP_TUNNEL
+			self.keep_alive = False
 			return
-
-		# already get the reqeust line
-		if self._state == HTTP_RESPONSE_LINE:
-			self._parse_response_headers(data, 0)
-
-		# already get all headers
-		if self._state == HTTP_RESPONSE_HEADER:
-			self._parse_response_body(data, 0)
-
-
-
-
-
-
-
-
-
-
+		if te is not None and b'chunked' in te.lower():
+			self._state = HTTP_CHUNK_SIZE
+		elif length is not None:
+			try:
+				self._left = int(length)
+			except ValueError:
+				raise HTTPError('bad content-length %r' % length)
+			if self._left < 0:
+				raise HTTPError('bad content-length %r' % length)
+			self._state = HTTP_BODY
+			if not self._left:
+				self._done()
+		elif self._is_response:
+			self._state = HTTP_BODY_EOF
+			self.keep_alive = False
+		else:
+			self._done()
+
+
+def test():
+	def feed_all(parser, data, step):
+		# feed step bytes at a time, returns the bytes left after the message
+		pos = 0
+		while pos < len(data) and not parser.complete:
+			chunk = data[pos:pos + step]
+			pos += parser.feed(chunk)
+		return data[pos:]
+
+	get = b'GET http://example.com:8080/a HTTP/1.1\r\nHost: example.com:8080\r\n\r\n'
+	post = b'POST /b HTTP/1.1\r\nHost: b.example\r\nContent-Length: 5\r\n\r\nhello'
+	chunked = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+			b'5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+	for step in (1, 3, 7, 4096):
+		p = HTTPX()
+		assert feed_all(p, get + post, step) == post
+		assert p.method == b'GET' and p.keep_alive
+		assert p.host_and_port() == (b'example.com', 8080)
+		p.uri = b'http://[::1]:81/'
+		assert p.host_and_port() == (b'::1', 81)
+		for uri in (b'http://a:70000/', b'http://a:-1/', b'http://a:0/', b'http://a:x/'):
+			p.uri = uri
+			try:
+				p.host_and_port()
+				assert False, uri
+			except HTTPError:
+				pass
+		p.reset()
+		assert feed_all(p, post, step) == b''
+		assert p.complete and p.host_and_port() == (b'b.example', 80)
+
+		p = HTTPX(response=True)
+		assert feed_all(p, chunked + b'HTTP/1.1', step) == b'HTTP/1.1'
+		assert p.status == 200 and p.keep_alive
+		p = HTTPX(response=True)
+		assert feed_all(p, memoryview(chunked + post), step).tobytes() == post
+		p = HTTPX()
+		assert feed_all(p, memoryview(post + get), step).tobytes() == get
+
+	# a head in pieces is kept by the parser until it is whole
+	p = HTTPX()
+	assert p.feed(post[:10]) == 10 and p.buffered == 10 and not p.headers_complete
+	n = p.feed(post[10:])
+	assert p.head == post[:-5] and n == len(post) - 10 and p.buffered == 0
+
+	# body-less responses
+	for status, method in ((204, b'GET'), (304, b'GET'), (200, b'HEAD'), (100, b'GET')):
+		p = HTTPX(response=True)
+		p.request_method = method
+		head = b'HTTP/1.1 %d X\r\nContent-Length: 10\r\n\r\n' % status
+		assert p.feed(head + b'next') == len(head) and p.complete
+
+	# close delimited
+	p = HTTPX(response=True)
+	data = b'HTTP/1.0 200 OK\r\n\r\nsome body'
+	assert p.feed(data) == len(data)
+	assert not p.complete and not p.keep_alive and p.close_delimited
+	assert p.feed_eof() and p.complete
+
+	# truncated Content-Length body
+	p = HTTPX(response=True)
+	p.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc')
+	assert not p.feed_eof()
+
+	# keep-alive rules
+	for head, keep_alive in ((b'GET / HTTP/1.0\r\n\r\n', False),
+			(b'GET / HTTP/1.0\r\nConnection: Keep-Alive\r\n\r\n', True),
+			(b'GET / HTTP/1.0\r\nProxy-Connection: keep-alive\r\n\r\n', True),
+			(b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n', False)):
+		p = HTTPX()
+		p.feed(head)
+		assert p.complete and p.keep_alive == keep_alive, head
+
+	# tunnels
+	p = HTTPX()
+	p.feed(b'CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n')
+	assert p.tunnel and not p.complete
+	assert p.feed(b'\x16\x03\x01') == 3
+	p = HTTPX(response=True)
+	p.feed(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n\r\n')
+	assert p.tunnel
+
+	for bad in (b'GET\r\n\r\n', b'GET / FTP/1.0\r\n\r\n', b'GET / HTTP/1.1\r\nno colon\r\n\r\n',
+			b'POST / HTTP/1.1\r\nContent-Length: x\r\n\r\n'):
+		try:
+			HTTPX().feed(bad)
+			assert False, bad
+		except HTTPError:
+			pass
+	try:
+		HTTPX().feed(b'GET / HTTP/1.1\r\n' + b'X: y\r\n' * HEADER_MAX)
+		assert False
+	except HTTPError:
+		pass
+
+
+if __name__ == '__main__':
+	test()
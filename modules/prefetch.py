@@ -0,0 +1,282 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+import sys
+import os
+import re
+import time
+import collections
+import logging
+
+try:
+	from urlparse import urljoin, urldefrag
+except ImportError:
+	from urllib.parse import urljoin, urldefrag
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+from proxyx import common
+from modules import httpx
+
+# pages going through the relay are scanned for the subresources they link
+# to as they stream by, which are then fetched into the response cache so
+# the requests of the browser that follow are hits
+
+# tags whose link is a subresource, <a> and <iframe> are navigations
+_TAG = re.compile(br'<(img|script|link)\b([^>]*)>', re.I)
+_ATTR = re.compile(br'''([\w-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+# css, in stylesheets and in the style of html
+_CSS_URL = re.compile(br'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^\s"')]+))\s*\)|'''
+					br'''@import\s+(?:"([^"]*)"|'([^']*)')''', re.I)
+# bytes percent-encoded in a link before it is resolved, as browsers do
+_NON_ASCII = re.compile(br'[\x80-\xff]')
+# the <link rel> that are fetched by the browser anyway
+LINK_RELS = (b'stylesheet', b'icon', b'preload', b'modulepreload')
+
+# a link may straddle two reads, that many bytes of the last one are
+# scanned again with the next one
+SCAN_OVERLAP = 1024
+# past that much of a page its links are left alone
+SCAN_MAX = 1024 * 1024
+# links waiting for a free fetch, the ones past it are skipped
+QUEUE_MAX = 256
+
+# the request headers a prefetch copies from its page, so that what the
+# response varies on usually matches the request of the browser
+COPY_HEADERS = (b'user-agent', b'accept-language', b'accept-encoding')
+
+
+def _attrs(data):
+	attrs = {}
+	for m in _ATTR.finditer(data):
+		attrs[m.group(1).lower()] = m.group(2) or m.group(3) or m.group(4) or b''
+	return attrs
+
+
+def html_links(data):
+	links = []
+	for m in _TAG.finditer(data):
+		tag = m.group(1).lower()
+		attrs = _attrs(m.group(2))
+		if tag == b'link':
+			rel = attrs.get(b'rel', b'').lower().split()
+			if not any(r in LINK_RELS for r in rel):
+				continue
+			link = attrs.get(b'href')
+		else:
+			link = attrs.get(b'src')
+		if link:
+			links.append(link.replace(b'&amp;', b'&'))
+	return links + css_links(data)
+
+
+def css_links(data):
+	links = []
+	for m in _CSS_URL.finditer(data):
+		link = [g for g in m.groups() if g]
+		if link:
+			links.append(link[0])
+	return links
+
+
+class Page(object):
+	"""the links of one response, fed as it is received"""
+
+	def __init__(self, prefetcher, url, address, request_headers, scan):
+		self._prefetcher = prefetcher
+		self.url = url
+		self.address = address
+		self.request_headers = request_headers
+		self._scan = scan # html_links or css_links
+		self._tail = b''
+		self._scanned = 0
+		self._seen = set()
+		# links queued for it, up to max_per_page
+		self.count = 0
+
+	def feed(self, data):
+		if self._scanned >= SCAN_MAX:
+			return
+		self._scanned += len(data)
+		data = self._tail + data
+		self._tail = data[-SCAN_OVERLAP:]
+		for link in self._scan(data):
+			if link not in self._seen:
+				self._seen.add(link)
+				self._prefetcher.add(self, link)
+
+
+class Prefetcher(object):
+	"""fetches the subresources of pages into the response cache, at most
+	concurrency of them at a time and max_per_page for each page.
+	start(data, request, address, callback) sends the request in data and
+	calls callback() once done with it, whatever the outcome.
+	This class is not thread safe"""
+
+	def __init__(self, cache, start, max_per_page, concurrency, origins=(),
+			stats=None):
+		self._cache = cache
+		self._start = start
+		self._max_per_page = max_per_page
+		self._concurrency = concurrency
+		# other hosts links are followed to, besides the origin of the page
+		self._origins = set(common.to_bytes(origin).lower() for origin in origins)
+		self._queue = collections.deque()
+		self._pending = set() # cache keys queued or being fetched
+		self._running = 0
+		self._closed = False
+		if stats is None:
+			stats = {}
+		self.stats = stats
+		for k in ('prefetch_requests', 'prefetch_skipped', 'prefetch_bytes'):
+			stats.setdefault(k, 0)
+
+	def page(self, url, address, request_headers, response):
+		"""a Page to feed the response of a GET for url with, None when it
+		has no links to scan"""
+		if self._closed or response.status != 200:
+			return None
+		if (response.get_header(b'content-encoding') or b'identity').lower() != b'identity':
+			return None
+		content_type = (response.get_header(b'content-type') or b'').lower()
+		content_type = content_type.split(b';', 1)[0].strip()
+		if content_type in (b'text/html', b'application/xhtml+xml'):
+			scan = html_links
+		elif content_type == b'text/css':
+			scan = css_links
+		else:
+			return None
+		return Page(self, url, address, request_headers, scan)
+
+	def add(self, page, link):
+		if self._closed:
+			return
+		link = _NON_ASCII.sub(lambda m: b'%%%02X' % ord(m.group()), link.strip())
+		try:
+			url = urldefrag(urljoin(page.url, link))[0]
+		except (ValueError, UnicodeError) as e:
+			# e.g. a broken ipv6 address
+			logging.debug('prefetch %r: %s', link, e)
+			return
+		if not url.lower().startswith(b'http://'):
+			# https goes through CONNECT, the relay does not see it
+			return
+		i = url.find(b'/', 7)
+		host = url[7:] if i == -1 else url[7:i]
+		lines = [b'GET ' + url + b' HTTP/1.1', b'Host: ' + host]
+		for name, value in page.request_headers:
+			if name.lower() in COPY_HEADERS:
+				lines.append(name + b': ' + value)
+		data = b'\r\n'.join(lines) + b'\r\n\r\n'
+		request = httpx.HTTPX()
+		try:
+			request.feed(data)
+			address = request.host_and_port()
+		except httpx.HTTPError as e:
+			logging.debug('prefetch %r: %s', url, e)
+			return
+		if address is None or not request.complete:
+			return
+		if address != page.address and address[0].lower() not in self._origins:
+			return
+		key = self._cache.key(request, address)
+		if key is None or key in self._pending or \
+				self._cache.fresh(key, request.headers, time.time()):
+			return
+		if page.count >= self._max_per_page or len(self._queue) >= QUEUE_MAX:
+			self.stats['prefetch_skipped'] += 1
+			return
+		page.count += 1
+		self._pending.add(key)
+		self._queue.append((key, data, request, address))
+		self._next()
+
+	def _next(self):
+		while self._queue and self._running < self._concurrency:
+			key, data, request, address = self._queue.popleft()
+			self._running += 1
+			self.stats['prefetch_requests'] += 1
+			logging.debug('prefetch %s', key[1])
+			self._start(data, request, address, lambda key=key: self._done(key))
+
+	def _done(self, key):
+		self._running -= 1
+		self._pending.discard(key)
+		if not self._closed:
+			self._next()
+
+	def close(self):
+		# the ones running finish on their own
+		self._closed = True
+		self._queue.clear()
+
+
+def test():
+	from modules import cache
+
+	html = (b'<html><head><link rel="stylesheet" href="/a.css">'
+		b'<link rel=canonical href="/page"><script src=\'js/b.js\'></script>'
+		b'<style>body { background: url( "/bg.png" ) }</style></head>'
+		b'<body><a href="/other">x</a><IMG alt="x" SRC=c.png?x=1&amp;y=2>'
+		b'<img src="http://cdn.example/d.png"><img src="http://elsewhere/e.png">'
+		b'<img src="https://example.com/f.png"><img src="data:image/png;base64,AA">'
+		b'<img src="/a.css#frag"></body></html>')
+	assert html_links(html) == [b'/a.css', b'js/b.js', b'c.png?x=1&y=2',
+		b'http://cdn.example/d.png', b'http://elsewhere/e.png',
+		b'https://example.com/f.png', b'data:image/png;base64,AA',
+		b'/a.css#frag', b'/bg.png'], html_links(html)
+	assert css_links(b'@import "x.css"; a { b: url(y.png) } c { d: url(\'z.woff\') }') == \
+		[b'x.css', b'y.png', b'z.woff']
+
+	def response(head):
+		r = httpx.HTTPX(response=True)
+		r.request_method = b'GET'
+		r.feed(head)
+		return r
+
+	started = []
+	c = cache.ResponseCache(1024 * 1024, 1024 * 1024)
+	p = Prefetcher(c, lambda data, request, address, callback:
+				started.append((request.uri, callback)), 3, 2, [u'cdn.example'])
+	headers = [(b'Host', b'example.com'), (b'User-Agent', b'test'), (b'Cookie', b'secret')]
+	address = (b'example.com', 80)
+	url = b'http://example.com:80/dir/index.html'
+	for head in (b'HTTP/1.1 404 Not Found\r\nContent-Type: text/html\r\n\r\n',
+			b'HTTP/1.1 200 OK\r\nContent-Type: image/png\r\n\r\n',
+			b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Encoding: gzip\r\n\r\n'):
+		assert p.page(url, address, headers, response(head)) is None
+
+	# fed in pieces, links straddling two of them included
+	page = p.page(url, address, headers,
+				response(b'HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n\r\n'))
+	for i in range(0, len(html), 7):
+		page.feed(html[i:i + 7])
+	# same origin and the configured one, two at a time, three for the page
+	assert [uri for uri, callback in started] == [b'http://example.com:80/a.css',
+		b'http://example.com:80/dir/js/b.js'], started
+	assert p.stats['prefetch_requests'] == 2 and p.stats['prefetch_skipped'] == 2, p.stats
+	started.pop(0)[1]()
+	# in the order they came, the style one before the images after it
+	assert [uri for uri, callback in started] == [b'http://example.com:80/dir/js/b.js',
+		b'http://example.com:80/bg.png'], started
+
+	# the request copies what the response may vary on, not the cookies
+	data = []
+	p = Prefetcher(c, lambda *args: data.append(args[0]), 8, 8)
+	page = p.page(url, address, headers, response(b'HTTP/1.1 200 OK\r\nContent-Type: text/css\r\n\r\n'))
+	page.feed(b'a { b: url(y.png) } c { d: url(y.png) }')
+	assert data == [b'GET http://example.com:80/dir/y.png HTTP/1.1\r\nHost: example.com:80\r\n'
+					b'User-Agent: test\r\n\r\n'], data
+	p.close()
+	page.feed(b'e { f: url(z.png) }')
+	assert len(data) == 1
+
+	# links with bytes past ascii are requested encoded, broken ones skipped
+	data = []
+	p = Prefetcher(c, lambda *args: data.append(args[0]), 8, 8)
+	page = p.page(url, address, headers, response(b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n'))
+	page.feed(b'<img src="/caf\xc3\xa9.png"><img src="http://[::1/x.png"><img src="/ok.png">')
+	assert [d.split(b' ', 2)[1] for d in data] == [b'http://example.com:80/caf%C3%A9.png',
+		b'http://example.com:80/ok.png'], data
+
+
+if __name__ == '__main__':
+	test()
@@ -10,97 +10,136 @@ import struct
 import logging
 import traceback
 import random
+import tempfile
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
-from proxyx import eventloop, utils
-from modules import httpx
+from proxyx import eventloop, utils, connector, writequeue
+from modules import httpx, cache
 
 TIMEOUTS_CLEAN_SIZE = 512
 TIMEOUT_PRECISION = 4
 
-MSG_FASTOPEN = 0x20000000
-
 CMD_CONNECT = 1
 CMD_BIND = 2
 CMD_UDP_ASSOCIATE = 3
-# local:
-# stage 0 init
-# stage 1 hello received, hello sent
-# stage 2 UDP assoc
-# stage 3 DNS
-# stage 4 addr received, reply sent
-# stage 5 remote connected
+# client connection (TCPRelayHandler):
+# stage 0 init, reading requests
+# stage 6 closing, flushing the last responses
+# stage 3 destroyed
 
-# remote:
+# exchange, one request and its response:
 # stage 0 init
-# stage 3 DNS
-# stage 4 addr received, reply sent
-# stage 5 remote connected
+# stage 4 DNS
+# stage 5 connecting
+# stage 1 request being sent
+# stage 2 response being received
+# stage 3 done, the remote is back in the pool or closed
 
 STAGE_INIT = 0
 STAGE_HEADER = 1
 STAGE_RESPONSE_INIT = 2
 STAGE_DESTROYED = 3
+STAGE_DNS = 4
+STAGE_CONNECTING = 5
+STAGE_CLOSING = 6 # the remote is gone, flushing to the client
 
+BUF_SIZE = 64 * 1024
 
-# stream direction
-STREAM_UP = 0
-STREAM_DOWN = 1
+# pipelined requests in flight on one client connection, the next one waits
+PIPELINE_MAX = 16
+# response bytes an exchange keeps while earlier responses are still going
+# out, it stops reading its remote beyond that
+PIPELINE_BUFFER = 256 * 1024
 
-# stream wait status
-WAIT_STATUS_INIT = 0
-WAIT_STATUS_READING = 1
-WAIT_STATUS_WRITING = 2
-WAIT_STATUS_READWRITING = WAIT_STATUS_READING | WAIT_STATUS_WRITING
+# backpressure: once that much waits to be sent toward one side, the other
+# side is not read until it is down to LOW_WATER
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
 
-BUF_SIZE = 64 * 1024
+# a prefetch that is not done by then is given up
+PREFETCH_TIMEOUT = 30
+
+# the requests that may go in the SYN with fast open. the network may
+# deliver a SYN twice, and so the data in it (rfc7413 6.3)
+FAST_OPEN_METHODS = (b'GET', b'HEAD', b'OPTIONS')
 
+# what may go to a spill file, regions of files are queued as they are
+SPILLABLE = (bytes, memoryview)
 
-def parse_header(data):
-	host = ''
-	if data.find('http://') != -1:
-		start = data.find('http://') + 7
-		host = data[start:data.find('/', start)]
+# the phases of a request timed into the histograms of the relay, each
+# from the end of the one before it:
+# head: accept to the request head parsed, first request of a connection only
+# dns: to the remote resolved, connect: to its handshake done, neither for
+# a pooled remote
+# wait: to the first byte of the response, transfer: to its last byte
+# total: head parsed to last byte, a cache hit has only this one
+TIMING_PHASES = ('head', 'dns', 'connect', 'wait', 'transfer', 'total')
 
-	elif data.find('Host:') != -1:
-		start = data.find('Host:') + 6
-		host = data[start:data.find('\r\n', start)]
+# edge triggered sockets are registered once for everything
+ET_MODE = eventloop.POLL_IN | eventloop.POLL_OUT | eventloop.POLL_ERR | eventloop.POLL_ET
 
-	else:
-		return None
-	logging.debug('data:%s', data)
-	logging.debug('host:%s', host)
-	return host, 80
 
 class TCPRelayHandler(object):
+	# one per client connection, most of them idle keep-alive ones: no
+	# __dict__, and the parser only while a request is coming in
+	__slots__ = ('_accepted', '_request', '_local_buf', '_exchanges', '_local_done',
+				'_local_eof', '_tunnel', '_local_paused', '_spill_threshold',
+				'_server', '_fd_to_handlers', '_loop', '_local_sock', '_config',
+				'_dns_resolver', '_is_local', '_stage', '_data_to_write_to_local',
+				'_remote_address', '_chosen_server')
+
 	def __init__(self, server, fd_to_handlers, loop, local_sock, config, dns_resolver, is_local):
-                self._ttfb = time.time()
-		self._request = httpx.HTTPX()
-		self._response = httpx.HTTPX()
 		self._server = server
 		self._fd_to_handlers = fd_to_handlers
 		self._loop = loop
-		self._local_sock = local_sock
-		self._remote_sock = None
 		self._config = config
 		self._dns_resolver = dns_resolver
 		self._is_local = is_local
-		self._stage = STAGE_INIT
-		self._fastopen_connected = False
-		self._data_to_write_to_local = []
-		self._data_to_write_to_remote = []
-		self._upstream_status = WAIT_STATUS_READING
-		self._downstream_status = WAIT_STATUS_INIT
-		self._remote_address = None
+		# once that much waits for the client, the rest of a response goes
+		# to a temp file instead, 0 for never
+		self._spill_threshold = int(config['spill_threshold'])
 		if is_local:
 			self._chosen_server = self._get_a_server()
-		fd_to_handlers[local_sock.fileno()] = self
-		local_sock.setblocking(False)
+		self._data_to_write_to_local = writequeue.WriteQueue()
+		self.reset(local_sock)
+
+	def reset(self, local_sock):
+		"""starts on a new client connection. the relay recycles destroyed
+		handlers this way, everything of the last connection goes here"""
+		# cleared once the first request is in, monotonic
+		self._accepted = self._loop.time()
+		# the request being received, None between requests
+		self._request = None
+		# client bytes not yet given to a request, a pipelined request
+		# waits here while it cannot be dispatched
+		self._local_buf = b''
+		# requests in flight, oldest first. only the oldest one writes to
+		# the client, the others keep their response until it is their turn
+		self._exchanges = []
+		# no more requests are taken from the client
+		self._local_done = False
+		# the client sent all it had, what is in _local_buf still counts
+		self._local_eof = False
+		# opaque from here on: client bytes all go to the last exchange
+		self._tunnel = False
+		# not read while the last exchange has too much to send
+		self._local_paused = False
+		self._local_sock = local_sock
+		self._stage = STAGE_INIT
+		self._data_to_write_to_local.clear()
+		self._remote_address = None
+		self._fd_to_handlers[local_sock.fileno()] = self
 		local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-		loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR)
-		self.last_activity = 0
+		if self._loop.edge_triggered:
+			self._loop.add(local_sock, ET_MODE, self.handle_event)
+		else:
+			self._loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR, self.handle_event)
 		self._update_activity()
 
+	@property
+	def remote_address(self):
+		return self._remote_address
+
 	def _get_a_server(self):
 		server_address = self._config['server_address']
 		server_port = self._config['server_port']
@@ -109,181 +148,265 @@ class TCPRelayHandler(object):
 	def _update_activity(self):
 		self._server.update_activity(self)
 
-	def _create_remote_sock(self, ip, port):
-		addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
-
-		if len(addrs) == 0:
-			raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
-		af, socktype, proto, canonname, sa = addrs[0]
-		remote_sock = socket.socket(af, socktype, proto)
-		self._remote_sock = remote_sock
-		self._fd_to_handlers[remote_sock.fileno()] = self
-		remote_sock.setblocking(False)
-		remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-		return remote_sock
-
-	def _update_stream(self, stream, status):
-		dirty = False
-		if stream == STREAM_DOWN:
-			if self._downstream_status != status:
-				self._downstream_status = status
-				dirty = True
-		elif stream == STREAM_UP:
-			if self._upstream_status != status:
-				self._upstream_status = status
-				dirty = True
-		if dirty:
-			if self._local_sock:
-				event = eventloop.POLL_ERR
-				if self._downstream_status & WAIT_STATUS_WRITING:
-					event |= eventloop.POLL_OUT
-				if self._upstream_status &WAIT_STATUS_READING:
-					event |= eventloop.POLL_IN
-				self._loop.modify(self._local_sock, event)
-			if self._remote_sock:
-				event = eventloop.POLL_ERR
-				if self._downstream_status & WAIT_STATUS_READING:
-					event |= eventloop.POLL_IN
-				if self._upstream_status & WAIT_STATUS_WRITING:
-					event |= eventloop.POLL_OUT
-				self._loop.modify(self._remote_sock, event)
+	def _timing(self, phase, seconds):
+		self._server.timings[phase].record(seconds * 1000000)
 
+	def _update_local(self):
+		# level triggered: watch what the client connection waits for
+		if self._loop.edge_triggered or not self._local_sock:
+			return
+		event = eventloop.POLL_ERR
+		if not self._local_done and not self._local_eof and not self._local_paused:
+			event |= eventloop.POLL_IN
+		if self._data_to_write_to_local:
+			event |= eventloop.POLL_OUT
+		self._loop.modify(self._local_sock, event)
 
-	def _handle_dns_resolved(self, result, error):
-		logging.debug('_handle_dns_resolved')
-		logging.info('dns_resolver:%s', result)
-		if error:
-			logging.error(error)
-			self.destroy()
+	def _update_flow(self):
+		# backpressure both ways, between the water marks things stay as
+		# they are: the head exchange reads while little waits for the
+		# client, the client is read while little waits for the last
+		# exchange, its request bytes not sent yet included
+		if self._stage == STAGE_DESTROYED:
 			return
-		if result:
-			ip = result
-			if ip:
-				try:
-					remote_addr = ip
-					if self._is_local:
-						remote_port = self._chosen_server[1]
-					else:
-						remote_port = self._remote_address[1]
-
-					logging.debug('%s,%d', remote_addr, remote_port)
-					remote_sock = self._create_remote_sock(remote_addr, remote_port)
-					try:
-						remote_sock.connect((remote_addr, remote_port))
-					except (OSError, IOError) as e:
-						if eventloop.errno_from_exception(e) == errno.EINPROGRESS:
-							logging.debug('EINPROGRESS')
-						logging.debug(e)
-					logging.debug('connect wait')
-					self._loop.add(remote_sock, eventloop.POLL_ERR | eventloop.POLL_OUT)
-					self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
-					self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
+		exchanges = self._exchanges
+		if exchanges:
+			pending = len(self._data_to_write_to_local)
+			if pending >= HIGH_WATER and not exchanges[0].can_spill:
+				exchanges[0].pause()
+			elif pending <= LOW_WATER:
+				exchanges[0].resume()
+		pending = len(self._local_buf)
+		if exchanges:
+			pending += exchanges[-1].pending
+		if pending >= HIGH_WATER:
+			if not self._local_paused:
+				self._local_paused = True
+				self._update_local()
+		elif pending <= LOW_WATER and self._local_paused:
+			self._local_paused = False
+			if self._loop.edge_triggered and self._local_sock:
+				# what came meanwhile
+				self._loop.rearm(self._local_sock)
+			else:
+				self._update_local()
 
+	def _process_requests(self):
+		# each request on the client connection is routed on its own, the
+		# bytes of one request are only sent to its exchange
+		while self._local_buf and not self._local_done:
+			if self._tunnel:
+				data, self._local_buf = self._local_buf, b''
+				if not self._exchanges:
+					# what the tunnel was for is done, nobody to send it to
+					return
+			else:
+				request = self._request
+				if request is None:
+					request = self._request = self._server.request_parsers.take() or \
+						httpx.HTTPX()
+				if not request.headers_complete and not self._can_dispatch():
+					# waits for earlier responses
+					return
+				had_head = request.headers_complete
+				buffered = request.buffered
+				data = self._local_buf
+				n = request.feed(data)
+				if n < len(data):
+					data, self._local_buf = data[:n], data[n:]
+				else:
+					self._local_buf = b''
+				if not had_head:
+					if not request.headers_complete:
+						# the parser keeps the head until the rest of it comes
+						continue
+					if buffered:
+						# it came in pieces, it goes out whole
+						data = request.head + data[len(request.head) - buffered:]
+					self._on_request_head()
+					if self._local_done or self._stage == STAGE_DESTROYED:
+						return
+				if request.complete:
+					self._request = None
+					request.reset()
+					self._server.request_parsers.put(request)
+					if not self._exchanges[-1].keep_alive:
+						# the last request on this connection
+						self._local_done = True
+						self._local_buf = b''
+						self._update_local()
+				elif request.tunnel:
+					self._tunnel = True
+			exchange = self._exchanges[-1]
+			exchange.send(data)
+			if self._stage == STAGE_DESTROYED:
+				return
+			if exchange.cached is not None:
+				exchange.serve_cached()
+				if self._stage == STAGE_DESTROYED:
+					return
+			elif exchange.stage == STAGE_INIT:
+				# once the head is queued, it may go in the SYN
+				exchange.connect()
+				if self._stage == STAGE_DESTROYED:
 					return
 
-				except (OSError, IOError) as e:
-					logging.error(e)
-					if self._config['verbose']:
-						traceback.print_exc()
-		self.destroy()
+	def _can_dispatch(self):
+		# whether the next request may go out before the earlier responses
+		# are in. one that may turn the connection into a tunnel goes last
+		if not self._exchanges:
+			return True
+		last = self._exchanges[-1]
+		return len(self._exchanges) < PIPELINE_MAX and last.keep_alive and \
+			not last.upgrade
 
-	def _handler(self):
-		logging.debug('_handler')
-		if self._remote_sock:
-			pass
+	def _on_request_head(self):
+		request = self._request
+		address = request.host_and_port()
+		if address is None:
+			raise httpx.HTTPError('no host in request')
+		self._server.stats['requests'] += 1
+		self._remote_address = address
+		exchange = Exchange(self, request, address)
+		self._exchanges.append(exchange)
+		if self._accepted is not None:
+			self._timing('head', exchange.started - self._accepted)
+			self._accepted = None
+		cache = self._server.cache
+		if cache is not None:
+			key = cache.key(request, address)
+			if key is not None:
+				# wall clock, Expires and Date are compared with it
+				exchange.cached = cache.lookup(key, request, time.time())
+				if exchange.cached is not None:
+					# served once the request is in, no remote needed
+					return
+				exchange.keep_for_cache(key, request.headers)
+				if self._server.prefetcher is not None:
+					exchange.scan_links(key[1], request.headers)
+
+	def _on_response_data(self, exchange, data):
+		# a memoryview is of a read buffer, it is copied if kept after
+		if exchange is self._exchanges[0]:
+			queue = self._data_to_write_to_local
+			if 0 < self._spill_threshold <= len(queue) and exchange.can_spill and \
+					isinstance(data, SPILLABLE):
+				# the client is behind, the remote is read on regardless
+				data = exchange.spill(data) or data
+			queue.append(data)
+			self._on_local_write()
+			queue.own()
 		else:
-			remote_address, remote_port = self._request.get_host_address_and_port()
-			logging.debug('handler:%s, %d', remote_address, remote_port)
+			exchange.hold(data)
 
-			self._remote_address = (remote_address, remote_port)
-			self._dns_resolver.resolve(self._remote_address[0], self._handle_dns_resolved)
+	def _on_exchange_complete(self, exchange):
+		if exchange is self._exchanges[-1] and self._request is not None and \
+				self._request.headers_complete and not self._tunnel:
+			# answered before the request body was all sent, the rest of it
+			# goes through as it is and the client connection ends with it
+			exchange.reusable = False
+			exchange.keep_alive = False
+			exchange.tunnel = True
+			self._tunnel = True
+			return
+		exchange.complete = True
+		exchange.time_complete()
+		# its remote goes back to the pool right away
+		exchange.close()
+		if exchange is self._exchanges[0]:
+			self._next_response()
 
-	def _write_to_sock(self, data, sock):
-		if  not data or not sock:
-			return False
-		uncomplete = False
+	def _on_exchange_tunnel(self, exchange):
+		# the response went opaque, later client bytes are for it if it is
+		# the last exchange. the ones after it cannot be answered any more
+		if exchange is self._exchanges[-1]:
+			# no request after it, the client connection ends with it
+			exchange.keep_alive = False
+			self._tunnel = True
+			self._on_local_data()
+		else:
+			self._drop_exchanges(self._exchanges.index(exchange) + 1)
+
+	def _on_exchange_failed(self, exchange):
+		# the response is cut short: the client gets what came of it, then
+		# the connection closes
+		exchange.keep_alive = False
+		exchange.complete = True
+		self._drop_exchanges(self._exchanges.index(exchange) + 1)
+		if exchange is self._exchanges[0]:
+			self._next_response()
+
+	def _drop_exchanges(self, keep):
+		# the client connection ends after the first keep exchanges
+		for exchange in self._exchanges[keep:]:
+			exchange.close()
+		del self._exchanges[keep:]
+		self._local_done = True
+		self._local_buf = b''
+		self._update_local()
+
+	def _next_response(self):
+		# the oldest response is complete, the next one goes out. a
+		# response that ends the client connection drops the ones after it
+		exchanges = self._exchanges
+		while exchanges and exchanges[0].complete:
+			exchange = exchanges.pop(0)
+			if not exchange.keep_alive:
+				self._drop_exchanges(0)
+				break
+			if exchanges:
+				self._data_to_write_to_local.extend(exchanges[0].take_held())
+		# resumes the next one too, unless the client is behind
+		self._on_local_write()
+		if self._stage == STAGE_DESTROYED:
+			return
+		if self._stage == STAGE_INIT and not self._local_done:
+			# requests waiting for a free slot
+			self._on_local_data()
+		self._check_closing()
+
+	def _check_closing(self):
+		# nothing in flight and no more requests coming: flush and close
+		if self._stage == STAGE_INIT and not self._exchanges and \
+				(self._local_done or self._local_eof):
+			self._stage = STAGE_CLOSING
+			self._on_local_write()
+
+	def _write_to_sock(self, queue, sock):
+		"""sends what the socket takes of a WriteQueue, False after an
+		error"""
 		try:
-			l = len(data)
-			s = sock.send(data)
-			#logging.info('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>data:%d', l-s)
-			if s < l:
-				data = data[s:]
-				uncomplete = True
+			queue.send(sock)
 		except (OSError, IOError) as e:
 			error_no = eventloop.errno_from_exception(e)
 			if error_no in (errno.EAGAIN, errno.EINPROGRESS,
 					errno.EWOULDBLOCK):
-				uncomplete = True
-			else:
-				logging.error(e)
+				return True
+			logging.error(e)
 			if self._config['verbose']:
 				traceback.print_exc()
-			self.destroy()
 			return False
-		if uncomplete:
-			if sock == self._local_sock:
-				self._data_to_write_to_local.append(data)
-				self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
-			elif sock == self._remote_sock:
-				self._data_to_write_to_remote.append(data)
-				self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
-			else:
-				logging.error('write_all_to_sock:unknown socket')
-		else:
-			if sock == self._local_sock:
-				self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
-			elif sock == self._remote_sock:
-				self._update_stream(STREAM_UP, WAIT_STATUS_READING)
-			else:
-				logging.error('write_all_to_sock:unknown socket')
 		return True
 
-	# message from upstream
-	def _on_remote_read(self):
-		logging.debug('_on_remote_read')
-		self._update_activity()
-		if not self._remote_sock:
-			return
-		is_local = self._is_local
-		data = None
-		try:
-			data = self._remote_sock.recv(BUF_SIZE)
-		except (OSError, IOError) as e:
-			if eventloop.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-				return
-		if not data:
-                        
-			self.destroy()
-			return
-                if time.time() - self._ttfb >= 1:
-                        logging.info('---------------------------------ttfb:%d', time.time() - self._ttfb)
-                        logging.info(self._host)
-
-		if self._stage == STAGE_HEADER:
-			self._stage = STAGE_RESPONSE_INIT
-		self._data_to_write_to_local.append(data)
-		self._on_local_write()
-		
-
-	def _on_remote_write(self):
-		logging.debug('_on_remote_write')
-		#logging.info('begin:%s, %d', self._remote_address, time.time() - self._ttfb)
-		#self._ttfb = time.time()
-		self._update_activity()
-		if self._stage == STAGE_INIT:
-			self._stage = STAGE_HEADER
-
-		if self._data_to_write_to_remote:
-			data = b''.join(self._data_to_write_to_remote)
-			self._data_to_write_to_remote = []
-			self._write_to_sock(data, self._remote_sock)
-		else:
-			self._update_stream(STREAM_UP, WAIT_STATUS_READING)
-
-	def _on_remote_error(self):
-		logging.debug('_on_remote_error')
-		self._update_activity()
-		self.destroy()
+	def _read_from_sock(self, sock, buf):
+		# reads into buf, returns (bytes read, eof). level triggered reads
+		# once per event, edge triggered until EAGAIN or until buf is full,
+		# then the caller reads again as no new event will come
+		view = memoryview(buf)
+		n = 0
+		while n < len(buf):
+			try:
+				r = sock.recv_into(view[n:])
+			except (OSError, IOError) as e:
+				if eventloop.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				return n, True
+			if not r:
+				return n, True
+			n += r
+			if not self._loop.edge_triggered:
+				break
+		return n, False
 
 	# message from downstream
 
@@ -292,76 +415,65 @@ class TCPRelayHandler(object):
 		self._update_activity()
 		if not self._local_sock:
 			return
-		is_local = self._is_local
-		data = None
-		try:
-			data = self._local_sock.recv(BUF_SIZE)
-		except (OSError, IOError) as e:
-			if eventloop.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+		buffers = self._server.buffers
+		while True:
+			if self._local_paused and self._loop.edge_triggered:
+				# read once resumed
 				return
-		if not data:
+			buf = buffers.lease()
+			n, eof = self._read_from_sock(self._local_sock, buf)
+			taken = n and not self._local_done
+			if taken:
+				# requests are parsed from a copy
+				self._local_buf += memoryview(buf)[:n].tobytes()
+			buffers.release(buf)
+			if taken:
+				self._on_local_data()
+				if self._stage == STAGE_DESTROYED:
+					return
+			if eof:
+				self._on_local_eof()
+				return
+			if not self._loop.edge_triggered or n < len(buf):
+				return
+
+	def _on_local_eof(self):
+		# a client may half close after its last request, the responses to
+		# it still go out. a tunnel or a request cut short ends here
+		if self._tunnel or (self._request is not None and
+				self._request.headers_complete):
 			self.destroy()
 			return
-                
-		if self._stage == STAGE_INIT:
-			header_result = parse_header(data)
-			if header_result is None:
-				raise Exception('can not parse header')
-			self._host = header_result
-			remote_addr, remote_port = header_result
-			#self._remote_address = remote_addr, remote_port
-			self._data_to_write_to_remote.append(data)
-			#self._dns_resolver.resolve(self._remote_address[0], self._handle_dns_resolved)
-			logging.info(remote_addr)
-			addresses = socket.getaddrinfo(remote_addr, remote_port, 0, 0, socket.SOL_TCP)
-			af, socktype, proto, canonname, sa = addresses[0]
-			self._remote_address = sa
-			self._handle_dns_resolved(sa[0], None)
-
-		elif self._stage == STAGE_HEADER:
-			self._data_to_write_to_remote.append(data)
-			self._on_remote_write()
+		self._local_eof = True
+		self._update_local()
+		self._check_closing()
 
-	def _on_local_read_back(self):
-		logging.debug('_on_local_read')
-		self._update_activity()
-		if not self._local_sock:
-			return
-		is_local = self._is_local
-		data = None
+	def _on_local_data(self):
 		try:
-			data = self._local_sock.recv(BUF_SIZE)
-		except (OSError, IOError) as e:
-			if eventloop.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-				return
-		if not data:
-			self.destroy()
-			return
-		logging.debug('data:%s', data[0:80])
-		if self._request.check_header() == False:
-			logging.debug('parse')
-			if self._request.parse_request(data) == False:
+			self._process_requests()
+		except httpx.HTTPError as e:
+			logging.warn('bad request: %s', e)
+			if self._exchanges:
+				# the requests before it are still answered
+				self._drop_exchanges(len(self._exchanges))
+			else:
 				self.destroy()
-			if self._request.check_header() == True:
-				
-				self._handler()
-				logging.debug('send after parse')
-				
-		else:
-			self._data_to_write_to_remote.append(data)
-			logging.debug('send')
-			self._on_remote_write()
-		
+		self._update_flow()
 
 	def _on_local_write(self):
 		logging.debug('_on_local_write')
 		self._update_activity()
-		if self._data_to_write_to_local:
-			data = b''.join(self._data_to_write_to_local)
-			self._data_to_write_to_local = []
-			self._write_to_sock(data, self._local_sock)
-		else:
-			self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
+		if not self._local_sock:
+			return
+		if self._data_to_write_to_local and \
+				not self._write_to_sock(self._data_to_write_to_local, self._local_sock):
+			self.destroy()
+			return
+		if self._stage == STAGE_CLOSING and not self._data_to_write_to_local:
+			self.destroy()
+			return
+		self._update_local()
+		self._update_flow()
 
 	def _on_local_error(self):
 		logging.debug('_on_local_error')
@@ -369,24 +481,13 @@ class TCPRelayHandler(object):
 		self.destroy()
 
 
-	def handle_event(self, sock, event):
+	def handle_event(self, sock, fd, event):
+		# client connection events, the remote ones go to their exchange
 		if self._stage == STAGE_DESTROYED:
 			logging.debug('ignore handle_event: destroyed')
 			return
 
-		if sock == self._remote_sock:
-			if event & eventloop.POLL_ERR:
-				self._on_remote_error()
-				if self._stage == STAGE_DESTROYED:
-					return
-
-			if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-				self._on_remote_read()
-				if self._stage == STAGE_DESTROYED:
-					return
-			if event & eventloop.POLL_OUT:
-				self._on_remote_write()
-		elif sock == self._local_sock:
+		if sock == self._local_sock:
 			if event & eventloop.POLL_ERR:
 				self._on_local_error()
 				if self._stage == STAGE_DESTROYED:
@@ -408,27 +509,1176 @@ class TCPRelayHandler(object):
 			return
 		self._stage = STAGE_DESTROYED
 		if self._remote_address:
-			logging.debug('destroy:%s : %d' %self._remote_address)
+			logging.debug('destroy:%s : %d' %self._remote_address[:2])
 		else:
 			logging.debug('destroy')
-		if self._remote_sock:
+		for exchange in self._exchanges:
 			logging.debug('destroying remote')
-			self._loop.remove(self._remote_sock)
-			del self._fd_to_handlers[self._remote_sock.fileno()]
-			self._remote_sock.close()
-			self._remote_sock = None
+			exchange.close()
+		self._exchanges = []
 		if self._local_sock:
 			logging.debug('destroying local')
 			self._loop.remove(self._local_sock)
 			del self._fd_to_handlers[self._local_sock.fileno()]
 			self._local_sock.close()
 			self._local_sock = None
-		self._dns_resolver.remove_callback(self._handle_dns_resolved)
+		# nothing is kept while it waits to be recycled
+		if self._request is not None:
+			self._request.reset()
+			self._server.request_parsers.put(self._request)
+			self._request = None
+		self._local_buf = b''
+		self._data_to_write_to_local.clear()
 		self._server.remove_handler(self)
 		logging.debug('destroying over')
 
 
+class PrefetchHandler(TCPRelayHandler):
+	"""a client connection without a client: one request of the prefetcher,
+	its response is only kept for the cache. callback() is called once it
+	is done, whatever the outcome"""
+
+	__slots__ = ('_timer', '_callback')
+
+	def __init__(self, server, fd_to_handlers, loop, config, dns_resolver, is_local,
+			data, request, address, callback):
+		self._accepted = None
+		self._server = server
+		self._fd_to_handlers = fd_to_handlers
+		self._loop = loop
+		self._local_sock = None
+		self._config = config
+		self._dns_resolver = dns_resolver
+		self._is_local = is_local
+		self._stage = STAGE_INIT
+		self._remote_address = address
+		self._callback = callback
+		if is_local:
+			self._chosen_server = self._get_a_server()
+		exchange = Exchange(self, request, address)
+		self._exchanges = [exchange]
+		exchange.keep_for_cache(server.cache.key(request, address), request.headers,
+								prefetched=True)
+		# instead of the idle timeout of the relay
+		self._timer = loop.call_later(PREFETCH_TIMEOUT, self.destroy)
+		exchange.send(data)
+		exchange.connect()
+
+	def _update_activity(self):
+		pass
+
+	def _timing(self, phase, seconds):
+		# no client waits on it
+		pass
+
+	def _update_flow(self):
+		pass
 
+	def _on_response_data(self, exchange, data):
+		self._server.stats['prefetch_bytes'] += len(data)
+
+	def _on_exchange_complete(self, exchange):
+		exchange.complete = True
+		self.destroy()
+
+	def _on_exchange_tunnel(self, exchange):
+		self.destroy()
+
+	def _on_exchange_failed(self, exchange):
+		self.destroy()
+
+	def destroy(self):
+		if self._stage == STAGE_DESTROYED:
+			return
+		self._stage = STAGE_DESTROYED
+		self._timer.cancel()
+		# a complete response leaves its remote in the pool
+		for exchange in self._exchanges:
+			exchange.close()
+		self._exchanges = []
+		callback, self._callback = self._callback, None
+		callback()
+
+
+class Exchange(object):
+	"""one request of a client connection and its response, over a remote
+	connection of its own. the exchanges of a connection run at the same
+	time, the handler writes their responses to the client in order"""
+
+	__slots__ = ('_handler', '_loop', 'method', 'address', 'keep_alive', 'upgrade',
+				'reusable', 'tunnel', 'complete', 'paused', 'stage', 'cached',
+				'_cache_key', '_cache_headers', '_cache_chunks', '_cache_checked',
+				'_cache_prefetched', '_scan_url', '_scan_headers', '_page',
+				'_response', '_remote_sock', '_connector', '_pool_key',
+				'_data_to_write_to_remote', '_held', '_held_size', '_spill_left',
+				'_spill', 'started', '_resolved', '_connected', '_first_byte')
+
+	def __init__(self, handler, request, address):
+		self._handler = handler
+		self._loop = handler._loop
+		self.method = request.method
+		self.address = address
+		# whether the client connection goes on after this exchange
+		self.keep_alive = request.keep_alive
+		# the response may switch protocols, nothing is pipelined after it
+		self.upgrade = request.get_header(b'upgrade') is not None
+		# whether the remote connection may go back to the pool
+		self.reusable = request.keep_alive and not request.tunnel
+		self.tunnel = False
+		self.complete = False
+		self.paused = False
+		self.stage = STAGE_INIT
+		# a cached response to serve instead of going to the origin
+		self.cached = None
+		# a copy of the response kept for the cache under _cache_key
+		self._cache_key = None
+		self._cache_headers = None
+		self._cache_chunks = None
+		self._cache_checked = False
+		self._cache_prefetched = False
+		# the url of a page whose links go to the prefetcher, and its Page
+		self._scan_url = None
+		self._scan_headers = None
+		self._page = None
+		# made once the response starts, a cached one needs none
+		self._response = None
+		self._remote_sock = None
+		self._connector = None
+		self._pool_key = None
+		self._data_to_write_to_remote = writequeue.WriteQueue()
+		# response bytes waiting for the earlier responses to go out
+		self._held = []
+		self._held_size = 0
+		# response bytes that may still go to a temp file while the client
+		# is behind, and the file. the regions of it queued for the client
+		# keep it open, it is unlinked from the start
+		self._spill_left = 0
+		if handler._config['spill_threshold']:
+			self._spill_left = int(handler._config['spill_max'])
+		self._spill = None
+		# when the phases of TIMING_PHASES ended, monotonic
+		self.started = self._loop.time()
+		self._resolved = None
+		self._connected = None
+		self._first_byte = None
+
+	def connect(self):
+		handler = self._handler
+		host, port = self.address
+		if handler._is_local:
+			host, port = handler._chosen_server
+		self._pool_key = (host, port)
+		remote_sock = handler._server.pool.checkout(self._pool_key, self._loop.time())
+		if remote_sock:
+			self._attach_remote(remote_sock)
+			return
+		self.stage = STAGE_DNS
+		# may call back right away for ips, hosts and cached names
+		handler._dns_resolver.resolve_all(host, self._handle_dns_resolved)
+
+	def _handle_dns_resolved(self, result, error):
+		logging.debug('_handle_dns_resolved')
+		if self.stage != STAGE_DNS:
+			return
+		if error:
+			logging.error(error)
+			self._fail()
+			return
+		self._resolved = self._time('dns', self.started)
+		remote_port = self._pool_key[1]
+		logging.debug('%s,%d', result[1], remote_port)
+		self.stage = STAGE_CONNECTING
+		fast_open = self._handler._server.fast_open
+		data = b''
+		if fast_open is not None and self.method in FAST_OPEN_METHODS:
+			data = self._data_to_write_to_remote.peek(BUF_SIZE)
+		self._connector = connector.Connector(self._loop, result[1], remote_port,
+											self._handle_connected, data, fast_open)
+		self._connector.start()
+
+	def _handle_connected(self, result, error):
+		self._connector = None
+		if error:
+			logging.error(error)
+			self._fail()
+			return
+		remote_sock, addr, sent = result
+		self._connected = self._time('connect', self._resolved)
+		# what went in the SYN
+		self._data_to_write_to_remote.consume(sent)
+		remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+		self._attach_remote(remote_sock)
+
+	def _attach_remote(self, remote_sock):
+		self._remote_sock = remote_sock
+		self._handler._fd_to_handlers[remote_sock.fileno()] = self._handler
+		self.stage = STAGE_HEADER
+		if self._loop.edge_triggered:
+			self._loop.add(remote_sock, ET_MODE, self.handle_event)
+		else:
+			self._loop.add(remote_sock, eventloop.POLL_IN | eventloop.POLL_ERR,
+						self.handle_event)
+		# what the request has so far
+		self._on_remote_write()
+
+	def _release_remote(self):
+		# give the remote connection back to the pool when its response is
+		# complete, or close it. it is connected once attached
+		remote_sock = self._remote_sock
+		self._remote_sock = None
+		self._loop.remove(remote_sock)
+		del self._handler._fd_to_handlers[remote_sock.fileno()]
+		if self.reusable and self.complete and not self._data_to_write_to_remote:
+			self._handler._server.pool.checkin(self._pool_key, remote_sock,
+											self._loop.time())
+		else:
+			remote_sock.close()
+		self._data_to_write_to_remote.clear()
+
+	def _update(self):
+		# level triggered: watch what the remote connection waits for
+		if self._loop.edge_triggered or not self._remote_sock:
+			return
+		event = eventloop.POLL_ERR
+		if not self.paused:
+			event |= eventloop.POLL_IN
+		if self._data_to_write_to_remote:
+			event |= eventloop.POLL_OUT
+		self._loop.modify(self._remote_sock, event)
+
+	def send(self, data):
+		if self.stage == STAGE_DESTROYED:
+			return
+		self._data_to_write_to_remote.append(data)
+		if self.stage in (STAGE_HEADER, STAGE_RESPONSE_INIT):
+			self._on_remote_write()
+		# else flushed once connected
+
+	@property
+	def pending(self):
+		# request bytes not sent yet
+		return len(self._data_to_write_to_remote)
+
+	def pause(self):
+		if not self.paused:
+			self.paused = True
+			self._update()
+
+	def hold(self, data):
+		# keeps response bytes until the earlier responses are out, reading
+		# stops when too many are waiting, unless they can go to disk
+		if self._held_size >= PIPELINE_BUFFER and self.can_spill and \
+				isinstance(data, SPILLABLE):
+			data = self.spill(data) or data
+		if isinstance(data, memoryview):
+			data = data.tobytes()
+		self._held.append(data)
+		self._held_size += len(data)
+		if self._held_size >= PIPELINE_BUFFER and not self.can_spill:
+			self.pause()
+
+	@property
+	def can_spill(self):
+		# a tunnel has no end to wait for, it is not worth a file
+		return self._spill_left > 0 and not self.tunnel
+
+	def spill(self, data):
+		# appends response bytes, SPILLABLE ones, to the spill file, returns
+		# the region of it to queue instead, or None once spill_max is
+		# reached or the file fails
+		if len(data) > self._spill_left:
+			self._spill_left = 0
+			return None
+		stats = self._handler._server.stats
+		try:
+			if self._spill is None:
+				fd, path = tempfile.mkstemp(prefix='spill-',
+										dir=self._handler._config['spill_dir'] or None)
+				os.close(fd)
+				try:
+					self._spill = cache.Segment(path, 0)
+				finally:
+					os.unlink(path)
+				stats['spills'] += 1
+			offset = self._spill.append(data)
+		except (OSError, IOError) as e:
+			logging.error('spill: %s', e)
+			self._spill_left = 0
+			return None
+		self._spill_left -= len(data)
+		stats['spilled_bytes'] += len(data)
+		return cache.FileRegion(self._spill, offset, len(data))
+
+	def _time(self, phase, since):
+		# the phase ends now, returned
+		now = self._loop.time()
+		self._handler._timing(phase, now - since)
+		return now
+
+	def time_complete(self):
+		# the last byte of the response is in
+		if self._first_byte is not None:
+			self._time('transfer', self._first_byte)
+		self._time('total', self.started)
+
+	def serve_cached(self):
+		# head and body, the body may be a region of a disk cache file
+		response, self.cached = self.cached, None
+		self.stage = STAGE_RESPONSE_INIT
+		# in memory or in a cache file already, not worth a copy
+		self._spill_left = 0
+		for data in response:
+			self._handler._on_response_data(self, data)
+			if self.stage == STAGE_DESTROYED:
+				return
+		self._handler._on_exchange_complete(self)
+
+	def keep_for_cache(self, key, request_headers, prefetched=False):
+		self._cache_key = key
+		self._cache_headers = request_headers
+		self._cache_chunks = []
+		self._cache_prefetched = prefetched
+
+	def scan_links(self, url, request_headers):
+		self._scan_url = url
+		self._scan_headers = request_headers
+
+	def _keep(self, data, done):
+		# copies the response for the cache, until its head shows it can
+		# not be stored
+		response = self._response
+		cache = self._handler._server.cache
+		self._cache_chunks.append(data.tobytes())
+		if not self._cache_checked and response.headers_complete:
+			self._cache_checked = True
+			if not cache.storable(self._cache_headers, response, time.time()):
+				self._cache_key = self._cache_chunks = None
+				return
+		if done:
+			cache.store(self._cache_key, self._cache_headers, response,
+						b''.join(self._cache_chunks), time.time(),
+						self._cache_prefetched)
+			self._cache_key = self._cache_chunks = None
+
+	def _scan(self, data):
+		# gives the links of a page to the prefetcher, as they come
+		if self._page is None:
+			if not self._response.headers_complete:
+				return
+			self._page = self._handler._server.prefetcher.page(self._scan_url,
+									self.address, self._scan_headers, self._response)
+			if self._page is None:
+				self._scan_url = self._scan_headers = None
+				return
+		self._page.feed(data.tobytes())
+
+	def take_held(self):
+		held = self._held
+		self._held = []
+		self._held_size = 0
+		return held
+
+	def resume(self):
+		if not self.paused:
+			return
+		self.paused = False
+		if self.stage == STAGE_DESTROYED or not self._remote_sock:
+			return
+		if self._loop.edge_triggered:
+			# no new event comes for what is already there, unless asked
+			self._loop.rearm(self._remote_sock)
+		else:
+			self._update()
+
+	def _frame(self, data):
+		# returns how many bytes of data belong to the response and whether
+		# it is complete
+		if self.tunnel:
+			return len(data), False
+		response = self._response
+		if response is None:
+			response = self._response = \
+				self._handler._server.response_parsers.take() or httpx.HTTPX(response=True)
+		pos = 0
+		try:
+			while True:
+				response.request_method = self.method
+				pos += response.feed(data[pos:] if pos else data)
+				if response.headers_complete and not response.keep_alive:
+					self.reusable = False
+					if response.close_delimited:
+						# the client finds its end by the close too
+						self.keep_alive = False
+				if response.tunnel:
+					self._to_tunnel()
+					return len(data), False
+				if not response.complete:
+					return pos, False
+				# an interim 1xx response is followed by the real one
+				if not 100 <= response.status < 200:
+					break
+				response.reset()
+				if pos == len(data):
+					return pos, False
+		except httpx.HTTPError as e:
+			logging.warn('%s: %s', self.address, e)
+			self.keep_alive = False
+			self._to_tunnel()
+			return len(data), False
+		if pos < len(data):
+			logging.warn('%s: data after the response', self.address)
+			self.reusable = False
+		return pos, True
+
+	def _to_tunnel(self):
+		self.tunnel = True
+		self.reusable = False
+		self._handler._on_exchange_tunnel(self)
+
+	# message from upstream
+	def _on_remote_read(self):
+		logging.debug('_on_remote_read')
+		handler = self._handler
+		handler._update_activity()
+		buffers = handler._server.buffers
+		while True:
+			if self.paused and self._loop.edge_triggered:
+				# read once resumed
+				return
+			buf = buffers.lease()
+			try:
+				n, eof = handler._read_from_sock(self._remote_sock, buf)
+				self._on_remote_data(memoryview(buf)[:n], eof)
+			finally:
+				# whatever is kept of it was copied
+				buffers.release(buf)
+			if eof or self.stage == STAGE_DESTROYED or \
+					not self._loop.edge_triggered or n < len(buf):
+				return
+
+	def _on_remote_data(self, data, eof):
+		handler = self._handler
+		if eof:
+			# not going back to the pool, whatever came before
+			self.reusable = False
+		done = False
+		if data:
+			if self.stage == STAGE_HEADER:
+				self.stage = STAGE_RESPONSE_INIT
+				self._first_byte = self._time('wait', self._connected or self.started)
+			n, done = self._frame(data)
+			if self.stage == STAGE_DESTROYED:
+				return
+			if n < len(data):
+				data = data[:n]
+			if self._cache_key is not None:
+				self._keep(data, done)
+			if self._scan_url is not None:
+				self._scan(data)
+			if data:
+				handler._on_response_data(self, data)
+				if self.stage == STAGE_DESTROYED:
+					return
+		if done:
+			handler._on_exchange_complete(self)
+		elif eof:
+			# a close delimited response ends here
+			if self._response is not None and self._response.feed_eof():
+				handler._on_exchange_complete(self)
+			else:
+				self._fail()
+
+	def _on_remote_write(self):
+		logging.debug('_on_remote_write')
+		self._handler._update_activity()
+		if self._data_to_write_to_remote and \
+				not self._handler._write_to_sock(self._data_to_write_to_remote,
+												self._remote_sock):
+			self._fail()
+			return
+		self._update()
+		self._handler._update_flow()
+
+	def _on_remote_error(self):
+		logging.debug('_on_remote_error')
+		self._handler._update_activity()
+		self._fail()
+
+	def handle_event(self, sock, fd, event):
+		if self.stage == STAGE_DESTROYED:
+			logging.debug('ignore handle_event: destroyed')
+			return
+		if event & eventloop.POLL_ERR:
+			self._on_remote_error()
+			return
+		if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+			self._on_remote_read()
+			if self.stage == STAGE_DESTROYED:
+				return
+		if event & eventloop.POLL_OUT:
+			self._on_remote_write()
+
+	def _fail(self):
+		self.reusable = False
+		self.close()
+		self._handler._on_exchange_failed(self)
+
+	def close(self):
+		if self.stage == STAGE_DESTROYED:
+			return
+		self.stage = STAGE_DESTROYED
+		if self._remote_sock:
+			self._release_remote()
+		if self._connector:
+			self._connector.close()
+			self._connector = None
+		self._spill_left = 0
+		self._spill = None
+		if self._response is not None:
+			self._response.reset()
+			self._handler._server.response_parsers.put(self._response)
+			self._response = None
+		# a complete response keeps what it holds until its turn
+		self._handler._dns_resolver.remove_callback(self._handle_dns_resolved)
+
+
+
+
+
+
+
+
+def _run_relay(dns_resolver, client, **config_args):
+	"""runs client(proxy_addr, result) in a thread against a relay, until it
+	sets result['done']. result['server'] is the relay, to peek at"""
+	import threading
+	from proxyx import tcprelay
+
+	config = utils.get_config()
+	config['server_address'] = '127.0.0.1'
+	config['server_port'] = 0
+	config.update(config_args)
+	server = tcprelay.TCPRelay(config, dns_resolver, False)
+	proxy = ('127.0.0.1', server._server_socket.getsockname()[1])
+	loop = eventloop.EventLoop(config['edge_triggered'])
+	dns_resolver.add_to_loop(loop)
+	server.add_to_loop(loop)
+
+	result = {'server': server}
+	t = threading.Thread(target=client, args=(proxy, result))
+	t.daemon = True
+	t.start()
+
+	def check():
+		if 'done' in result:
+			loop.stop()
+		else:
+			loop.call_later(0.05, check)
+
+	loop.call_later(0.05, check)
+	loop.call_later(10, loop.stop)
+	loop.run()
+	result['stats'] = dict(server.stats)
+	server.close()
+	dns_resolver.close()
+	return result
+
+
+def _origin(name, delay=0, headers=b'', paths=None):
+	"""a threaded keep-alive origin, answers every request with its name
+	after delay seconds, or with the (headers, body) paths has for its path.
+	returns the listening socket and a dict counting its connections and
+	requests, and the requests of each path"""
+	import threading
+
+	origin = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	origin.bind(('127.0.0.1', 0))
+	origin.listen(5)
+	counts = {'connections': 0, 'requests': 0}
+
+	def handle(conn):
+		data = b''
+		while True:
+			i = data.find(b'\r\n\r\n')
+			if i == -1:
+				chunk = conn.recv(4096)
+				if not chunk:
+					break
+				data += chunk
+				continue
+			path = data.split(b' ', 2)[1]
+			if path.startswith(b'http://'):
+				path = path[path.find(b'/', 7):]
+			data = data[i + 4:]
+			counts['requests'] += 1
+			counts[path] = counts.get(path, 0) + 1
+			time.sleep(delay)
+			h, body = (paths or {}).get(path, (headers, name))
+			conn.sendall(b'HTTP/1.1 200 OK\r\n%sContent-Length: %d\r\n\r\n%s' %
+						(h, len(body), body))
+		conn.close()
+
+	def serve():
+		while True:
+			try:
+				conn, _ = origin.accept()
+			except (OSError, IOError):
+				return
+			counts['connections'] += 1
+			t = threading.Thread(target=handle, args=(conn,))
+			t.daemon = True
+			t.start()
+
+	t = threading.Thread(target=serve)
+	t.daemon = True
+	t.start()
+	return origin, counts
+
+
+def test():
+	from proxyx import asyncdns
+
+	# one lookup stalls on a dns server that never answers, an unrelated
+	# connection to an ip must still go through the same loop meanwhile
+	dns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	dns.bind(('127.0.0.1', 0))
+	dns_resolver = asyncdns.DNSResolver(['127.0.0.1'], dns.getsockname()[1])
+	origin, _ = _origin(b'ok')
+	origin_port = origin.getsockname()[1]
+
+	def stall(proxy, result):
+		stalled = socket.create_connection(proxy)
+		stalled.sendall(b'GET http://stalled.example/ HTTP/1.0\r\n\r\n')
+		# blocks until the lookup is on the wire
+		dns.recvfrom(1024)
+		started = time.time()
+		c = socket.create_connection(proxy)
+		c.sendall(b'GET / HTTP/1.0\r\nHost: 127.0.0.1:%d\r\n\r\n' % origin_port)
+		data = b''
+		while True:
+			chunk = c.recv(4096)
+			if not chunk:
+				break
+			data += chunk
+		result['response'] = data
+		result['elapsed'] = time.time() - started
+		stalled.settimeout(0.2)
+		try:
+			result['stalled'] = stalled.recv(4096)
+		except socket.timeout:
+			result['stalled'] = None
+		stalled.close()
+		c.close()
+		result['done'] = True
+
+	result = _run_relay(dns_resolver, stall)
+	dns.close()
+	origin.close()
+
+	assert result['response'].endswith(b'\r\n\r\nok'), result
+	assert result['elapsed'] < 1, result
+	# still waiting for its lookup, neither answered nor closed
+	assert result['stalled'] is None, result
+
+	# one keep-alive client connection, each request goes to its own origin
+	(a, a_counts), (b, b_counts) = _origin(b'a'), _origin(b'b')
+	hosts = [b'127.0.0.1:%d' % origin.getsockname()[1] for origin in (a, b)]
+
+	def keep_alive(proxy, result):
+		c = socket.create_connection(proxy)
+		c.settimeout(5)
+		result['responses'] = []
+		for host in (hosts[0], hosts[1], hosts[0], hosts[0]):
+			c.sendall(b'GET http://%s/ HTTP/1.1\r\nHost: %s\r\n\r\n' % (host, host))
+			response = httpx.HTTPX(response=True)
+			data = b''
+			while not response.complete:
+				chunk = c.recv(4096)
+				if not chunk:
+					break
+				response.feed(chunk)
+				data += chunk
+			result['responses'].append(data[-1:])
+		# idle between requests, nothing kept for the next one yet
+		time.sleep(0.05)
+		result['idle'] = [(handler._request, handler._data_to_write_to_local._items)
+						for handler in list(result['server']._fd_to_handlers.values())]
+		c.close()
+		result['done'] = True
+
+	result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), keep_alive)
+	assert result['responses'] == [b'a', b'b', b'a', b'a'], result
+	assert result['idle'] == [(None, None)], result
+	assert result['stats']['requests'] == 4, result
+	# the connections to a are reused from the pool
+	assert a_counts['connections'] == 1 and b_counts['connections'] == 1, \
+		(a_counts, b_counts)
+	# the head of the first request only, no dns nor connect for the pooled
+	timings = result['server'].timings
+	assert [timings[phase].count for phase in TIMING_PHASES] == [1, 2, 2, 4, 4, 4], \
+		dict((phase, timings[phase].count) for phase in TIMING_PHASES)
+	assert timings['total'].max >= timings['wait'].max > 0, timings['total'].summary()
+
+	# connections one after the other get the handler and parsers of the
+	# last one, whatever state it was left in
+	def recycled(proxy, result):
+		result['responses'] = []
+		for i, host in enumerate((hosts[0], hosts[1], hosts[0])):
+			c = socket.create_connection(proxy)
+			c.settimeout(5)
+			# the head in two reads
+			c.sendall(b'GET http://%s/ HTTP/1.1\r\n' % host)
+			time.sleep(0.02)
+			c.sendall(b'Host: %s\r\n\r\n' % host)
+			response = httpx.HTTPX(response=True)
+			data = b''
+			while not response.complete:
+				chunk = c.recv(4096)
+				if not chunk:
+					break
+				response.feed(chunk)
+				data += chunk
+			result['responses'].append(data[-1:])
+			# cut short in the middle of the next request
+			c.sendall(b'GET http://%s/ HTTP/1.1\r\nHo' % host)
+			time.sleep(0.05)
+			c.close()
+			time.sleep(0.05)
+		result['done'] = True
+
+	result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), recycled)
+	assert result['responses'] == [b'a', b'b', b'a'], result
+	stats = result['stats']
+	assert stats['handler_free_hits'] == 2 and stats['handler_free_misses'] == 1, stats
+	assert stats['request_parser_free_hits'] == 5, stats
+	assert stats['response_parser_free_hits'] == 2, stats
+	a.close()
+	b.close()
+
+	# reset() sets again every slot but the ones of the relay: a handler
+	# from the free list has nothing of its last connection
+	from proxyx import tcprelay
+
+	def connected():
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		peer = socket.create_connection(listener.getsockname())
+		sock = listener.accept()[0]
+		listener.close()
+		return sock, peer
+
+	config = utils.get_config()
+	config['server_address'] = '127.0.0.1'
+	config['server_port'] = 0
+	server = tcprelay.TCPRelay(config, dns_resolver, False)
+	loop = eventloop.EventLoop()
+	sock, peer = connected()
+	handler = TCPRelayHandler(server, server._fd_to_handlers, loop, sock, config,
+							dns_resolver, False)
+	handler.destroy()
+	assert server.handlers.take() is handler
+	once = ('_server', '_fd_to_handlers', '_loop', '_config', '_dns_resolver',
+			'_is_local', '_spill_threshold', '_chosen_server', '_data_to_write_to_local')
+	stale = object()
+	for name in TCPRelayHandler.__slots__:
+		if name not in once:
+			setattr(handler, name, stale)
+	handler._data_to_write_to_local.append(b'stale')
+	sock2, peer2 = connected()
+	handler.reset(sock2)
+	for name in TCPRelayHandler.__slots__:
+		if name not in once:
+			assert getattr(handler, name) is not stale, name
+	assert not handler._data_to_write_to_local
+	assert server._fd_to_handlers == {sock2.fileno(): handler}
+	handler.destroy()
+	for s in (peer, peer2):
+		s.close()
+	server.close()
+
+	# pipelined requests to slow origins are answered at the same time,
+	# the responses still in request order
+	delay = 0.3
+	(a, a_counts), (b, b_counts) = _origin(b'a', delay), _origin(b'b', delay)
+	hosts = [b'127.0.0.1:%d' % origin.getsockname()[1] for origin in (a, b)]
+
+	def pipeline(proxy, result):
+		c = socket.create_connection(proxy)
+		c.settimeout(5)
+		started = time.time()
+		c.sendall(b''.join(b'GET / HTTP/1.1\r\nHost: %s\r\n\r\n' % host
+			for host in (hosts[0], hosts[1], hosts[0])))
+		result['responses'] = []
+		response = httpx.HTTPX(response=True)
+		while len(result['responses']) < 3:
+			data = c.recv(4096)
+			if not data:
+				break
+			pos = 0
+			while pos < len(data):
+				pos += response.feed(data[pos:])
+				if response.complete:
+					# the last byte of the body
+					result['responses'].append(data[pos - 1:pos])
+					response.reset()
+		result['elapsed'] = time.time() - started
+		c.close()
+		result['done'] = True
+
+	result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), pipeline)
+	assert result['responses'] == [b'a', b'b', b'a'], result
+	assert result['elapsed'] < 2 * delay, result
+	# the two requests to a were in flight together
+	assert a_counts['connections'] == 2, a_counts
+	a.close()
+	b.close()
+
+	# repeated requests for a cacheable response are answered by the relay,
+	# pipelined behind a miss too
+	origin, counts = _origin(b'cached', delay, b'Cache-Control: max-age=60\r\n')
+	host = b'127.0.0.1:%d' % origin.getsockname()[1]
+	get = b'GET /static HTTP/1.1\r\nHost: %s\r\n\r\n' % host
+
+	def cached(proxy, result):
+		c = socket.create_connection(proxy)
+		c.settimeout(5)
+		result['responses'] = []
+		for requests in (1, 1, 2):
+			c.sendall(get * requests)
+			response = httpx.HTTPX(response=True)
+			while requests:
+				data = c.recv(4096)
+				if not data:
+					break
+				pos = 0
+				while pos < len(data):
+					pos += response.feed(data[pos:])
+					if response.complete:
+						result['responses'].append((data[pos - 6:pos],
+							response.get_header(b'age') is not None))
+						response.reset()
+						requests -= 1
+		c.close()
+		result['done'] = True
+
+	result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), cached,
+						cache_size=1024 * 1024)
+	assert result['responses'] == [(b'cached', False)] + [(b'cached', True)] * 3, result
+	assert counts['requests'] == 1, counts
+	stats = result['stats']
+	assert stats['cache_hits'] == 3 and stats['cache_misses'] == 1, stats
+	assert stats['cache_bytes_saved'] > 3 * len(b'cached'), stats
+
+	# with the disk tier a restarted relay still has it
+	import tempfile
+	import shutil
+	path = tempfile.mkdtemp()
+	try:
+		for i in range(2):
+			result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), cached,
+								cache_size=1024 * 1024, cache_dir=path)
+		assert result['responses'] == [(b'cached', True)] * 4, result
+		# served from the segment, it is not copied back into memory
+		assert result['stats']['cache_disk_hits'] == 4, result['stats']
+		assert counts['requests'] == 2, counts
+	finally:
+		shutil.rmtree(path)
+	origin.close()
+
+	# the links of a page are fetched into the cache while the client is
+	# still reading it, its requests for them are hits
+	static = b'Cache-Control: max-age=60\r\n'
+	origin, counts = _origin(b'', paths={
+		b'/': (b'Content-Type: text/html\r\n',
+			b'<link rel="stylesheet" href="/a.css"><img src="b.png"><img src="/c.png">'),
+		b'/a.css': (static + b'Content-Type: text/css\r\n', b'a { b: c }'),
+		b'/b.png': (static, b'b' * 100)})
+	host = b'127.0.0.1:%d' % origin.getsockname()[1]
+
+	def page(proxy, result):
+		c = socket.create_connection(proxy)
+		c.settimeout(5)
+		result['responses'] = []
+		for path in (b'/', b'/a.css', b'/b.png'):
+			c.sendall(b'GET http://%s%s HTTP/1.1\r\nHost: %s\r\n\r\n' % (host, path, host))
+			response = httpx.HTTPX(response=True)
+			while not response.complete:
+				data = c.recv(4096)
+				if not data:
+					break
+				response.feed(data)
+			result['responses'].append(response.get_header(b'age') is not None)
+			if path == b'/':
+				time.sleep(0.2)
+		c.close()
+		result['done'] = True
+
+	result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), page,
+						cache_size=1024 * 1024, prefetch=True, prefetch_max_per_page=2)
+	origin.close()
+	assert result['responses'] == [False, True, True], result
+	assert counts[b'/a.css'] == 1 and counts[b'/b.png'] == 1, counts
+	# the third link is over the fan out
+	assert b'/c.png' not in counts, counts
+	stats = result['stats']
+	assert stats['prefetch_requests'] == 2 and stats['prefetch_skipped'] == 1, stats
+	assert stats['prefetch_bytes'] > stats['prefetch_used_bytes'] > 100, stats
+
+	# a client much slower than its origin, both ways: what the relay keeps
+	# for a connection stays under the high water mark and a read
+	size = 16 * 1024 * 1024
+	origin, counts = _origin(b'x' * size)
+	host = b'127.0.0.1:%d' % origin.getsockname()[1]
+	# accepts in the backlog, never reads
+	sink = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sink.bind(('127.0.0.1', 0))
+	sink.listen(5)
+	sink_host = b'127.0.0.1:%d' % sink.getsockname()[1]
+
+	def pending(server):
+		most = 0
+		for handler in list(server._fd_to_handlers.values()):
+			most = max(most, len(handler._data_to_write_to_local),
+				len(handler._local_buf) + sum(e.pending for e in handler._exchanges))
+		return most
+
+	def slow(proxy, result):
+		server = result['server']
+		c = socket.create_connection(proxy)
+		c.sendall(b'GET / HTTP/1.1\r\nHost: %s\r\n\r\n' % host)
+		result['pending'] = 0
+		for i in range(50):
+			time.sleep(0.01)
+			result['pending'] = max(result['pending'], pending(server))
+		got = 0
+		response = httpx.HTTPX(response=True)
+		while not response.complete:
+			data = c.recv(BUF_SIZE)
+			if not data:
+				break
+			got += response.feed(data)
+		result['got'] = got
+		c.close()
+
+		c = socket.create_connection(proxy)
+		c.settimeout(0.5)
+		try:
+			c.sendall(b'POST / HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n\r\n' %
+					(sink_host, size) + b'x' * size)
+		except socket.timeout:
+			pass
+		result['upload_pending'] = pending(server)
+		c.close()
+		result['done'] = True
+
+	for edge_triggered in (False, True):
+		result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), slow,
+							edge_triggered=edge_triggered)
+		assert result['got'] > size, result
+		assert HIGH_WATER <= result['pending'] <= HIGH_WATER + BUF_SIZE, result
+		assert HIGH_WATER <= result['upload_pending'] <= HIGH_WATER + BUF_SIZE, result
+	sink.close()
+
+	# spilling: the origin is read to the end while the client is not
+	# reading, its connection goes back to the pool and the client is sent
+	# the rest from the temp file. past spill_max it waits as above
+	def in_memory(server):
+		most = 0
+		for handler in list(server._fd_to_handlers.values()):
+			most = max(most, sum(len(item) for item in handler._data_to_write_to_local._items or ()
+								if not isinstance(item, cache.FileRegion)))
+		return most
+
+	def spilled(proxy, result):
+		server = result['server']
+		c = socket.create_connection(proxy)
+		c.sendall(b'GET / HTTP/1.1\r\nHost: %s\r\n\r\n' % host)
+		result['memory'] = 0
+		for i in range(100):
+			time.sleep(0.01)
+			result['memory'] = max(result['memory'], in_memory(server))
+			if len(server.pool):
+				break
+		result['pooled'] = len(server.pool)
+		response = httpx.HTTPX(response=True)
+		data = []
+		while not response.complete:
+			chunk = c.recv(BUF_SIZE)
+			if not chunk:
+				break
+			response.feed(chunk)
+			data.append(chunk)
+		result['body'] = b''.join(data).split(b'\r\n\r\n', 1)[1]
+		c.close()
+		result['done'] = True
+
+	for edge_triggered, spill_max in ((False, size), (True, size), (False, size // 4)):
+		result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), spilled,
+							edge_triggered=edge_triggered, spill_threshold=LOW_WATER,
+							spill_max=spill_max)
+		body = result.pop('body')
+		assert body == b'x' * size, (len(body), result)
+		stats = result['stats']
+		assert stats['spills'] == 1, stats
+		if spill_max == size:
+			assert result['pooled'] == 1 and result['memory'] <= LOW_WATER + BUF_SIZE, result
+			# less what the socket buffers took
+			assert stats['spilled_bytes'] > size // 2, stats
+		else:
+			assert result['pooled'] == 0 and stats['spilled_bytes'] <= spill_max, result
+
+	# a disk cache hit behind a spilled response, the client still behind:
+	# its body is a region of the cache file, queued as it is
+	static, static_counts = _origin(b'cached', headers=b'Cache-Control: max-age=60\r\n')
+	static_host = b'127.0.0.1:%d' % static.getsockname()[1]
+
+	def read_responses(c, count):
+		# the bodies, a read may end one response and start the next
+		bodies = []
+		response = httpx.HTTPX(response=True)
+		data = []
+		while len(bodies) < count:
+			chunk = c.recv(BUF_SIZE)
+			if not chunk:
+				break
+			pos = 0
+			while pos < len(chunk):
+				n = response.feed(chunk[pos:])
+				data.append(chunk[pos:pos + n])
+				pos += n
+				if response.complete:
+					bodies.append(b''.join(data).split(b'\r\n\r\n', 1)[1])
+					data = []
+					response.reset()
+		return bodies
+
+	def fill(proxy, result):
+		c = socket.create_connection(proxy)
+		c.sendall(b'GET / HTTP/1.1\r\nHost: %s\r\n\r\n' % static_host)
+		result['bodies'] = read_responses(c, 1)
+		c.close()
+		result['done'] = True
+
+	def spilled_hit(proxy, result):
+		server = result['server']
+		c = socket.create_connection(proxy)
+		c.sendall(b'GET / HTTP/1.1\r\nHost: %s\r\n\r\n' % host)
+		for i in range(100):
+			time.sleep(0.01)
+			if len(server.pool):
+				break
+		c.sendall(b'GET / HTTP/1.1\r\nHost: %s\r\n\r\n' % static_host)
+		time.sleep(0.05)
+		result['bodies'] = read_responses(c, 2)
+		c.close()
+		result['done'] = True
+
+	import tempfile
+	import shutil
+	path = tempfile.mkdtemp()
+	try:
+		result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), fill,
+							cache_size=1024 * 1024, cache_dir=path)
+		assert result['bodies'] == [b'cached'], result
+		result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), spilled_hit,
+							cache_size=1024 * 1024, cache_dir=path, spill_threshold=LOW_WATER)
+		bodies = result.pop('bodies')
+		assert bodies == [b'x' * size, b'cached'], [len(body) for body in bodies]
+		stats = result['stats']
+		assert stats['spills'] == 1 and stats['cache_disk_hits'] == 1, stats
+		assert static_counts['requests'] == 1, static_counts
+	finally:
+		shutil.rmtree(path)
+	static.close()
+	origin.close()
+
+	# fast open: the GET may go in the SYN, the POST never does. either way
+	# the origins get each request once
+	(a, a_counts), (b, b_counts) = _origin(b'a'), _origin(b'b')
+	hosts = [b'127.0.0.1:%d' % origin.getsockname()[1] for origin in (a, b)]
+
+	def fast_open(proxy, result):
+		c = socket.create_connection(proxy)
+		c.settimeout(5)
+		result['responses'] = []
+		for method, host in ((b'GET', hosts[0]), (b'POST', hosts[1])):
+			c.sendall(b'%s http://%s/ HTTP/1.1\r\nHost: %s\r\nContent-Length: 0\r\n\r\n'
+					% (method, host, host))
+			response = httpx.HTTPX(response=True)
+			data = b''
+			while not response.complete:
+				chunk = c.recv(4096)
+				if not chunk:
+					break
+				response.feed(chunk)
+				data += chunk
+			result['responses'].append(data[-1:])
+		c.close()
+		result['done'] = True
+
+	result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), fast_open, fast_open=True)
+	assert result['responses'] == [b'a', b'b'], result
+	assert a_counts['requests'] == 1 and b_counts['requests'] == 1, (a_counts, b_counts)
+	if connector._fast_open:
+		assert result['stats']['fast_open_connects'] == 1, result['stats']
+	for origin in (a, b):
+		origin.close()
+
+	# an upload refused before its body is all in: the rest of the body
+	# goes nowhere once the origin is gone, the client connection ends
+	import threading
+
+	refusing = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	refusing.bind(('127.0.0.1', 0))
+	refusing.listen(5)
+	refusing_host = b'127.0.0.1:%d' % refusing.getsockname()[1]
+
+	def refuse():
+		conn = refusing.accept()[0]
+		data = b''
+		while b'\r\n\r\n' not in data:
+			data += conn.recv(4096)
+		conn.sendall(b'HTTP/1.1 413 Payload Too Large\r\nConnection: close\r\n'
+					b'Content-Length: 0\r\n\r\n')
+		conn.close()
+
+	t = threading.Thread(target=refuse)
+	t.daemon = True
+	t.start()
+
+	def upload(proxy, result):
+		c = socket.create_connection(proxy)
+		c.settimeout(5)
+		c.sendall(b'POST / HTTP/1.1\r\nHost: %s\r\nContent-Length: 100000\r\n\r\n'
+				% refusing_host + b'x' * 1000)
+		data = b''
+		while b'\r\n\r\n' not in data:
+			data += c.recv(4096)
+		# the origin closed meanwhile
+		time.sleep(0.1)
+		result['closed'] = False
+		try:
+			c.sendall(b'x' * 1000)
+			while True:
+				chunk = c.recv(4096)
+				if not chunk:
+					break
+				data += chunk
+			result['closed'] = True
+		except socket.timeout:
+			pass
+		except (OSError, IOError):
+			# reset, the relay did not read what was sent last
+			result['closed'] = True
+		result['response'] = data
+		c.close()
+		result['done'] = True
 
+	result = _run_relay(asyncdns.DNSResolver(['127.0.0.1']), upload)
+	assert result['response'].startswith(b'HTTP/1.1 413 ') and result['closed'], result
+	refusing.close()
 
 
+if __name__ == '__main__':
+	test()
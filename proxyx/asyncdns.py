@@ -36,6 +36,14 @@ from proxyx import common, lru_cache, eventloop
 
 CACHE_SWEEP_INTERVAL = 30
 
+# rfc8305 3: once one of the A and AAAA replies is in, wait this long for
+# the other one. a lost reply then costs this much, not the idle timeout
+RESOLUTION_DELAY = 0.05
+# with no reply at all the queries are sent again after this many seconds,
+# up to RESOLVE_TRIES times in all, then the lookup fails
+RESOLVE_RETRY = 2
+RESOLVE_TRIES = 3
+
 VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d-]{1,63}(?<!-)$", re.IGNORECASE)
 
 common.patch_socket()
@@ -266,9 +274,27 @@ STATUS_IPV4 = 0
 STATUS_IPV6 = 1
 
 
-class DNSResolver(object):
+def interleave_addresses(ipv6, ipv4):
+    # rfc8305 section 4: alternate families, starting with IPv6
+    result = []
+    for i in range(max(len(ipv6), len(ipv4))):
+        result.extend(ipv6[i:i + 1])
+        result.extend(ipv4[i:i + 1])
+    return result
+
 
+class AllRequest(object):
+    # a pending resolve_all, A and AAAA are queried at the same time
     def __init__(self):
+        self.callbacks = []
+        self.answers = {}  # qtype -> [ip, ...]
+        self.timer = None
+        self.tries = 1
+
+
+class DNSResolver(object):
+
+    def __init__(self, server_list=None, port=53):
         self._loop = None
         self._request_id = 1
         self._hosts = {}
@@ -276,18 +302,23 @@ class DNSResolver(object):
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
         self._cache = lru_cache.LRUCache(timeout=300)
-        self._last_time = time.time()
+        self._all_pending = {}  # hostname -> AllRequest
+        self._all_cb_to_hostname = {}
+        self._all_cache = lru_cache.LRUCache(timeout=300)
+        self._sweep_timer = None
         self._sock = None
         self._servers = None
-        self._parse_resolv()
+        self._port = port
+        if server_list:
+            self._servers = list(server_list)
+        else:
+            self._parse_resolv()
         self._parse_hosts()
         # TODO monitor hosts change and reload hosts
         # TODO parse /etc/gai.conf and follow its rules
 
     def _parse_resolv(self):
-        self._servers = ['192.168.0.1']
-        return 
-        
+        self._servers = []
         try:
             with open('/etc/resolv.conf', 'rb') as f:
                 content = f.readlines()
@@ -326,7 +357,7 @@ class DNSResolver(object):
         except IOError:
             self._hosts['localhost'] = '127.0.0.1'
 
-    def add_to_loop(self, loop, ref=False):
+    def add_to_loop(self, loop):
         if self._loop:
             raise Exception('already add to loop')
         self._loop = loop
@@ -334,8 +365,9 @@ class DNSResolver(object):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
                                    socket.SOL_UDP)
         self._sock.setblocking(False)
-        loop.add(self._sock, eventloop.POLL_IN)
-        loop.add_handler(self.handle_events, ref=ref)
+        loop.add(self._sock, eventloop.POLL_IN, self.handle_event)
+        self._sweep_timer = loop.call_later(CACHE_SWEEP_INTERVAL,
+                                            self._handle_periodic)
 
     def _call_callback(self, hostname, ip, error=None):
         callbacks = self._hostname_to_cb.get(hostname, [])
@@ -352,8 +384,68 @@ class DNSResolver(object):
         if hostname in self._hostname_status:
             del self._hostname_status[hostname]
 
+    def _handle_all_data(self, response):
+        hostname = response.hostname
+        req = self._all_pending[hostname]
+        qtype = response.questions[0][1]
+        if qtype not in (QTYPE_A, QTYPE_AAAA) or qtype in req.answers:
+            return
+        req.answers[qtype] = [answer[0] for answer in response.answers
+                              if answer[1] == qtype and
+                              answer[2] == QCLASS_IN]
+        if req.timer:
+            req.timer.cancel()
+            req.timer = None
+        if len(req.answers) == 2:
+            self._call_all_callbacks(hostname)
+        else:
+            # the other reply may be lost, whatever is in by then is used
+            req.timer = self._loop.call_later(RESOLUTION_DELAY,
+                                              self._call_all_callbacks,
+                                              hostname)
+
+    def _retry_all(self, hostname):
+        # no reply yet, both queries are sent again
+        req = self._all_pending.get(hostname)
+        if req is None:
+            return
+        req.timer = None
+        if req.tries >= RESOLVE_TRIES:
+            self._call_all_callbacks(hostname)
+            return
+        req.tries += 1
+        self._send_all_req(hostname, req)
+
+    def _send_all_req(self, hostname, req):
+        self._send_req(hostname, QTYPE_AAAA)
+        self._send_req(hostname, QTYPE_A)
+        req.timer = self._loop.call_later(RESOLVE_RETRY, self._retry_all,
+                                          hostname)
+
+    def _call_all_callbacks(self, hostname):
+        req = self._all_pending.pop(hostname, None)
+        if req is None:
+            return
+        if req.timer:
+            req.timer.cancel()
+        ips = interleave_addresses(req.answers.get(QTYPE_AAAA, []),
+                                   req.answers.get(QTYPE_A, []))
+        if ips and len(req.answers) == 2:
+            # not the ones of a single family, the other reply was lost
+            self._all_cache[hostname] = ips
+        for callback in req.callbacks:
+            self._all_cb_to_hostname.pop(callback, None)
+            if ips:
+                callback((hostname, ips), None)
+            else:
+                callback((hostname, None),
+                         Exception('unknown hostname %s' % hostname))
+
     def _handle_data(self, data):
         response = parse_response(data)
+        if response and response.hostname in self._all_pending and \
+                response.questions:
+            self._handle_all_data(response)
         if response and response.hostname:
             hostname = response.hostname
             ip = None
@@ -376,30 +468,28 @@ class DNSResolver(object):
                             self._call_callback(hostname, None)
                             break
 
-    def handle_events(self, events):
-        for sock, fd, event in events:
-            if sock != self._sock:
-                continue
-            if event & eventloop.POLL_ERR:
-                logging.error('dns socket err')
-                self._loop.remove(self._sock)
-                self._sock.close()
-                # TODO when dns server is IPv6
-                self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                           socket.SOL_UDP)
-                self._sock.setblocking(False)
-                self._loop.add(self._sock, eventloop.POLL_IN)
-            else:
-                data, addr = sock.recvfrom(1024)
-                if addr[0] not in self._servers:
-                    logging.warn('received a packet other than our dns')
-                    break
-                self._handle_data(data)
-            break
-        now = time.time()
-        if now - self._last_time > CACHE_SWEEP_INTERVAL:
-            self._cache.sweep()
-            self._last_time = now
+    def handle_event(self, sock, fd, event):
+        if event & eventloop.POLL_ERR:
+            logging.error('dns socket err')
+            self._loop.remove(self._sock)
+            self._sock.close()
+            # TODO when dns server is IPv6
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                       socket.SOL_UDP)
+            self._sock.setblocking(False)
+            self._loop.add(self._sock, eventloop.POLL_IN, self.handle_event)
+        else:
+            data, addr = sock.recvfrom(1024)
+            if addr[0] not in self._servers:
+                logging.warn('received a packet other than our dns')
+                return
+            self._handle_data(data)
+
+    def _handle_periodic(self):
+        self._cache.sweep()
+        self._all_cache.sweep()
+        self._sweep_timer = self._loop.call_later(CACHE_SWEEP_INTERVAL,
+                                                  self._handle_periodic)
 
     def remove_callback(self, callback):
         hostname = self._cb_to_hostname.get(callback)
@@ -412,6 +502,14 @@ class DNSResolver(object):
                     del self._hostname_to_cb[hostname]
                     if hostname in self._hostname_status:
                         del self._hostname_status[hostname]
+        hostname = self._all_cb_to_hostname.pop(callback, None)
+        if hostname:
+            req = self._all_pending[hostname]
+            req.callbacks.remove(callback)
+            if not req.callbacks:
+                if req.timer:
+                    req.timer.cancel()
+                del self._all_pending[hostname]
 
     def _send_req(self, hostname, qtype):
         self._request_id += 1
@@ -421,7 +519,7 @@ class DNSResolver(object):
         for server in self._servers:
             logging.debug('resolving %s with type %d using server %s',
                           hostname, qtype, server)
-            self._sock.sendto(req, (server, 53))
+            self._sock.sendto(req, (server, self._port))
 
     def resolve(self, hostname, callback):
         if type(hostname) != bytes:
@@ -450,19 +548,118 @@ class DNSResolver(object):
                 self._cb_to_hostname[callback] = hostname
             else:
                 arr.append(callback)
+                self._cb_to_hostname[callback] = hostname
                 # TODO send again only if waited too long
                 self._send_req(hostname, QTYPE_A)
 
+    def resolve_all(self, hostname, callback):
+        # like resolve, but calls back with (hostname, [ip, ...]) holding
+        # both the A and AAAA records, ordered for connection racing
+        if type(hostname) != bytes:
+            hostname = hostname.encode('utf8')
+        if not hostname:
+            callback(None, Exception('empty hostname'))
+        elif is_ip(hostname):
+            callback((hostname, [hostname]), None)
+        elif hostname in self._hosts:
+            logging.debug('hit hosts: %s', hostname)
+            callback((hostname, [self._hosts[hostname]]), None)
+        elif hostname in self._all_cache:
+            logging.debug('hit cache: %s', hostname)
+            callback((hostname, self._all_cache[hostname]), None)
+        else:
+            if not is_valid_hostname(hostname):
+                callback(None, Exception('invalid hostname: %s' % hostname))
+                return
+            req = self._all_pending.get(hostname, None)
+            if not req:
+                req = self._all_pending[hostname] = AllRequest()
+                self._send_all_req(hostname, req)
+            req.callbacks.append(callback)
+            self._all_cb_to_hostname[callback] = hostname
+
     def close(self):
+        for req in self._all_pending.values():
+            if req.timer:
+                req.timer.cancel()
+        if self._sweep_timer:
+            self._sweep_timer.cancel()
+            self._sweep_timer = None
         if self._sock:
             self._sock.close()
             self._sock = None
 
 
+def test_resolve_all():
+    # A and AAAA both go in the result, one lost reply costs
+    # RESOLUTION_DELAY and leaves nothing cached, no reply at all is asked
+    # for again RESOLVE_TRIES times in all before failing
+    global RESOLVE_RETRY
+    retry, RESOLVE_RETRY = RESOLVE_RETRY, RESOLUTION_DELAY * 2
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    dns_resolver = DNSResolver(['127.0.0.1'], server.getsockname()[1])
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+
+    def response(hostname, qtype, ips):
+        r = DNSResponse()
+        r.hostname = hostname
+        r.questions = [(hostname, qtype, QCLASS_IN)]
+        r.answers = [(ip, qtype, QCLASS_IN) for ip in ips]
+        return r
+
+    results = {}
+    for hostname, replies in ((b'dual.test', [(QTYPE_AAAA, ['::1']),
+                                              (QTYPE_A, ['127.0.0.1'])]),
+                              (b'v6.test', [(QTYPE_AAAA, ['::1'])]),
+                              (b'v4.test', [(QTYPE_A, ['127.0.0.1'])]),
+                              (b'empty-a.test', [(QTYPE_A, [])]),
+                              (b'empty-aaaa.test', [(QTYPE_AAAA, [])]),
+                              (b'lost.test', [])):
+        def callback(result, error, hostname=hostname, started=loop.time()):
+            results[hostname] = (result and result[1], error is not None,
+                                 loop.time() - started)
+        dns_resolver.resolve_all(hostname, callback)
+        for qtype, ips in replies:
+            dns_resolver._handle_all_data(response(hostname, qtype, ips))
+    loop.call_later(RESOLVE_RETRY * (RESOLVE_TRIES + 1), loop.stop)
+    loop.run()
+    queries = 0
+    server.setblocking(False)
+    try:
+        while server.recv(1024):
+            queries += 1
+    except (OSError, IOError):
+        pass
+    dns_resolver.close()
+    server.close()
+    assert results[b'dual.test'][:2] == (['::1', '127.0.0.1'], False), \
+        results
+    assert results[b'v6.test'][:2] == (['::1'], False), results
+    assert results[b'v4.test'][:2] == (['127.0.0.1'], False), results
+    for hostname in (b'empty-a.test', b'empty-aaaa.test', b'lost.test'):
+        assert results[hostname][:2] == (None, True), results
+    for hostname in (b'v6.test', b'v4.test', b'empty-a.test',
+                     b'empty-aaaa.test'):
+        # timers go off up to a clock tick early
+        assert results[hostname][2] >= RESOLUTION_DELAY / 2, results
+        assert results[hostname][2] < RESOLVE_RETRY, results
+    assert results[b'lost.test'][2] >= RESOLVE_RETRY * (RESOLVE_TRIES - 0.5)
+    # two queries for each host, and again for the lost one
+    assert queries == 2 * 6 + 2 * (RESOLVE_TRIES - 1), queries
+    assert sorted(dns_resolver._all_cache) == [b'dual.test'], \
+        sorted(dns_resolver._all_cache)
+    assert not dns_resolver._all_pending
+    RESOLVE_RETRY = retry
+
+
 def test():
+    test_resolve_all()
+
     dns_resolver = DNSResolver()
     loop = eventloop.EventLoop()
-    dns_resolver.add_to_loop(loop, ref=True)
+    dns_resolver.add_to_loop(loop)
 
     global counter
     counter = 0
@@ -476,7 +673,7 @@ def test():
             print(result, error)
             counter += 1
             if counter == 9:
-                loop.remove_handler(dns_resolver.handle_events)
+                loop.stop()
                 dns_resolver.close()
         a_callback = callback
         return a_callback
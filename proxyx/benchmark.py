@@ -0,0 +1,794 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# benchmarks for proxyx, run one with
+#
+#	python proxyx/benchmark.py <name> [args...]
+#
+# end-to-end benchmarks fork an origin server and a proxy process on
+# 127.0.0.1 and drive them from this process
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import sys
+import os
+import time
+import json
+import socket
+import signal
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+from proxyx import utils, eventloop, asyncdns, tcprelay, server, timingwheel, \
+	writequeue
+from modules import prepull
+
+MB = 1024 * 1024
+
+
+def _config(port):
+	config = utils.get_config()
+	config['server_address'] = '127.0.0.1'
+	config['server_port'] = port
+	return config
+
+
+def _free_port():
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+
+def _recv_header(sock):
+	data = b''
+	while data.find(b'\r\n\r\n') == -1:
+		chunk = sock.recv(4096)
+		if not chunk:
+			return None
+		data += chunk
+	return data
+
+
+def start_origin(size):
+	"""fork an origin answering every request with size bytes, keep-alive:
+	requests are served on a connection until the peer closes it"""
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(128)
+	port = listener.getsockname()[1]
+	pid = os.fork()
+	if pid:
+		listener.close()
+		return pid, port
+	block = b'x' * MB
+	header = b'HTTP/1.1 200 OK\r\nContent-Length: ' + str(size).encode() + b'\r\n\r\n'
+
+	def serve(conn):
+		# the head and the body go out in separate writes, without this
+		# the body waits for a delayed ack on reused connections
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		try:
+			while _recv_header(conn) is not None:
+				conn.sendall(header)
+				left = size
+				while left > 0:
+					n = min(left, len(block))
+					conn.sendall(block[:n])
+					left -= n
+		except (OSError, IOError):
+			pass
+		finally:
+			conn.close()
+
+	while True:
+		conn, _ = listener.accept()
+		t = threading.Thread(target=serve, args=(conn,))
+		t.daemon = True
+		t.start()
+
+
+def start_sink():
+	"""fork an origin that accepts connections and never answers, a request
+	sent to it stays in flight"""
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(1024)
+	port = listener.getsockname()[1]
+	pid = os.fork()
+	if pid:
+		listener.close()
+		return pid, port
+	conns = []
+	while True:
+		conns.append(listener.accept()[0])
+
+
+class CountingImpl(object):
+	"""wraps an EventLoop backend and counts the syscalls going through it"""
+
+	def __init__(self, impl, counts):
+		self._impl = impl
+		self._counts = counts
+
+	def poll(self, timeout):
+		self._counts['epoll_wait'] += 1
+		return self._impl.poll(timeout)
+
+	def add_fd(self, fd, mode):
+		self._counts['epoll_ctl'] += 1
+		self._impl.add_fd(fd, mode)
+
+	def remove_fd(self, fd):
+		self._counts['epoll_ctl'] += 1
+		self._impl.remove_fd(fd)
+
+	def modify_fd(self, fd, mode):
+		self._counts['epoll_ctl'] += 1
+		self._impl.modify_fd(fd, mode)
+
+
+class CountingSocket(object):
+	"""socket proxy counting recv/send calls"""
+
+	def __init__(self, sock, counts):
+		self._sock = sock
+		self._counts = counts
+
+	def recv(self, *args):
+		self._counts['recv'] += 1
+		return self._sock.recv(*args)
+
+	def recv_into(self, *args):
+		self._counts['recv'] += 1
+		return self._sock.recv_into(*args)
+
+	def send(self, *args):
+		self._counts['send'] += 1
+		return self._sock.send(*args)
+
+	def sendmsg(self, *args):
+		self._counts['send'] += 1
+		return self._sock.sendmsg(*args)
+
+	def accept(self):
+		self._counts['accept'] += 1
+		conn, addr = self._sock.accept()
+		now = time.time()
+		self._counts['first_accept'] = self._counts['first_accept'] or now
+		self._counts['last_accept'] = now
+		return CountingSocket(conn, self._counts), addr
+
+	def __getattr__(self, name):
+		return getattr(self._sock, name)
+
+
+def _new_counts():
+	return dict.fromkeys(['epoll_wait', 'epoll_ctl', 'recv', 'send', 'accept',
+		'first_accept', 'last_accept'], 0)
+
+
+def start_proxy(config, loop_args=None, instrument=True, setup=None, servers=None,
+		trace=False):
+	"""fork a proxy process, servers is an optional prebuilt (dns_resolver,
+	tcp_relay); returns (pid, read end of the pipe the child writes its
+	counters and the relay's stats to as json after SIGTERM). with trace
+	the peak of the memory tracemalloc saw is in the counters too"""
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid:
+		os.close(w)
+		return pid, r
+	os.close(r)
+	counts = _new_counts()
+	loop = eventloop.EventLoop(**(loop_args or {}))
+	if servers:
+		dns_resolver, relay = servers
+	else:
+		dns_resolver = asyncdns.DNSResolver()
+		relay = tcprelay.TCPRelay(config, dns_resolver, False)
+	if instrument:
+		loop._impl = CountingImpl(loop._impl, counts)
+		relay._server_socket = CountingSocket(relay._server_socket, counts)
+		attach_remote = prepull.Exchange._attach_remote
+
+		def _attach_remote(exchange, sock):
+			# pooled sockets are already wrapped
+			if not isinstance(sock, CountingSocket):
+				sock = CountingSocket(sock, counts)
+			attach_remote(exchange, sock)
+		prepull.Exchange._attach_remote = _attach_remote
+	if setup:
+		setup(loop, relay, counts)
+	signal.signal(signal.SIGTERM, lambda signum, frame: loop.stop())
+	dns_resolver.add_to_loop(loop)
+	relay.add_to_loop(loop)
+	tracemalloc = None
+	if trace:
+		try:
+			import tracemalloc
+			tracemalloc.start()
+		except ImportError:
+			pass
+	start = os.times()
+	loop.run()
+	end = os.times()
+	if tracemalloc:
+		counts['traced_peak'] = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	counts['cpu'] = (end[0] - start[0]) + (end[1] - start[1])
+	counts['stats'] = relay.stats
+	os.write(w, json.dumps(counts).encode())
+	os._exit(0)
+
+
+def stop_proxy(pid, r):
+	os.kill(pid, signal.SIGTERM)
+	data = b''
+	while True:
+		chunk = os.read(r, 65536)
+		if not chunk:
+			break
+		data += chunk
+	os.waitpid(pid, 0)
+	os.close(r)
+	return json.loads(data.decode())
+
+
+def fetch(proxy_port, origin_port, size):
+	sock = socket.create_connection(('127.0.0.1', proxy_port))
+	sock.sendall(b'GET / HTTP/1.1\r\nHost: 127.0.0.1:' + str(origin_port).encode() +
+				b'\r\n\r\n')
+	header = _recv_header(sock)
+	got = len(header) - header.find(b'\r\n\r\n') - 4
+	while got < size:
+		chunk = sock.recv(MB)
+		if not chunk:
+			break
+		got += len(chunk)
+	sock.close()
+	return got
+
+
+def bench_epoll(size_mb=32, rounds=4):
+	"""level vs edge triggered epoll: syscalls per MB and throughput"""
+	size = int(size_mb) * MB
+	rounds = int(rounds)
+	origin_pid, origin_port = start_origin(size)
+	try:
+		for name, edge in (('level', False), ('edge', True)):
+			port = _free_port()
+			pid, r = start_proxy(_config(port), {'edge_triggered': edge})
+			time.sleep(0.2)
+			total = 0
+			start = time.time()
+			for i in range(rounds):
+				total += fetch(port, origin_port, size)
+			elapsed = time.time() - start
+			counts = stop_proxy(pid, r)
+			mb = total / MB
+			print('%-6s %8.1f MB/s  epoll_wait/MB %7.1f  epoll_ctl/MB %7.1f  '
+				'recv/MB %6.1f  send/MB %6.1f  syscalls/MB %7.1f' % (
+					name, mb / elapsed, counts['epoll_wait'] / mb,
+					counts['epoll_ctl'] / mb, counts['recv'] / mb,
+					counts['send'] / mb,
+					(counts['epoll_wait'] + counts['epoll_ctl'] +
+						counts['recv'] + counts['send']) / mb))
+	finally:
+		os.kill(origin_pid, signal.SIGKILL)
+		os.waitpid(origin_pid, 0)
+
+
+def _fetch_all(port, origin_port, size, concurrency, requests):
+	"""requests fetches by concurrency clients, returns (elapsed, sum of
+	their latencies)"""
+	left = [requests]
+	latency = [0.0]
+	lock = threading.Lock()
+
+	def client():
+		while True:
+			with lock:
+				if left[0] <= 0:
+					return
+				left[0] -= 1
+			t = time.time()
+			fetch(port, origin_port, size)
+			t = time.time() - t
+			with lock:
+				latency[0] += t
+
+	start = time.time()
+	threads = [threading.Thread(target=client) for i in range(concurrency)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return time.time() - start, latency[0]
+
+
+def bench_requests(concurrency=50, requests=2000, size=4096):
+	"""many small requests from concurrent clients, without and with the
+	upstream pool: requests/s, latency, poller syscalls and upstream
+	connects per request"""
+	concurrency, requests, size = int(concurrency), int(requests), int(size)
+	origin_pid, origin_port = start_origin(size)
+	try:
+		for name, max_idle in (('no pool', 0), ('pool', utils.get_config()['pool_max_idle'])):
+			config = _config(_free_port())
+			config['pool_max_idle'] = max_idle
+			port = config['server_port']
+			pid, r = start_proxy(config)
+			time.sleep(0.2)
+			elapsed, latency = _fetch_all(port, origin_port, size, concurrency, requests)
+			counts = stop_proxy(pid, r)
+			print('%-7s %d requests, concurrency %d: %.0f req/s  latency %.2fms  '
+				'epoll_wait/req %.2f  epoll_ctl/req %.2f  cpu/req %.1fus  '
+				'upstream connects/req %.2f' % (
+					name, requests, concurrency, requests / elapsed,
+					latency / requests * 1e3,
+					counts['epoll_wait'] / requests, counts['epoll_ctl'] / requests,
+					counts['cpu'] / requests * 1e6,
+					counts['stats']['pool_misses'] / requests))
+	finally:
+		os.kill(origin_pid, signal.SIGKILL)
+		os.waitpid(origin_pid, 0)
+
+
+def _time_gc(loop, relay, counts):
+	# pauses of the cyclic collector, where gc.callbacks is there (3.3+)
+	import gc
+	counts['gc_collections'] = 0
+	counts['gc_time'] = 0.0
+	counts['gc_max'] = 0.0
+	if not hasattr(gc, 'callbacks'):
+		counts['gc_collections'] = None
+		return
+	started = [0]
+
+	def callback(phase, info):
+		if phase == 'start':
+			started[0] = time.time()
+			return
+		t = time.time() - started[0]
+		counts['gc_collections'] += 1
+		counts['gc_time'] += t
+		counts['gc_max'] = max(counts['gc_max'], t)
+	gc.callbacks.append(callback)
+
+
+def bench_recycle(concurrency=50, connections=20000, size=128):
+	"""short connections, one small request each: connections/s and the
+	pauses of the garbage collector, without and with destroyed handlers
+	and parsers recycled"""
+	concurrency, connections, size = int(concurrency), int(connections), int(size)
+	origin_pid, origin_port = start_origin(size)
+	try:
+		for name, free_max in (('no reuse', 0),
+				('reuse', utils.get_config()['free_list_max'])):
+			config = _config(_free_port())
+			config['free_list_max'] = free_max
+			pid, r = start_proxy(config, setup=_time_gc)
+			time.sleep(0.2)
+			elapsed, latency = _fetch_all(config['server_port'], origin_port, size,
+										concurrency, connections)
+			counts = stop_proxy(pid, r)
+			stats = counts['stats']
+			if counts['gc_collections'] is None:
+				gc = 'gc n/a (no gc.callbacks)'
+			else:
+				gc = 'gc %d collections, %.1fms total, max %.2fms' % (
+					counts['gc_collections'], counts['gc_time'] * 1e3,
+					counts['gc_max'] * 1e3)
+			print('%-8s %d connections, concurrency %d: %6.0f conn/s  cpu/conn %.1fus  '
+				'handlers reused %d  %s' % (
+					name, connections, concurrency, connections / elapsed,
+					counts['cpu'] / connections * 1e6, stats['handler_free_hits'], gc))
+	finally:
+		os.kill(origin_pid, signal.SIGKILL)
+		os.waitpid(origin_pid, 0)
+
+
+def bench_cpus(connections=2000, workers=0, concurrency=20):
+	"""one pinned worker per cpu behind SO_REUSEPORT: how connections
+	spread over the workers and how many were received on another cpu"""
+	connections, concurrency = int(connections), int(concurrency)
+	cpus = utils.get_cpus()
+	workers = int(workers) or len(cpus)
+	origin_pid, origin_port = start_origin(1024)
+	port = _free_port()
+	config = _config(port)
+	config['workers'] = workers
+	config['reuse_port'] = True
+	servers = server.make_servers(config, workers)
+	server.steer_servers(servers, cpus)
+	procs = []
+	for i in range(workers):
+		cpu = cpus[i % len(cpus)]
+		procs.append(start_proxy(config, instrument=False, servers=servers[i],
+			setup=lambda loop, relay, counts, cpu=cpu: utils.set_cpu_affinity(cpu)))
+	for _, relay in servers:
+		relay.close()
+	time.sleep(0.2)
+	left = [connections]
+	lock = threading.Lock()
+
+	def client():
+		while True:
+			with lock:
+				if left[0] <= 0:
+					return
+				left[0] -= 1
+			fetch(port, origin_port, 1024)
+
+	try:
+		threads = [threading.Thread(target=client) for i in range(concurrency)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		total = 0
+		migrated = 0
+		for i, (pid, r) in enumerate(procs):
+			stats = stop_proxy(pid, r)['stats']
+			total += stats['accepted']
+			migrated += stats['migrated']
+			print('worker %d cpu %d: %5d connections (%5.1f%%)  %5d migrated' % (
+				i, cpus[i % len(cpus)], stats['accepted'],
+				stats['accepted'] * 100.0 / connections, stats['migrated']))
+		print('total %d connections, %d (%.1f%%) handled on another cpu' % (
+			total, migrated, migrated * 100.0 / max(total, 1)))
+	finally:
+		os.kill(origin_pid, signal.SIGKILL)
+		os.waitpid(origin_pid, 0)
+
+
+def bench_throttled(size_mb=256, rate_mb=200, rcvbuf_kb=64):
+	"""one big response relayed to a client reading at rate_mb MB/s through
+	a small receive buffer, so that the proxy queues most of it and sends
+	in many short writes: cpu and send calls per GB, with and without
+	sendmsg"""
+	size = int(size_mb) * MB
+	rate = float(rate_mb) * MB
+	rcvbuf = int(rcvbuf_kb) * 1024
+	origin_pid, origin_port = start_origin(size)
+	modes = [('send', False)]
+	if writequeue._sendmsg:
+		modes.append(('sendmsg', True))
+	try:
+		for name, sendmsg in modes:
+			port = _free_port()
+			pid, r = start_proxy(_config(port), setup=lambda loop, relay, counts,
+				sendmsg=sendmsg: setattr(writequeue, '_sendmsg', sendmsg))
+			time.sleep(0.2)
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+			sock.connect(('127.0.0.1', port))
+			sock.sendall(b'GET / HTTP/1.1\r\nHost: 127.0.0.1:' +
+						str(origin_port).encode() + b'\r\n\r\n')
+			header = _recv_header(sock)
+			got = len(header) - header.find(b'\r\n\r\n') - 4
+			start = time.time()
+			while got < size:
+				chunk = sock.recv(rcvbuf)
+				if not chunk:
+					break
+				got += len(chunk)
+				# ahead of the rate, wait for it
+				ahead = got / rate - (time.time() - start)
+				if ahead > 0:
+					time.sleep(ahead)
+			elapsed = time.time() - start
+			sock.close()
+			counts = stop_proxy(pid, r)
+			gb = got / (1024 * MB)
+			print('%-8s %d MB at %.0f MB/s (%.0f MB/s): cpu/GB %.2fs  send/GB %.0f  '
+				'recv/GB %.0f' % (
+					name, got // MB, rate / MB, got / MB / elapsed,
+					counts['cpu'] / gb, counts['send'] / gb, counts['recv'] / gb))
+	finally:
+		os.kill(origin_pid, signal.SIGKILL)
+		os.waitpid(origin_pid, 0)
+
+
+def bench_buffers(concurrency=50, requests=500, size=1024 * 1024):
+	"""read buffers leased from the pool versus one allocated per read
+	(a pool keeping none): allocations and cpu per relayed MB, and the
+	peak of the memory tracemalloc saw in the proxy"""
+	concurrency, requests, size = int(concurrency), int(requests), int(size)
+	origin_pid, origin_port = start_origin(size)
+	try:
+		for name, max_free in (('no pool', 0),
+				('pool', utils.get_config()['buffer_pool_max'])):
+			config = _config(_free_port())
+			config['buffer_pool_max'] = max_free
+			pid, r = start_proxy(config, trace=True)
+			time.sleep(0.2)
+			elapsed, latency = _fetch_all(config['server_port'], origin_port, size,
+										concurrency, requests)
+			counts = stop_proxy(pid, r)
+			stats = counts['stats']
+			mb = requests * size / MB
+			peak = counts.get('traced_peak')
+			print('%-7s %.0f MB, concurrency %d: %6.0f MB/s  buffer allocations/MB %7.2f  '
+				'pool hits/MB %6.1f  cpu/MB %.2fms  traced peak %s' % (
+					name, mb, concurrency, mb / elapsed,
+					stats['buffer_pool_misses'] / mb, stats['buffer_pool_hits'] / mb,
+					counts['cpu'] / mb * 1e3,
+					peak is None and 'n/a (no tracemalloc)' or '%.1f MB' % (peak / MB)))
+	finally:
+		os.kill(origin_pid, signal.SIGKILL)
+		os.waitpid(origin_pid, 0)
+
+
+def _rss(pid):
+	# resident set size of a process in bytes, None without /proc
+	try:
+		with open('/proc/%d/statm' % pid, 'rb') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError, IndexError):
+		return None
+
+
+def bench_connections(connections=5000):
+	"""memory of the proxy per connection: idle keep-alive ones, after one
+	response, then the same with a request each in flight to an origin
+	that does not answer"""
+	connections = int(connections)
+	origin_pid, origin_port = start_origin(1024)
+	sink_pid, sink_port = start_sink()
+	config = _config(_free_port())
+	config['max_connections'] = 0
+	pid, r = start_proxy(config, instrument=False)
+	clients = []
+	try:
+		time.sleep(0.2)
+		# what the first request loads is not counted
+		fetch(config['server_port'], origin_port, 1024)
+		time.sleep(0.1)
+		base = _rss(pid)
+		if base is None:
+			print('n/a (no /proc)')
+			return
+		request = b'GET / HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n\r\n'
+		for i in range(connections):
+			sock = socket.create_connection(('127.0.0.1', config['server_port']))
+			sock.sendall(request % origin_port)
+			header = _recv_header(sock)
+			got = len(header) - header.find(b'\r\n\r\n') - 4
+			while got < 1024:
+				got += len(sock.recv(4096))
+			clients.append(sock)
+		time.sleep(0.2)
+		idle = _rss(pid)
+		for sock in clients:
+			sock.sendall(request % sink_port)
+		# until the proxy is connected to the sink for all of them
+		last = None
+		while last != _rss(pid):
+			last = _rss(pid)
+			time.sleep(0.5)
+		active = last
+		print('%d connections: idle %.0f B/conn  active %.0f B/conn  (rss %.1f MB, '
+			'%.1f MB idle, %.1f MB active)' % (
+				connections, (idle - base) / connections, (active - base) / connections,
+				base / MB, idle / MB, active / MB))
+	finally:
+		for sock in clients:
+			sock.close()
+		stop_proxy(pid, r)
+		for p in (origin_pid, sink_pid):
+			os.kill(p, signal.SIGKILL)
+			os.waitpid(p, 0)
+
+
+def _count_holds(loop, relay, counts):
+	# how long exchanges keep their upstream connection
+	counts['holds'] = 0
+	counts['hold_time'] = 0.0
+	counts['hold_max'] = 0.0
+	attached = {}
+	attach_remote = prepull.Exchange._attach_remote
+	release_remote = prepull.Exchange._release_remote
+
+	def _attach_remote(exchange, sock):
+		attached[exchange] = time.time()
+		attach_remote(exchange, sock)
+
+	def _release_remote(exchange):
+		t = time.time() - attached.pop(exchange)
+		counts['holds'] += 1
+		counts['hold_time'] += t
+		counts['hold_max'] = max(counts['hold_max'], t)
+		release_remote(exchange)
+	prepull.Exchange._attach_remote = _attach_remote
+	prepull.Exchange._release_remote = _release_remote
+
+
+def bench_slow(clients=20, size_mb=16, rate_mb=4, rcvbuf_kb=64):
+	"""clients reading a big response at rate_mb MB/s each, the proxy
+	holding back the origin at the water marks versus spilling what the
+	clients are behind on to a temp file: how long the upstream connection
+	is held per response and the peak RSS of the proxy"""
+	clients, size = int(clients), int(size_mb) * MB
+	rate = float(rate_mb) * MB
+	rcvbuf = int(rcvbuf_kb) * 1024
+	origin_pid, origin_port = start_origin(size)
+
+	def client(port, got, i):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+		sock.connect(('127.0.0.1', port))
+		sock.sendall(b'GET / HTTP/1.1\r\nHost: 127.0.0.1:' +
+					str(origin_port).encode() + b'\r\n\r\n')
+		header = _recv_header(sock)
+		n = len(header) - header.find(b'\r\n\r\n') - 4
+		start = time.time()
+		while n < size:
+			chunk = sock.recv(rcvbuf)
+			if not chunk:
+				break
+			n += len(chunk)
+			ahead = n / rate - (time.time() - start)
+			if ahead > 0:
+				time.sleep(ahead)
+		sock.close()
+		got[i] = n
+
+	try:
+		for name, threshold in (('backpressure', 0), ('spill', prepull.LOW_WATER)):
+			config = _config(_free_port())
+			config['spill_threshold'] = threshold
+			pid, r = start_proxy(config, setup=_count_holds)
+			time.sleep(0.2)
+			base = _rss(pid)
+			got = [0] * clients
+			threads = [threading.Thread(target=client,
+							args=(config['server_port'], got, i)) for i in range(clients)]
+			start = time.time()
+			for t in threads:
+				t.start()
+			peak = base
+			while any(t.is_alive() for t in threads):
+				rss = _rss(pid)
+				if rss is not None:
+					peak = max(peak, rss)
+				time.sleep(0.05)
+			elapsed = time.time() - start
+			counts = stop_proxy(pid, r)
+			holds = max(counts['holds'], 1)
+			print('%-12s %d clients x %d MB at %.0f MB/s in %.1fs: upstream held %.2fs '
+				'(max %.2fs) per response  peak rss %s  spilled %d MB' % (
+					name, clients, sum(got) // clients // MB, rate / MB, elapsed,
+					counts['hold_time'] / holds, counts['hold_max'],
+					base is None and 'n/a (no /proc)' or
+						'%.1f MB (+%.1f MB)' % (peak / MB, (peak - base) / MB),
+					counts['stats']['spilled_bytes'] // MB))
+	finally:
+		os.kill(origin_pid, signal.SIGKILL)
+		os.waitpid(origin_pid, 0)
+
+
+def _traced(f):
+	# (result of f(), bytes it left allocated) or None without tracemalloc
+	try:
+		import tracemalloc
+	except ImportError:
+		return f(), None
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	result = f()
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return result, after - before
+
+
+def bench_wheel(*sizes):
+	"""idle timeout bookkeeping: cost of refresh / cancel / expire and
+	memory per tracked connection"""
+	sizes = [int(n) for n in sizes] or [10000, 100000, 1000000]
+
+	class Handler(object):
+		pass
+
+	timeout = 300
+	for n in sizes:
+		handlers = [Handler() for i in range(n)]
+		now = 1000.0
+		wheel, mem = _traced(lambda: _fill_wheel(handlers, timeout, now))
+
+		start = time.time()
+		for h in handlers:
+			wheel.refresh(h, now + tcprelay.TIMEOUT_PRECISION)
+		refresh = time.time() - start
+
+		start = time.time()
+		for h in handlers[::10]:
+			wheel.cancel(h)
+		cancel = time.time() - start
+
+		start = time.time()
+		ticks = 0
+		t = now
+		while len(wheel):
+			t += tcprelay.TIMEOUT_PRECISION
+			wheel.expire(t)
+			ticks += 1
+		expire = time.time() - start
+		print('%8d connections: refresh %5.0fns  cancel %5.0fns  expire %5.0fns/conn '
+			'(%d ticks)  memory %s' % (
+				n, refresh / n * 1e9, cancel / (n // 10) * 1e9,
+				expire / (n - n // 10) * 1e9, ticks,
+				mem is None and 'n/a (no tracemalloc)' or '%.0f B/conn' % (mem / n)))
+
+
+def _fill_wheel(handlers, timeout, now):
+	wheel = timingwheel.TimingWheel(timeout, tcprelay.TIMEOUT_PRECISION, now)
+	for h in handlers:
+		wheel.refresh(h, now)
+	return wheel
+
+
+def bench_accept(connections=2000, *budgets):
+	"""a burst of connections hitting the listener at once: accepts/s and
+	poll wakeups per accepted connection for each accept budget"""
+	connections = int(connections)
+	budgets = [int(b) for b in budgets] or [1, 16, 64]
+	for budget in budgets:
+		port = _free_port()
+		config = _config(port)
+		config['accept_budget'] = budget
+		pid, r = start_proxy(config)
+		time.sleep(0.2)
+		clients = []
+		start = time.time()
+		for i in range(connections):
+			c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			c.setblocking(False)
+			try:
+				c.connect(('127.0.0.1', port))
+			except (OSError, IOError):
+				pass
+			clients.append(c)
+		connected = time.time() - start
+		# the proxy accepts in the background, give it time to catch up
+		time.sleep(max(1, connections / 2000.0))
+		counts = stop_proxy(pid, r)
+		for c in clients:
+			c.close()
+		accepted = counts['stats']['accepted']
+		elapsed = max(counts['last_accept'] - counts['first_accept'], 1e-6)
+		print('budget %3d: %d/%d accepted  %8.0f accepts/s  epoll_wait/accept %.3f  '
+			'(burst sent in %.3fs)' % (
+				budget, accepted, connections, accepted / elapsed,
+				counts['epoll_wait'] / max(accepted, 1), connected))
+
+
+BENCHMARKS = {
+	'accept': bench_accept,
+	'buffers': bench_buffers,
+	'connections': bench_connections,
+	'cpus': bench_cpus,
+	'epoll': bench_epoll,
+	'recycle': bench_recycle,
+	'requests': bench_requests,
+	'slow': bench_slow,
+	'throttled': bench_throttled,
+	'wheel': bench_wheel,
+}
+
+
+def main():
+	logging.basicConfig(level=logging.WARN, format='%(levelname)-s: %(message)s')
+	if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+		print('usage: benchmark.py <%s> [args...]' % '|'.join(sorted(BENCHMARKS)))
+		sys.exit(2)
+	BENCHMARKS[sys.argv[1]](*sys.argv[2:])
+
+
+if __name__ == '__main__':
+	main()
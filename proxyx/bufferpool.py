@@ -0,0 +1,57 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+
+class BufferPool(object):
+	"""fixed size bytearrays to recv_into. one is leased for a read and
+	released once what was read is sent on or copied, the released ones
+	are kept for the next reads, at most max_free of them.
+	This class is not thread safe"""
+
+	def __init__(self, size, max_free, stats=None):
+		self.size = size
+		self._max_free = max_free
+		self._free = [] # the last released is leased first, still in cache
+		if stats is None:
+			stats = {}
+		self.stats = stats
+		for k in ('buffer_pool_hits', 'buffer_pool_misses'):
+			stats.setdefault(k, 0)
+
+	def __len__(self):
+		return len(self._free)
+
+	def lease(self):
+		if self._free:
+			self.stats['buffer_pool_hits'] += 1
+			return self._free.pop()
+		self.stats['buffer_pool_misses'] += 1
+		return bytearray(self.size)
+
+	def release(self, buf):
+		if len(self._free) < self._max_free:
+			self._free.append(buf)
+
+	def clear(self):
+		self._free = []
+
+
+def test():
+	pool = BufferPool(16, 2)
+	a = pool.lease()
+	b = pool.lease()
+	c = pool.lease()
+	assert len(a) == 16 and a is not b
+	assert pool.stats == {'buffer_pool_hits': 0, 'buffer_pool_misses': 3}
+	for buf in (a, b, c):
+		pool.release(buf)
+	# over max_free, c is dropped
+	assert len(pool) == 2
+	assert pool.lease() is b and pool.lease() is a
+	assert pool.stats['buffer_pool_hits'] == 2
+	pool.release(a)
+	pool.clear()
+	assert len(pool) == 0 and pool.lease() is not a
+
+
+if __name__ == '__main__':
+	test()
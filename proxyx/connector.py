@@ -0,0 +1,351 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+import sys
+import os
+import time
+import socket
+import errno
+import logging
+import collections
+
+from proxyx import eventloop, asyncdns, common
+
+
+# rfc8305: start the next attempt when the previous one has not connected
+# within this many seconds, a failed attempt starts the next one at once
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+# tcp fast open (rfc7413): the first bytes to send go in the SYN
+MSG_FASTOPEN = 0x20000000
+TCP_INFO = getattr(socket, 'TCP_INFO', 11)
+TCPI_OPT_SYN_DATA = 32 # tcp_info.tcpi_options, the peer acked the data in the SYN
+# cleared once the kernel turns out to have no client side fast open
+_fast_open = True
+
+# connects to a destination after which fast open is no longer tried for
+# it, for RETRY_AFTER seconds: a peer without it gives no cookie, the data
+# goes after the handshake anyway
+FAST_OPEN_FAILURES = 2
+FAST_OPEN_RETRY_AFTER = 600
+# destinations remembered, the least recently failed are forgotten
+FAST_OPEN_MAX = 4096
+
+
+class FastOpenCache(object):
+	"""the destinations whose fast open connects did not get data through,
+	keyed by (ip, port). a peer supporting it fails once, while the kernel
+	gets its cookie. This class is not thread safe"""
+
+	def __init__(self, max_size=FAST_OPEN_MAX, stats=None):
+		self._max_size = max_size
+		self._failures = collections.OrderedDict() # key -> (count, until)
+		if stats is None:
+			stats = {}
+		self.stats = stats
+		for k in ('fast_open_connects', 'fast_open_accepted'):
+			stats.setdefault(k, 0)
+
+	def __len__(self):
+		return len(self._failures)
+
+	def usable(self, key, now):
+		failure = self._failures.get(key)
+		if failure is None or failure[0] < FAST_OPEN_FAILURES:
+			return True
+		if now < failure[1]:
+			return False
+		# tried again, one more failure is enough
+		self._failures[key] = (FAST_OPEN_FAILURES - 1, now)
+		return True
+
+	def update(self, key, accepted, now):
+		self.stats['fast_open_connects'] += 1
+		if accepted:
+			self.stats['fast_open_accepted'] += 1
+			self._failures.pop(key, None)
+			return
+		count = self._failures.pop(key, (0, 0))[0] + 1
+		self._failures[key] = (count, now + FAST_OPEN_RETRY_AFTER)
+		while len(self._failures) > self._max_size:
+			self._failures.popitem(last=False)
+
+
+def _syn_data_acked(sock):
+	try:
+		info = bytearray(sock.getsockopt(socket.SOL_TCP, TCP_INFO, 8))
+	except (OSError, IOError):
+		return False
+	return len(info) > 5 and bool(info[5] & TCPI_OPT_SYN_DATA)
+
+
+class Connector(object):
+	"""Happy Eyeballs: races non-blocking connects to addrs, in order and
+	staggered by CONNECTION_ATTEMPT_DELAY. callback((sock, addr, sent),
+	error) is called once, with the first socket to finish its handshake,
+	which is no longer registered with the loop by then. the other ones are
+	closed.
+	with a FastOpenCache, the first attempt sends data in its SYN where the
+	cache allows, sent is how many bytes of it went, the caller sends the
+	rest. only the first one does, a request raced on several connections
+	would reach the peer more than once"""
+
+	def __init__(self, loop, addrs, port, callback, data=b'', fast_open=None):
+		self._loop = loop
+		self._addrs = [common.to_str(addr) for addr in addrs]
+		self._port = port
+		self._callback = callback
+		self._data = data
+		self._fast_open = fast_open
+		self._socks = {} # fd -> (sock, addr, sent), attempts in flight
+		self._timer = None
+		self._error = None
+
+	def start(self):
+		# may call back right away when no attempt can even be started
+		self._next_attempt()
+
+	def _connect(self, addr, data):
+		# returns the socket and how much of data went in the SYN, None
+		# when it was connected without fast open
+		af = asyncdns.is_ip(addr)
+		if not af:
+			raise socket.error('not an ip address %s' % addr)
+		sock = socket.socket(af, socket.SOCK_STREAM, socket.SOL_TCP)
+		sock.setblocking(False)
+		try:
+			sent = self._start(sock, addr, data)
+		except Exception:
+			# whatever it is, e.g. OverflowError for a bad port
+			sock.close()
+			raise
+		self._loop.add(sock, eventloop.POLL_OUT | eventloop.POLL_ERR,
+					self._handle_event)
+		return sock, sent
+
+	def _start(self, sock, addr, data):
+		global _fast_open
+		sent = None
+		if data and _fast_open:
+			try:
+				sent = sock.sendto(data, MSG_FASTOPEN, (addr, self._port))
+			except (OSError, IOError) as e:
+				error_no = eventloop.errno_from_exception(e)
+				if error_no == errno.EINPROGRESS:
+					# no cookie for the peer yet, the SYN asks for one
+					sent = 0
+				elif error_no in (errno.EOPNOTSUPP, errno.ENOPROTOOPT, errno.EINVAL):
+					logging.warn('tcp fast open is not available: %s', e)
+					_fast_open = False
+				else:
+					raise
+		if sent is None:
+			try:
+				sock.connect((addr, self._port))
+			except (OSError, IOError) as e:
+				if eventloop.errno_from_exception(e) != errno.EINPROGRESS:
+					raise
+		return sent
+
+	def _next_attempt(self):
+		if self._timer:
+			self._timer.cancel()
+			self._timer = None
+		while self._addrs:
+			addr = self._addrs.pop(0)
+			data, self._data = self._data, b''
+			if data and (self._fast_open is None or
+					not self._fast_open.usable((addr, self._port), self._loop.time())):
+				data = b''
+			try:
+				sock, sent = self._connect(addr, data)
+			except Exception as e:
+				# e.g. no route for this family, a failed attempt whatever it is
+				logging.debug('connect %s:%d: %s', addr, self._port, e)
+				self._error = e
+				continue
+			self._socks[sock.fileno()] = (sock, addr, sent)
+			if self._addrs:
+				self._timer = self._loop.call_later(CONNECTION_ATTEMPT_DELAY,
+													self._next_attempt)
+			return
+		if not self._socks:
+			self._done(None, self._error or
+						Exception('no address to connect to'))
+
+	def _handle_event(self, sock, fd, event):
+		sock, addr, sent = self._socks.pop(fd)
+		self._loop.remove(sock)
+		err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if not err and not event & eventloop.POLL_ERR:
+			if sent is not None:
+				self._fast_open.update((addr, self._port),
+									sent > 0 and _syn_data_acked(sock), self._loop.time())
+			self._done((sock, addr, sent or 0), None)
+			return
+		sock.close()
+		self._error = socket.error(err, os.strerror(err))
+		logging.debug('connect %s:%d: %s', addr, self._port, self._error)
+		if self._addrs or not self._socks:
+			self._next_attempt()
+
+	def _done(self, result, error):
+		callback = self._callback
+		self.close()
+		callback(result, error)
+
+	def close(self):
+		if self._timer:
+			self._timer.cancel()
+			self._timer = None
+		for sock, addr, sent in self._socks.values():
+			self._loop.remove(sock)
+			sock.close()
+		self._socks = {}
+		self._addrs = []
+		self._callback = None
+
+
+def test():
+	# the same port on both families, refused_port is bound but not
+	# listening over IPv4. the handshake completes in the backlog, no
+	# accept needed
+	v6 = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+	v6.bind(('::1', 0))
+	v6.listen(5)
+	port = v6.getsockname()[1]
+	v4 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	v4.bind(('127.0.0.1', port))
+	v4.listen(5)
+	closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	closed.bind(('127.0.0.1', 0))
+	refused_port = closed.getsockname()[1]
+	refused = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+	refused.bind(('::1', refused_port))
+	refused.listen(5)
+	# syns to a listener with a full accept queue are dropped, a local
+	# stand in for an unroutable address
+	unroutable = '127.0.0.2'
+	blackhole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	blackhole.bind((unroutable, port))
+	blackhole.listen(0)
+	backlog = []
+	for i in range(3):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setblocking(False)
+		sock.connect_ex((unroutable, port))
+		backlog.append(sock)
+	time.sleep(0.1)
+
+	def race(addrs, port, data=b'', fast_open=None):
+		loop = eventloop.EventLoop()
+		result = {}
+
+		def callback(r, error):
+			result['elapsed'] = time.time() - started
+			result['addr'] = r and r[1]
+			result['sent'] = r and r[2]
+			result['error'] = error
+			if r:
+				r[0].close()
+			loop.stop()
+
+		started = time.time()
+		connector = Connector(loop, addrs, port, callback, data, fast_open)
+		connector.start()
+		if not result:
+			timeout = loop.call_later(5, loop.stop)
+			loop.run()
+			timeout.cancel()
+		# the loser sockets are gone
+		assert not loop._fdmap, loop._fdmap
+		return result
+
+	assert asyncdns.interleave_addresses(['a', 'b', 'c'], ['1']) == \
+		['a', '1', 'b', 'c']
+
+	# the first address wins when it connects
+	r = race(['::1', '127.0.0.1'], port)
+	assert r['addr'] == '::1' and r['elapsed'] < CONNECTION_ATTEMPT_DELAY, r
+
+	# a black holed address only costs the attempt delay
+	r = race([unroutable, '::1'], port)
+	assert r['addr'] == '::1', r
+	assert CONNECTION_ATTEMPT_DELAY <= r['elapsed'] < 1, r
+	r = race([unroutable, unroutable, '127.0.0.1'], port)
+	assert r['addr'] == '127.0.0.1' and r['elapsed'] < 1, r
+
+	# a refused connect moves on without waiting
+	r = race(['127.0.0.1', '::1'], refused_port)
+	assert r['addr'] == '::1' and r['elapsed'] < CONNECTION_ATTEMPT_DELAY, r
+
+	# every attempt failed
+	r = race(['127.0.0.1'], refused_port)
+	assert r['addr'] is None and r['error'], r
+	r = race([], port)
+	assert r['addr'] is None and r['error'], r
+	# not a socket error, a failed attempt all the same
+	for data in (b'', b'x'):
+		r = race(['127.0.0.1'], 70000, data, FastOpenCache())
+		assert r['addr'] is None and isinstance(r['error'], OverflowError), r
+
+	# closing gives up every attempt in flight, without calling back
+	loop = eventloop.EventLoop()
+	connector = Connector(loop, [unroutable], port, None)
+	connector.start()
+	connector.close()
+	assert not loop._fdmap
+
+	for sock in [v4, v6, closed, refused, blackhole] + backlog:
+		sock.close()
+
+	if not sys.platform.startswith('linux'):
+		return
+	# fast open: the data in the SYN gets through where the peer has it on,
+	# else it is not tried any more after FAST_OPEN_FAILURES connects
+	try:
+		with open('/proc/sys/net/ipv4/tcp_fastopen') as f:
+			server_side = int(f.read()) & 2
+	except (IOError, OSError, ValueError):
+		server_side = 0
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_TCP, 23, 5) # TCP_FASTOPEN
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(5)
+	port = listener.getsockname()[1]
+	data = b'GET / HTTP/1.1\r\n\r\n'
+	cache = FastOpenCache()
+	sent = []
+	for i in range(3):
+		r = race(['127.0.0.1'], port, data, cache)
+		sent.append(r['sent'])
+		conn = listener.accept()[0]
+		conn.settimeout(1)
+		if r['sent']:
+			assert conn.recv(100) == data[:r['sent']]
+		conn.close()
+	listener.close()
+	if not _fast_open:
+		# not in this kernel
+		return
+	if server_side:
+		assert sent[2] == len(data) and not len(cache), (sent, cache.stats)
+	else:
+		# the third one connected as usual
+		assert sent[2] == 0 and cache.stats['fast_open_connects'] == 2, (sent, cache.stats)
+
+	# failures are forgotten after a while, the least recent first
+	cache = FastOpenCache(max_size=2)
+	for port in (1, 2, 3):
+		for i in range(FAST_OPEN_FAILURES):
+			cache.update(('a', port), False, 0)
+	assert len(cache) == 2 and cache.usable(('a', 1), 0)
+	assert not cache.usable(('a', 3), 0)
+	assert cache.usable(('a', 3), FAST_OPEN_RETRY_AFTER)
+	cache.update(('a', 3), False, FAST_OPEN_RETRY_AFTER)
+	assert not cache.usable(('a', 3), FAST_OPEN_RETRY_AFTER)
+	cache.update(('a', 2), True, 0)
+	assert len(cache) == 1 and cache.stats['fast_open_accepted'] == 1
+
+
+if __name__ == '__main__':
+	test()
@@ -4,11 +4,13 @@ import select
 import errno
 import logging
 import time
+import heapq
 
 from collections import defaultdict
 
-__all__ = ['EventLoop', 'POLL_NULL', 'POLL_IN', 'POLL_OUT', 'POLL_ERR',
-           'POLL_HUP', 'POLL_NVAL', 'EVENT_NAMES']
+__all__ = ['EventLoop', 'Timer', 'POLL_NULL', 'POLL_IN', 'POLL_OUT',
+           'POLL_ERR', 'POLL_HUP', 'POLL_NVAL', 'POLL_ET', 'POLL_EXCLUSIVE',
+           'EVENT_NAMES']
 
 POLL_NULL = 0x00
 POLL_IN = 0x01
@@ -16,6 +18,14 @@ POLL_OUT = 0x04
 POLL_ERR = 0x08
 POLL_HUP = 0x10
 POLL_NVAL = 0x20
+POLL_ET = 0x80000000 # EPOLLET, only honoured by epoll
+POLL_EXCLUSIVE = 0x10000000 # EPOLLEXCLUSIVE, only honoured by epoll
+
+
+# rebuild the timer heap once this many cancelled timers pile up
+TIMERS_CLEAN_SIZE = 512
+
+_time = getattr(time, 'monotonic', time.time)
 
 
 EVENT_NAMES = {
@@ -34,6 +44,8 @@ class EpollLoop(object):
         self._epoll = select.epoll()
 
     def poll(self, timeout):
+        if timeout is None:
+            timeout = -1  # epoll behaviour
         return self._epoll.poll(timeout)
 
     def add_fd(self, fd, mode):
@@ -64,7 +76,7 @@ class KqueueLoop(object):
             self._kqueue.control([e], 0)
 
     def poll(self, timeout):
-        if timeout < 0:
+        if timeout is not None and timeout < 0:
             timeout = None  # kqueue behaviour
         events = self._kqueue.control(None, KqueueLoop.MAX_EVENTS, timeout)
         results = defaultdict(lambda: POLL_NULL)
@@ -126,8 +138,36 @@ class SelectLoop(object):
         self.add_fd(fd, mode)
 
 
+class Timer(object):
+	"""handle returned by EventLoop.call_at() and EventLoop.call_later()"""
+
+	def __init__(self, loop, when, callback, args):
+		self.when = when
+		self._loop = loop
+		self._callback = callback
+		self._args = args
+		self._cancelled = False
+
+	def cancel(self):
+		if self._cancelled or self._callback is None:
+			return
+		self._cancelled = True
+		self._callback = None
+		self._args = None
+		self._loop._timer_cancelled()
+
+	def cancelled(self):
+		return self._cancelled
+
+	def _run(self):
+		callback, args = self._callback, self._args
+		self._callback = None
+		self._args = None
+		callback(*args)
+
+
 class EventLoop(object):
-	def __init__(self):
+	def __init__(self, edge_triggered=False):
 		logging.debug('EventLoop init')
 		if hasattr(select, 'epoll'):
 			self._impl = EpollLoop()
@@ -140,54 +180,127 @@ class EventLoop(object):
 			model = 'select'
 		else:
 			raise Exception('can not find any available funtions in select')
-		self._fd_to_f = {}
-		self._handlers = []
-		self._ref_handlers = []
-		self._handlers_to_remove = []
-		logging.debug('using event model:%s', model)
+		# handlers registering with POLL_ET must drain their fds until EAGAIN
+		self.edge_triggered = edge_triggered and model == 'epoll'
+		self._fdmap = {} # fd -> (f, handler)
+		self._fd_to_mode = {} # mode currently registered in the poller
+		self._dirty_fds = {} # fd -> mode to apply before the next poll
+		self._rearm_fds = set()
+		self._stopping = False
+		self._timers = [] # heap of (when, seq, timer)
+		self._timer_seq = 0
+		self._cancelled_timers = 0
+		logging.debug('using event model:%s%s', model,
+					self.edge_triggered and ' (edge triggered)' or '')
+
+	def time(self):
+		return _time()
 
 	def poll(self, timeout=None):
+		self._flush_modifications()
 		events = self._impl.poll(timeout)
-		return [(self._fd_to_f[fd], fd, event) for fd, event in events]
+		return [(self._fdmap[fd][0], fd, event) for fd, event in events]
 
-	def add(self, f, mode):
+	def add(self, f, mode, handler):
+		# handler(f, fd, event) is called for every event on this fd only
 		fd = f.fileno()
-		self._fd_to_f[fd] = f
+		self._fdmap[fd] = (f, handler)
+		self._fd_to_mode[fd] = mode
+		self._dirty_fds.pop(fd, None)
+		self._rearm_fds.discard(fd)
 		self._impl.add_fd(fd, mode)
 
 	def remove(self, f):
 		fd = f.fileno()
-		del self._fd_to_f[fd]
+		del self._fdmap[fd]
+		del self._fd_to_mode[fd]
+		self._dirty_fds.pop(fd, None)
+		self._rearm_fds.discard(fd)
 		self._impl.remove_fd(fd)
 
 	def modify(self, f, mode):
+		# only recorded here, several changes to one fd during an
+		# iteration end up as at most one call into the poller
+		self._dirty_fds[f.fileno()] = mode
+
+	def rearm(self, f):
+		# registers f again with the mode it has: an edge triggered fd
+		# reports what is already pending on the next poll
 		fd = f.fileno()
-		self._impl.modify_fd(fd, mode)
-
-	def add_handler(self, handler, ref=True):
-		self._handlers.append(handler)
-		if ref:
-			self._ref_handlers.append(handler)
-
-	def remove_handler(self, handler):
-		if handler in self._ref_handlers:
-			self._ref_handlers.remove(handler)
-		if self._iterating:
-			self._handlers_to_remove.append(handler)
-		else:
-			self._handlers.remove(handler)
+		self._dirty_fds.setdefault(fd, self._fd_to_mode[fd])
+		self._rearm_fds.add(fd)
+
+	def _flush_modifications(self):
+		if not self._dirty_fds:
+			return
+		fd_to_mode = self._fd_to_mode
+		dirty_fds, self._dirty_fds = self._dirty_fds, {}
+		rearm_fds, self._rearm_fds = self._rearm_fds, set()
+		for fd, mode in dirty_fds.items():
+			if fd_to_mode.get(fd, mode) != mode or fd in rearm_fds:
+				fd_to_mode[fd] = mode
+				try:
+					self._impl.modify_fd(fd, mode)
+				except (OSError, IOError) as e:
+					logging.error('modify fd %d:%s', fd, e)
+
+	def stop(self):
+		self._stopping = True
+
+	def call_at(self, when, callback, *args):
+		timer = Timer(self, when, callback, args)
+		self._timer_seq += 1
+		heapq.heappush(self._timers, (when, self._timer_seq, timer))
+		return timer
+
+	def call_later(self, delay, callback, *args):
+		return self.call_at(self.time() + delay, callback, *args)
+
+	def _timer_cancelled(self):
+		# cancelled timers stay in the heap until they reach the top,
+		# rebuild it when they are the majority so memory stays bounded
+		self._cancelled_timers += 1
+		if self._cancelled_timers > TIMERS_CLEAN_SIZE and \
+				self._cancelled_timers > len(self._timers) >> 1:
+			self._timers = [t for t in self._timers if not t[2].cancelled()]
+			heapq.heapify(self._timers)
+			self._cancelled_timers = 0
+
+	def _next_timeout(self):
+		timers = self._timers
+		while timers and timers[0][2].cancelled():
+			heapq.heappop(timers)
+			self._cancelled_timers -= 1
+		if not timers:
+			return None
+		return max(0, timers[0][0] - self.time())
+
+	def _run_timers(self):
+		now = self.time()
+		timers = self._timers
+		ready = []
+		# collect first, timers scheduled by callbacks run next iteration
+		while timers and timers[0][0] <= now:
+			timer = heapq.heappop(timers)[2]
+			if timer.cancelled():
+				self._cancelled_timers -= 1
+			else:
+				ready.append(timer)
+		for timer in ready:
+			try:
+				timer._run()
+			except (OSError, IOError) as e:
+				logging.error(e)
+				import traceback
+				traceback.print_exc()
 
 	def run(self):
 		events = []
-                last_time = time.time()
-		while self._ref_handlers:
+		while not self._stopping:
 			try:
-				events = self.poll(0)
-
-				logging.debug('poll %d', time.time() - last_time)
-				last_time = time.time()
-                
+				events = self.poll(self._next_timeout())
 			except (OSError, IOError) as e:
+				events = []
 				if errno_from_exception(e) in (errno.EPIPE, errno.EINTR):
 					logging.debug('poll:%s', e)
 				else:
@@ -195,18 +308,18 @@ class EventLoop(object):
 					import traceback
 					traceback.print_exc()
 					continue
-			self._iterating = True
-			for handler in self._handlers:
+			for f, fd, event in events:
+				# an earlier handler in this batch may have removed the fd
+				entry = self._fdmap.get(fd, None)
+				if entry is None or entry[0] is not f:
+					continue
 				try:
-					handler(events)
-				except(OSError, IOError) as e:
+					entry[1](f, fd, event)
+				except (OSError, IOError) as e:
 					logging.error(e)
 					import traceback
 					traceback.print_exc()
-			for handler in self._handlers_to_remove:
-				self._handlers.remove(handler)
-				self._handlers_to_remove = []
-			self._iterating = False
+			self._run_timers()
 
 def errno_from_exception(e):
 	if hasattr(e, 'errno'):
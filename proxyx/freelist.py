@@ -0,0 +1,60 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+
+class FreeList(object):
+	"""objects done with, kept to be taken again instead of making new ones,
+	at most max_free of them. what is put back must be reset by then or be
+	reset by who takes it. name prefixes the stats.
+	This class is not thread safe"""
+
+	def __init__(self, max_free, name, stats=None):
+		self._max_free = max_free
+		self._free = []
+		self._hits = name + '_free_hits'
+		self._misses = name + '_free_misses'
+		if stats is None:
+			stats = {}
+		self.stats = stats
+		for k in (self._hits, self._misses):
+			stats.setdefault(k, 0)
+
+	def __len__(self):
+		return len(self._free)
+
+	def take(self):
+		# None when there is none, make one then
+		if self._free:
+			self.stats[self._hits] += 1
+			return self._free.pop()
+		self.stats[self._misses] += 1
+		return None
+
+	def put(self, obj):
+		if len(self._free) < self._max_free:
+			self._free.append(obj)
+
+	def clear(self):
+		self._free = []
+
+
+def test():
+	free = FreeList(2, 'thing')
+	assert free.take() is None
+	a, b, c = object(), object(), object()
+	for obj in (a, b, c):
+		free.put(obj)
+	# over max_free, c is dropped
+	assert len(free) == 2
+	assert free.take() is b and free.take() is a and free.take() is None
+	assert free.stats == {'thing_free_hits': 2, 'thing_free_misses': 2}, free.stats
+	free.put(a)
+	free.clear()
+	assert len(free) == 0
+	# none kept
+	free = FreeList(0, 'thing')
+	free.put(a)
+	assert free.take() is None
+
+
+if __name__ == '__main__':
+	test()
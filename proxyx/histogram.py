@@ -0,0 +1,118 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+
+# bits of a value kept exact: values up to 2 ** SUB_BITS have a bucket each,
+# past that a bucket is 2 ** -(SUB_BITS - 1) of its values wide, under 1%
+SUB_BITS = 8
+_SUB_COUNT = 1 << SUB_BITS
+_HALF_COUNT = _SUB_COUNT >> 1
+
+
+def _index(value):
+	shift = value.bit_length() - SUB_BITS
+	if shift <= 0:
+		return value
+	return shift * _HALF_COUNT + (value >> shift)
+
+
+def _highest(index):
+	# the largest value of the bucket at index
+	if index < _SUB_COUNT:
+		return index
+	shift = (index - _HALF_COUNT) // _HALF_COUNT
+	return ((index - shift * _HALF_COUNT + 1) << shift) - 1
+
+
+class Histogram(object):
+	"""counts of non negative integers, latencies in microseconds here, hdr
+	histogram style: log linear buckets, a percentile is off by under 1% of
+	it, recording is O(1) and the memory grows with the log of the largest
+	value only. This class is not thread safe"""
+
+	__slots__ = ('_counts', 'count', 'total', 'min', 'max')
+
+	def __init__(self):
+		self._counts = []
+		self.count = 0
+		self.total = 0
+		self.min = 0
+		self.max = 0
+
+	def record(self, value):
+		value = max(0, int(value))
+		i = _index(value)
+		counts = self._counts
+		if i >= len(counts):
+			counts.extend([0] * (i + 1 - len(counts)))
+		counts[i] += 1
+		if not self.count or value < self.min:
+			self.min = value
+		self.max = max(self.max, value)
+		self.count += 1
+		self.total += value
+
+	def percentile(self, p):
+		"""the value p percent of the recorded ones are at or under, the
+		top of its bucket. 0 when nothing was recorded"""
+		if not self.count:
+			return 0
+		rank = max(1, -(-self.count * p // 100))
+		seen = 0
+		for i, n in enumerate(self._counts):
+			seen += n
+			if seen >= rank:
+				return min(_highest(i), self.max)
+		return self.max
+
+	def mean(self):
+		return self.total / self.count if self.count else 0
+
+	def summary(self, scale=1000, unit='ms'):
+		return 'n=%d p50=%.1f%s p90=%.1f%s p99=%.1f%s p99.9=%.1f%s max=%.1f%s' % (
+			self.count, self.percentile(50) / scale, unit,
+			self.percentile(90) / scale, unit, self.percentile(99) / scale, unit,
+			self.percentile(99.9) / scale, unit, self.max / scale, unit)
+
+
+def test():
+	# the buckets cover every value once, in order
+	last = -1
+	for value in list(range(4 * _SUB_COUNT)) + [2 ** k + d for k in range(10, 40)
+												for d in (-1, 0, 1)]:
+		i = _index(value)
+		assert i >= last and _highest(i) >= value, value
+		assert _highest(i - 1) < value or i == 0, value
+		# within 1% of the value
+		assert _highest(i) - value <= value / (_HALF_COUNT - 1), value
+		last = i
+
+	h = Histogram()
+	assert h.percentile(99) == 0 and h.mean() == 0
+	for value in range(1, 10001):
+		h.record(value)
+	assert h.count == 10000 and h.min == 1 and h.max == 10000
+	assert h.mean() == 5000.5
+	for p, want in ((50, 5000), (90, 9000), (99, 9900), (100, 10000)):
+		got = h.percentile(p)
+		assert want <= got <= want * 1.01, (p, got)
+	assert h.percentile(0) == 1
+
+	# a slow tail in a mass of fast ones
+	h = Histogram()
+	for i in range(990):
+		h.record(100)
+	for i in range(10):
+		h.record(5000000)
+	assert h.percentile(50) == 100 and h.percentile(99) == 100
+	assert 5000000 <= h.percentile(99.9) <= 5050000
+	assert h.percentile(99.9) == h.max == 5000000
+	# buckets up to the largest value only, seconds in microseconds are a
+	# few thousand
+	assert len(h._counts) < 2500
+	h.record(-5)
+	assert h.min == 0
+	assert h.summary().startswith('n=1001 p50=0.1ms p90=0.1ms p99=0.1ms p99.9=5000.0ms')
+
+
+if __name__ == '__main__':
+	test()
@@ -0,0 +1,138 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+import socket
+import errno
+import logging
+
+from proxyx import eventloop
+
+
+class ConnectionPool(object):
+	"""idle upstream sockets by (host, port), most recently used first.
+	idle sockets are not registered with the loop, checkout() checks them
+	instead. This class is not thread safe"""
+
+	def __init__(self, max_idle, idle_timeout, stats=None):
+		self._max_idle = max_idle # per key, 0 disables pooling
+		self._idle_timeout = idle_timeout
+		self._idle = {} # key -> [(sock, since), ...], oldest first
+		self._count = 0
+		if stats is None:
+			stats = {}
+		self.stats = stats
+		for k in ('pool_hits', 'pool_misses', 'pool_stale'):
+			stats.setdefault(k, 0)
+
+	def __len__(self):
+		return self._count
+
+	def checkin(self, key, sock, now):
+		"""sock must be idle: no request in flight, no longer in the loop"""
+		if self._max_idle <= 0:
+			sock.close()
+			return
+		idle = self._idle.setdefault(key, [])
+		if len(idle) >= self._max_idle:
+			idle.pop(0)[0].close()
+			self._count -= 1
+		idle.append((sock, now))
+		self._count += 1
+
+	def checkout(self, key, now):
+		"""a healthy idle socket to key, or None"""
+		idle = self._idle.get(key, None)
+		while idle:
+			sock, since = idle.pop()
+			self._count -= 1
+			if now - since < self._idle_timeout and self._healthy(sock):
+				if not idle:
+					del self._idle[key]
+				self.stats['pool_hits'] += 1
+				return sock
+			self.stats['pool_stale'] += 1
+			sock.close()
+		self._idle.pop(key, None)
+		self.stats['pool_misses'] += 1
+		return None
+
+	def _healthy(self, sock):
+		# an idle connection has nothing to read, EOF means the origin
+		# closed it, data means it is out of sync
+		try:
+			data = sock.recv(1, socket.MSG_PEEK)
+		except (OSError, IOError) as e:
+			return eventloop.errno_from_exception(e) in (errno.EAGAIN,
+														errno.EWOULDBLOCK)
+		logging.debug('pooled connection %s', 'closed' if not data else 'out of sync')
+		return False
+
+	def sweep(self, now):
+		for key in list(self._idle.keys()):
+			idle = self._idle[key]
+			while idle and now - idle[0][1] >= self._idle_timeout:
+				idle.pop(0)[0].close()
+				self._count -= 1
+			if not idle:
+				del self._idle[key]
+
+	def close(self):
+		for idle in self._idle.values():
+			for sock, since in idle:
+				sock.close()
+		self._idle = {}
+		self._count = 0
+
+
+def test():
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(8)
+	addr = listener.getsockname()
+
+	def connect():
+		sock = socket.create_connection(addr)
+		sock.setblocking(False)
+		return sock, listener.accept()[0]
+
+	pool = ConnectionPool(max_idle=2, idle_timeout=10)
+	key = (b'example.com', 80)
+	assert pool.checkout(key, 0) is None
+
+	a, a_peer = connect()
+	b, b_peer = connect()
+	c, c_peer = connect()
+	pool.checkin(key, a, 0)
+	pool.checkin(key, b, 1)
+	# over max_idle, the oldest one goes
+	pool.checkin(key, c, 2)
+	assert len(pool) == 2
+
+	# most recently used first, closed or out of sync ones are skipped
+	c_peer.close()
+	b_peer.sendall(b'x')
+	assert pool.checkout(key, 3) is None
+	assert len(pool) == 0
+	assert pool.stats['pool_stale'] == 2 and pool.stats['pool_misses'] == 2
+
+	d, d_peer = connect()
+	pool.checkin(key, d, 3)
+	assert pool.checkout((b'other', 80), 3) is None
+	assert pool.checkout(key, 4) is d and pool.stats['pool_hits'] == 1
+
+	# idle timeout, on checkout and on sweep
+	pool.checkin(key, d, 5)
+	assert pool.checkout(key, 15) is None
+	e, e_peer = connect()
+	pool.checkin(key, e, 5)
+	pool.sweep(14)
+	assert len(pool) == 1
+	pool.sweep(15)
+	assert len(pool) == 0
+
+	pool.close()
+	for sock in (a_peer, b_peer, d_peer, e_peer, listener):
+		sock.close()
+
+
+if __name__ == '__main__':
+	test()
@@ -3,6 +3,8 @@ from __future__ import absolute_import, division, print_function, with_statement
 
 import sys
 import os
+import time
+import errno
 import logging
 import signal
 
@@ -10,43 +12,163 @@ import signal
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
 from proxyx import utils, eventloop, asyncdns, tcprelay
 
-def main():
-	config = utils.get_config()
+# a worker dying sooner than this after its fork is respawned only after
+# RESPAWN_DELAY, so a worker that can not start does not fork-bomb us
+MIN_WORKER_LIFETIME = 1
+RESPAWN_DELAY = 1
+
+
+def run_server(config, dns_resolver=None, tcp_server=None):
+	if tcp_server is None:
+		dns_resolver = asyncdns.DNSResolver()
+		tcp_server = tcprelay.TCPRelay(config, dns_resolver, False)
+
+	def child_handler(signum, _):
+		logging.warn('receive SIGQUIT, doing graceful shutting down..')
+		tcp_server.close(next_tick=True)
+
+	def stats_handler(signum, _):
+		logging.info('pid %d stats: %s', os.getpid(), tcp_server.stats)
+		for phase, timings in tcp_server.timings.items():
+			logging.info('pid %d %s: %s', os.getpid(), phase, timings.summary())
+
+	signal.signal(getattr(signal, 'SIGQUIT', signal.SIGTERM), child_handler)
+	if hasattr(signal, 'SIGUSR1'):
+		signal.signal(signal.SIGUSR1, stats_handler)
+	try:
+		loop = eventloop.EventLoop(config['edge_triggered'])
+		dns_resolver.add_to_loop(loop)
+		tcp_server.add_to_loop(loop)
+		loop.run()
+		dns_resolver.close()
+	except (KeyboardInterrupt, IOError, OSError) as e:
+		logging.error(e)
+		os._exit(1)
+
+
+def _exit_reason(status):
+	# a waitpid status, in words
+	if os.WIFSIGNALED(status):
+		return 'killed by signal %d' % os.WTERMSIG(status)
+	return 'exited with status %d' % os.WEXITSTATUS(status)
+
+
+def run_master(config, worker):
+	# pre-fork: the master only supervises, each worker runs its own loop
+	children = {} # pid -> (worker index, start time)
+	stopping = []
+	stop_signals = [signal.SIGTERM, signal.SIGINT]
+	if hasattr(signal, 'SIGQUIT'):
+		stop_signals.append(signal.SIGQUIT)
+
+	def spawn(index):
+		pid = os.fork()
+		if pid == 0:
+			for signum in stop_signals:
+				signal.signal(signum, signal.SIG_DFL)
+			code = 1
+			try:
+				worker(index)
+				code = 0
+			except Exception:
+				logging.exception('worker %d crashed', index)
+			finally:
+				os._exit(code)
+		logging.info('started worker %d, pid %d', index, pid)
+		children[pid] = (index, time.time())
+
+	def forward_handler(signum, _):
+		for pid in list(children.keys()):
+			try:
+				os.kill(pid, signum)
+			except OSError:
+				pass
+
+	def master_handler(signum, _):
+		stopping.append(signum)
+		forward_handler(signum, _)
+
+	for signum in stop_signals:
+		signal.signal(signum, master_handler)
+	if hasattr(signal, 'SIGUSR1'):
+		signal.signal(signal.SIGUSR1, forward_handler)
+	for i in range(int(config['workers'])):
+		spawn(i)
+	while children:
+		try:
+			pid, status = os.waitpid(-1, 0)
+		except OSError as e:
+			if eventloop.errno_from_exception(e) == errno.EINTR:
+				continue
+			break
+		if pid not in children:
+			continue
+		index, started = children.pop(pid)
+		if stopping:
+			continue
+		logging.error('worker %d (pid %d) %s, respawning', index, pid,
+					_exit_reason(status))
+		if time.time() - started < MIN_WORKER_LIFETIME:
+			time.sleep(RESPAWN_DELAY)
+		if not stopping:
+			spawn(index)
+	logging.info('all workers exited')
+
+
+def make_servers(config, count):
+	# with SO_REUSEPORT the master creates every worker's listener, in worker
+	# order, so their slots in the reuseport group and their backlogs
+	# survive a worker being respawned
+	servers = []
+	for i in range(count):
+		dns_resolver = asyncdns.DNSResolver()
+		servers.append((dns_resolver, tcprelay.TCPRelay(config, dns_resolver, False)))
+	return servers
+
+
+def steer_servers(servers, cpus):
+	# worker i runs on cpus[i % len(cpus)], so does its listener's traffic
+	for i, (_, tcp_server) in enumerate(servers):
+		tcp_server.bind_to_cpu(cpus[i % len(cpus)])
+	# the cpu filter returns the cpu number as the listener index, which is
+	# only right when there is exactly one worker per cpu, numbered from 0
+	if cpus == list(range(len(servers))):
+		servers[0][1].attach_cpu_filter()
 
-	datas = ''
 
-	datas += 'sdfgsd'
-	datas += 'asyncdns'
-	logging.debug(len(datas))
+def main():
+	config = utils.get_config()
 
 	logging.debug('server main()')
 
-	dns_resolver = asyncdns.DNSResolver()
-
-	tcp_server = tcprelay.TCPRelay(config, dns_resolver, False)
-
-
-	def run_server():
-		def child_handler(signum, _):
-			logging.warn('receive SIGQUIT, doing graceful shutting down..')
-
-		signal.signal(getattr(signal, 'SIGQUIT', signal.SIGTERM), child_handler)
-		try:
-			loop = eventloop.EventLoop()
-			dns_resolver.add_to_loop(loop)
-			tcp_server.add_to_loop(loop)
-			loop.run()
-
-		except (KeyboardInterrupt, IOError, OSError) as e:
-			logging.error(e)
-			os._exit(1)
-	if int(config['workers']) > 1:
-		pass
+	workers = int(config['workers'])
+	if workers > 1:
+		cpus = None
+		if config['cpu_affinity']:
+			cpus = utils.get_cpus()
+		if tcprelay.SO_REUSEPORT:
+			config['reuse_port'] = True
+			servers = make_servers(config, workers)
+			if cpus:
+				steer_servers(servers, cpus)
+		else:
+			# share one listener, registered with POLL_EXCLUSIVE by workers
+			servers = make_servers(config, 1)
+
+		def worker(index):
+			dns_resolver, tcp_server = servers[index % len(servers)]
+			tcp_server.worker = index
+			for _, other in servers:
+				if other is not tcp_server:
+					other.close()
+			if cpus:
+				utils.set_cpu_affinity(cpus[index % len(cpus)])
+			run_server(config, dns_resolver, tcp_server)
+
+		run_master(config, worker)
 	else:
-		run_server()
-
+		run_server(config)
 
-#if __main__ == '__main__':
-#	main()
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+	main()
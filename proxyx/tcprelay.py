@@ -1,5 +1,7 @@
 from __future__ import absolute_import, division, print_function, with_statement
 
+import sys
+import os
 import time
 import socket
 import errno
@@ -7,16 +9,42 @@ import struct
 import logging
 import traceback
 import random
+import ctypes
+import collections
+try:
+	import resource
+except ImportError:
+	resource = None
 
-from proxyx import eventloop, utils
-from modules import prepull
+from proxyx import eventloop, utils, timingwheel, pool, bufferpool, freelist, \
+	connector, histogram
+from modules import prepull, cache, prefetch
 
 
-TIMEOUTS_CLEAN_SIZE = 512
 TIMEOUT_PRECISION = 4
 
+# the listener is paused at the high water marks and resumed once below
+# LOW_WATER times each of them
+FD_HIGH_WATER = 0.9 # of RLIMIT_NOFILE
+LOW_WATER = 0.9
+
 MSG_FASTOPEN = 0x20000000
 
+if hasattr(socket, 'SO_REUSEPORT'):
+	SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith('linux'):
+	SO_REUSEPORT = 15
+else:
+	SO_REUSEPORT = None
+
+SO_INCOMING_CPU = 49
+SO_ATTACH_REUSEPORT_CBPF = 51
+
+# classic BPF for a SO_REUSEPORT group: "return the current cpu", i.e.
+# ld [SKF_AD_OFF + SKF_AD_CPU]; ret a. the kernel uses the value as the
+# index of the listener to wake, falling back to hashing when out of range
+REUSEPORT_CPU_FILTER = [(0x20, 0, 0, 0xfffff000 + 36), (0x16, 0, 0, 0)]
+
 CMD_CONNECT = 1
 CMD_BIND = 2
 CMD_UDP_ASSOCIATE = 3
@@ -34,13 +62,72 @@ class TCPRelay(object):
 		self._closed = False
 		self._eventloop = None
 		self._fd_to_handlers = {}
-		self._last_time = time.time()
+		self._periodic_timer = None
+		self._cpu = None
+		self.stats = {
+			'accepted': 0,
+			'requests': 0,
+			'migrated': 0, # connections whose packets were handled on another cpu
+			'listener_pauses': 0,
+			'listener_paused_time': 0.0, # seconds
+			'spills': 0, # responses that went to a temp file for a slow client
+			'spilled_bytes': 0,
+		}
+
+		# latencies of the phases of the requests, microseconds
+		self.timings = collections.OrderedDict(
+			(phase, histogram.Histogram()) for phase in prepull.TIMING_PHASES)
+
+		# admission control
+		self._connections = 0
+		self._max_connections = int(config['max_connections'])
+		self._max_memory = int(config['max_memory'])
+		self._max_fds = 0
+		if resource:
+			nofile = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+			if nofile != resource.RLIM_INFINITY:
+				self._max_fds = int(nofile * FD_HIGH_WATER)
+		self._memory_high = False
+		self._listener_mode = None
+		self._listener_paused = False
+		self._paused_at = 0
 
 		self._timeout = config['timeout']
-		self._timeouts = [] # a list of all the handlers
-
-		self._timeout_offset = 0 # last checked position for timeout
-		self._handler_to_timeouts = {} # key:handler value: index in timeouts
+		self._accept_budget = max(1, int(config['accept_budget']))
+		self._timeouts = None # timing wheel of all the handlers, made by add_to_loop
+
+		# idle upstream connections, shared by the handlers
+		self.pool = pool.ConnectionPool(int(config['pool_max_idle']),
+								config['pool_idle_timeout'], self.stats)
+		# read buffers, shared by the handlers
+		self.buffers = bufferpool.BufferPool(prepull.BUF_SIZE,
+								int(config['buffer_pool_max']), self.stats)
+		# what fast open connects taught about the destinations
+		self.fast_open = None
+		if config['fast_open']:
+			self.fast_open = connector.FastOpenCache(stats=self.stats)
+		# destroyed handlers and done with parsers, recycled
+		free_max = int(config['free_list_max'])
+		self.handlers = freelist.FreeList(free_max, 'handler', self.stats)
+		self.request_parsers = freelist.FreeList(free_max, 'request_parser', self.stats)
+		self.response_parsers = freelist.FreeList(free_max, 'response_parser', self.stats)
+		# the worker process running this relay, names its cache directory
+		self.worker = 0
+		# responses, shared by the handlers
+		self.cache = None
+		if int(config['cache_size']) > 0:
+			self.cache = cache.ResponseCache(int(config['cache_size']),
+								int(config['cache_max_object']), self.stats)
+		# fills the cache with what the pages going through link to
+		self.prefetcher = None
+		if config['prefetch']:
+			if self.cache is None:
+				logging.warn('prefetch needs the cache, cache_size is 0')
+			else:
+				self.prefetcher = prefetch.Prefetcher(self.cache, self._prefetch,
+								int(config['prefetch_max_per_page']),
+								int(config['prefetch_concurrency']),
+								config['prefetch_origins'], self.stats)
 
 		if is_local:
 			listen_addr = config['local_address']
@@ -57,6 +144,8 @@ class TCPRelay(object):
 		af, socktype, proto, canonname, sa = addrs[0]
 		server_socket = socket.socket(af, socktype, proto)
 		server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if config['reuse_port']:
+			server_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
 		server_socket.bind(sa)
 		server_socket.setblocking(False)
 		if config['fast_open']:
@@ -68,6 +157,28 @@ class TCPRelay(object):
 		server_socket.listen(1024)
 		self._server_socket = server_socket
 
+	def bind_to_cpu(self, cpu):
+		"""prefer connections whose packets are processed on cpu, the worker
+		running this relay is expected to be pinned to the same cpu"""
+		self._cpu = cpu
+		try:
+			self._server_socket.setsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU, cpu)
+		except socket.error as e:
+			logging.warn('SO_INCOMING_CPU is not available: %s', e)
+
+	def attach_cpu_filter(self):
+		"""steer every connection of the SO_REUSEPORT group to the listener
+		whose index is the cpu that received it"""
+		insns = b''.join(struct.pack('HBBI', *insn) for insn in REUSEPORT_CPU_FILTER)
+		buf = ctypes.create_string_buffer(insns, len(insns))
+		fprog = struct.pack('HL', len(REUSEPORT_CPU_FILTER), ctypes.addressof(buf))
+		try:
+			self._server_socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+			return True
+		except socket.error as e:
+			logging.warn('reuseport cpu filter is not available: %s', e)
+			return False
+
 	# add listen sock's handler
 	def add_to_loop(self, loop):
 		if self._eventloop:
@@ -75,111 +186,188 @@ class TCPRelay(object):
 		if self._closed:
 			raise Exception('already closed')
 		self._eventloop = loop
-		loop.add_handler(self._handle_events)
-
-		self._eventloop.add(self._server_socket, eventloop.POLL_IN | eventloop.POLL_ERR)
+		self._listener_mode = eventloop.POLL_IN | eventloop.POLL_ERR
+		if int(self._config['workers']) > 1:
+			# the listener may be shared by the workers' loops, only wake one
+			self._listener_mode |= eventloop.POLL_EXCLUSIVE
+		self._eventloop.add(self._server_socket, self._listener_mode, self._handle_event)
+		if self._timeout:
+			self._timeouts = timingwheel.TimingWheel(self._timeout, TIMEOUT_PRECISION, loop.time())
+		if self.cache is not None and self._config['cache_dir']:
+			# opened in the worker, after the fork
+			self.cache.disk = cache.DiskCache(
+				os.path.join(self._config['cache_dir'], 'worker%d' % self.worker),
+				int(self._config['cache_disk_size']), stats=self.stats)
+		self._periodic_timer = loop.call_later(TIMEOUT_PRECISION, self._handle_periodic)
+
+	def _prefetch(self, data, request, address, callback):
+		prepull.PrefetchHandler(self, self._fd_to_handlers, self._eventloop,
+								self._config, self._dns_resolver, self._is_local,
+								data, request, address, callback)
 
 	def remove_handler(self, handler):
-		index = self._handler_to_timeouts.get(hash(handler), -1)
-		logging.debug('timeouts len:%d, index:%d', len(self._timeouts), index)
-		if index >= 0:
-			#delete is O(n), so we just set it to None
-			self._timeouts[index] = None
-			del self._handler_to_timeouts[hash(handler)]
+		if self._timeouts is not None:
+			self._timeouts.cancel(handler)
+		self._connections -= 1
+		self.handlers.put(handler)
+		if self._listener_paused and self._below_low_water():
+			self._resume_listener()
+
+	def _above_high_water(self):
+		if self._max_connections and self._connections >= self._max_connections:
+			return True
+		if self._max_fds and self._fds() >= self._max_fds:
+			return True
+		return self._memory_high
+
+	def _below_low_water(self):
+		if self._max_connections and \
+				self._connections > self._max_connections * LOW_WATER:
+			return False
+		if self._max_fds and self._fds() > self._max_fds * LOW_WATER:
+			return False
+		return not self._memory_high
+
+	def _fds(self):
+		return len(self._fd_to_handlers) + len(self.pool)
+
+	def _check_memory(self):
+		# sampled from the periodic timer, reading /proc is not free
+		if not self._max_memory:
+			return
+		rss = utils.get_rss()
+		if rss is None:
+			return
+		if rss >= self._max_memory:
+			self._memory_high = True
+		elif rss < self._max_memory * LOW_WATER:
+			self._memory_high = False
+
+	def _pause_listener(self):
+		# new connections wait in the kernel backlog until we resume
+		if self._listener_paused or not self._server_socket:
+			return
+		self._eventloop.remove(self._server_socket)
+		self._listener_paused = True
+		# idle upstream connections are the cheapest thing to give back
+		self.pool.close()
+		if self._memory_high:
+			self.buffers.clear()
+			for free in (self.handlers, self.request_parsers, self.response_parsers):
+				free.clear()
+			if self.cache is not None:
+				self.cache.clear()
+		self._paused_at = self._eventloop.time()
+		self.stats['listener_pauses'] += 1
+		logging.warn('overloaded with %d connections, pause accepting',
+					self._connections)
+
+	def _resume_listener(self):
+		if not self._listener_paused:
+			return
+		self._update_paused_time()
+		self._listener_paused = False
+		if self._server_socket:
+			self._eventloop.add(self._server_socket, self._listener_mode, self._handle_event)
+		logging.info('%d connections, resume accepting', self._connections)
+
+	def _update_paused_time(self):
+		now = self._eventloop.time()
+		self.stats['listener_paused_time'] += now - self._paused_at
+		self._paused_at = now
 
 	def update_activity(self, handler):
-		now = int(time.time())
-		if now - handler.last_activity < TIMEOUT_PRECISION:
-			return
-		handler.last_activity = now
-		index = self._handler_to_timeouts.get(hash(handler), -1)
-		logging.debug('timeouts len:%d, index:%d', len(self._timeouts), index)
-		if index >= 0:
-			self._timeouts[index] = None
-		length = len(self._timeouts)
-		self._timeouts.append(handler)
-		self._handler_to_timeouts[hash(handler)] = length
+		if self._timeouts is not None:
+			self._timeouts.refresh(handler, self._eventloop.time())
 
 	def _sweep_timeout(self):
-		if self._timeout:
+		if self._timeouts is not None:
 			logging.log(utils.VERBOSE_LEVEL, 'sweeping timeouts')
-			now = time.time()
-			length = len(self._timeouts)
-			pos = self._timeout_offset
-			handler = None
-			logging.debug('pos:%d length:%d', pos, length)
-			while pos < length:
-				handler = self._timeouts[pos]
-
-				if handler:
-
-					if now - handler.last_activity < self._timeout:
-						break
-					else:
-						if handler.remote_address:
-							logging.warn('timed out:%s :%d' % handler.remote_address)
-						else:
-							logging.warn('timed out')
-						handler.destroy()
-						self._timeouts[pos] = None # free memory
-						pos += 1
+			for handler in self._timeouts.expire(self._eventloop.time()):
+				if handler.remote_address:
+					logging.warn('timed out:%s :%d' % handler.remote_address[:2])
+				else:
+					logging.warn('timed out')
+				handler.destroy()
+
+	# listen sock is readable
+	def _handle_event(self, sock, fd, event):
+		logging.log(utils.VERBOSE_LEVEL, 'fd %d %s', fd, eventloop.EVENT_NAMES.get(event, event))
+		if event & eventloop.POLL_ERR:
+			raise Exception('server_socket error')
+		# drain the backlog, but let the established connections have their
+		# turn after accept_budget new ones
+		for i in range(self._accept_budget):
+			try:
+				conn, addr = self._server_socket.accept()
+			except (OSError, IOError) as e:
+				error_no = eventloop.errno_from_exception(e)
+				if error_no not in (errno.EAGAIN, errno.EINPROGRESS, errno.EWOULDBLOCK):
+					logging.error(e)
+					if self._config['verbose']:
+						traceback.print_exc()
+				return
+			logging.debug('accept')
+			self.stats['accepted'] += 1
+			try:
+				# python does not expose accept4() flags, so the new socket is
+				# made non-blocking here, before its handler sees it
+				conn.setblocking(False)
+				if self._cpu is not None:
+					if conn.getsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU) != self._cpu:
+						self.stats['migrated'] += 1
+				handler = self.handlers.take()
+				if handler is not None:
+					handler.reset(conn)
 				else:
-					pos += 1
-
-			if pos > TIMEOUTS_CLEAN_SIZE and pos > length >> 1:
-
-				self._timeouts = self._timeouts[pos:]
-				for key in self._handler_to_timeouts:
-					self._handler_to_timeouts[key] = pos
-				pos = 0
-			self._timeout_offset = pos
-
-	def _handle_events(self, events):
-		for sock, fd, event in events:
-			if sock:
-				#logging.debug("TCPRelay _handle_events:[fd:%d], [event:%d]", fd, event)
-				logging.log(utils.VERBOSE_LEVEL, 'fd %d %s', fd, eventloop.EVENT_NAMES.get(event, event))
-			if sock == self._server_socket:
-				if event & eventloop.POLL_ERR:
-					raise Exception('server_socket error')
-				try:
-					logging.debug('accept')
-					conn = self._server_socket.accept()
 					prepull.TCPRelayHandler(self, self._fd_to_handlers,
-									self._eventloop, conn[0], self._config,
+									self._eventloop, conn, self._config,
 									self._dns_resolver, self._is_local)
-				except (OSError, IOError) as e:
-					error_no = eventloop.errno_from_exception(e)
-					if error_no in (errno.EAGAIN, errno.EINPROGRESS, errno.EWOULDBLOCK):
-						continue
-					else:
-						logging.error(e)
-						if self._config['verbose']:
-							traceback.print_exc()
-			else:
-				if sock:
-					handler = self._fd_to_handlers.get(fd, None)
-					if handler:
-						handler.handle_event(sock, event)
-				else:
-					logging.warn('poll removed fd')
-		now = time.time()
-		if now - self._last_time > TIMEOUT_PRECISION:
-			self._sweep_timeout()
-			self._last_time = now
+			except (OSError, IOError) as e:
+				logging.error(e)
+				if self._config['verbose']:
+					traceback.print_exc()
+				conn.close()
+				continue
+			self._connections += 1
+			if self._above_high_water():
+				self._pause_listener()
+				return
+
+	def _handle_periodic(self):
+		self._periodic_timer = None
+		self._sweep_timeout()
+		self.pool.sweep(self._eventloop.time())
+		self._check_memory()
+		if self._listener_paused:
+			self._update_paused_time()
+			if self._below_low_water():
+				self._resume_listener()
+		elif self._above_high_water():
+			self._pause_listener()
 		if self._closed:
 			if self._server_socket:
-				self._eventloop.remove(self._server_socket)
+				if not self._listener_paused:
+					self._eventloop.remove(self._server_socket)
 				self._server_socket.close()
 				self._server_socket = None
 				logging.info('closed listen port %d', self._listen_port)
+			self.pool.close()
 			if not self._fd_to_handlers:
-				self._eventloop.remove_hanlder(self._handler_events)
+				self._eventloop.stop()
+				return
+		self._periodic_timer = self._eventloop.call_later(TIMEOUT_PRECISION, self._handle_periodic)
 
 	def close(self, next_tick = False):
 		self._closed = True
-		if not next_tick:
+		self.pool.close()
+		if self.prefetcher is not None:
+			self.prefetcher.close()
+		if not next_tick and self._server_socket:
+			if self._eventloop and not self._listener_paused:
+				self._eventloop.remove(self._server_socket)
 			self._server_socket.close()
+			self._server_socket = None
 
 
 
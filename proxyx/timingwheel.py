@@ -0,0 +1,127 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+import logging
+
+
+# hashed timing wheel for idle timeouts
+# n: objects tracked, each one lives in exactly one slot
+# refresh & cancel are O(1) dict operations keyed by object identity, expire
+# is O(slots passed + objects expired), memory is O(slots + n)
+
+
+class TimingWheel(object):
+	"""This class is not thread safe"""
+
+	def __init__(self, timeout, precision, now):
+		self._precision = precision
+		# ticks from the current one to a deadline: ceil(timeout / precision)
+		# plus the partly elapsed current tick
+		self._ticks = max(1, int(-(-timeout // precision))) + 1
+		# one more slot than that, so that a fresh deadline never lands in
+		# the slot being expired
+		self._size = self._ticks + 1
+		self._slots = [{} for i in range(self._size)]
+		self._deadlines = {} # id(obj) -> deadline tick
+		self._tick = self._tick_of(now)
+
+	def _tick_of(self, t):
+		return int(t // self._precision)
+
+	def __len__(self):
+		return len(self._deadlines)
+
+	def __contains__(self, obj):
+		return id(obj) in self._deadlines
+
+	def refresh(self, obj, now):
+		# O(1), obj expires timeout to timeout + 2 * precision seconds from now
+		key = id(obj)
+		deadline = max(self._tick_of(now), self._tick) + self._ticks
+		old = self._deadlines.get(key, None)
+		if old == deadline:
+			return
+		if old is not None:
+			del self._slots[old % self._size][key]
+		self._deadlines[key] = deadline
+		self._slots[deadline % self._size][key] = obj
+
+	def cancel(self, obj):
+		# O(1)
+		key = id(obj)
+		deadline = self._deadlines.pop(key, None)
+		if deadline is not None:
+			del self._slots[deadline % self._size][key]
+
+	def expire(self, now):
+		"""advance to now and return the objects whose deadline passed, they
+		are no longer tracked"""
+		target = self._tick_of(now)
+		if target <= self._tick:
+			return []
+		expired = []
+		deadlines = self._deadlines
+		# after a long stall one pass over every slot is enough
+		start = max(self._tick + 1, target - self._size + 1)
+		for tick in range(start, target + 1):
+			slot = self._slots[tick % self._size]
+			if not slot:
+				continue
+			# deadlines are at most one revolution ahead unless the wheel
+			# was not advanced for a while, keep those for a later round
+			for key, obj in list(slot.items()):
+				if deadlines[key] <= target:
+					del slot[key]
+					del deadlines[key]
+					expired.append(obj)
+		self._tick = target
+		if expired:
+			logging.debug('%d objects expired' % len(expired))
+		return expired
+
+
+def test():
+	class Obj(object):
+		pass
+
+	a, b, c = Obj(), Obj(), Obj()
+	w = TimingWheel(timeout=10, precision=2, now=100)
+	w.refresh(a, 100)
+	w.refresh(b, 101)
+	w.refresh(c, 103)
+	assert len(w) == 3 and a in w
+
+	# never before the timeout
+	assert w.expire(111) == []
+	expired = w.expire(112)
+	assert a in expired and b in expired and c not in expired
+	assert a not in w and len(w) == 1
+
+	# refreshing moves the deadline
+	w.refresh(a, 111)
+	w.refresh(c, 111)
+	assert w.expire(123) == []
+	assert set(map(id, w.expire(124))) == set([id(a), id(c)])
+
+	# cancel
+	w.refresh(b, 130)
+	w.cancel(b)
+	w.cancel(b)
+	assert b not in w
+	assert w.expire(200) == []
+
+	# deadlines set while the wheel lagged behind are not expired early
+	w.refresh(a, 300)
+	assert w.expire(311) == []
+	assert w.expire(313) == [a]
+
+	# objects are kept by identity, equal objects do not collide
+	x, y = [1], [1]
+	w.refresh(x, 400)
+	w.refresh(y, 400)
+	assert len(w) == 2
+	w.cancel(x)
+	assert y in w and x not in w
+
+
+if __name__ == '__main__':
+	test()
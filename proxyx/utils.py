@@ -16,5 +16,61 @@ def get_config():
 	config['timeout'] = 300
 	config['verbose'] = False
 	config['fast_open'] = False
+	config['edge_triggered'] = False
+	config['reuse_port'] = False
+	config['cpu_affinity'] = False
+	config['accept_budget'] = 64
+	config['max_connections'] = 0 # 0 for no limit
+	config['max_memory'] = 0 # RSS in bytes, 0 for no limit
+	config['pool_max_idle'] = 8 # idle upstream connections per origin
+	config['pool_idle_timeout'] = 60
+	config['buffer_pool_max'] = 64 # free 64KB read buffers kept per worker
+	config['free_list_max'] = 1024 # destroyed handlers, and parsers of each kind, kept per worker for reuse
+	config['spill_threshold'] = 0 # bytes queued for a slow client before the rest of a response goes to a temp file, 0 for never
+	config['spill_dir'] = '' # of those temp files, '' for the system one
+	config['spill_max'] = 1024 * 1024 * 1024 # bytes spilled per response, past it the origin waits for the client
+	config['cache_size'] = 0 # bytes of responses cached per worker, 0 for no cache
+	config['cache_max_object'] = 1024 * 1024
+	config['cache_dir'] = '' # disk tier behind the memory cache, one subdirectory per worker
+	config['cache_disk_size'] = 1024 * 1024 * 1024 # bytes per worker
+	config['prefetch'] = False # fetch the links of pages into the cache, needs cache_size
+	config['prefetch_origins'] = [] # hosts followed besides the origin of the page
+	config['prefetch_max_per_page'] = 16
+	config['prefetch_concurrency'] = 8 # prefetches in flight per worker
 
-	return config
\ No newline at end of file
+	return config
+
+
+def get_cpus():
+	# the cpus this process may run on
+	if hasattr(os, 'sched_getaffinity'):
+		return sorted(os.sched_getaffinity(0))
+	try:
+		import multiprocessing
+		return list(range(multiprocessing.cpu_count()))
+	except NotImplementedError:
+		return [0]
+
+def get_rss():
+	# resident set size in bytes, None where /proc is not available
+	try:
+		with open('/proc/self/statm', 'rb') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError, IndexError):
+		return None
+
+def set_cpu_affinity(cpu):
+	if hasattr(os, 'sched_setaffinity'):
+		os.sched_setaffinity(0, [cpu])
+		return True
+	if sys.platform.startswith('linux'):
+		import ctypes
+		import ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		bits = ctypes.sizeof(ctypes.c_ulong) * 8
+		mask = (ctypes.c_ulong * (1024 // bits))()
+		mask[cpu // bits] = 1 << (cpu % bits)
+		if libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) == 0:
+			return True
+	logging.warn('can not pin to cpu %d', cpu)
+	return False
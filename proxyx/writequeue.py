@@ -0,0 +1,200 @@
+from __future__ import absolute_import, division, print_function, with_statement
+
+import socket
+import collections
+
+# buffers handed to one sendmsg, linux takes up to 1024
+IOV_MAX = 64
+
+_sendmsg = hasattr(socket.socket, 'sendmsg') # python 3.3+
+
+_BYTES = (bytes, memoryview)
+
+
+class WriteQueue(object):
+	"""data waiting to go out on a socket, oldest first. items are bytes,
+	memoryviews, or objects with send(sock) and slicing like
+	cache.FileRegion. nothing is copied or joined: a partial send moves an
+	offset into the first item, runs of bytes go out with one sendmsg where
+	there is one. an empty queue is one small object, every connection has
+	one. This class is not thread safe"""
+
+	__slots__ = ('_items', '_offset', '_size')
+
+	def __init__(self):
+		self._items = None # a deque while not empty
+		self._offset = 0 # sent of the first item
+		self._size = 0
+
+	def __len__(self):
+		# bytes pending
+		return self._size
+
+	def append(self, data):
+		if len(data):
+			if self._items is None:
+				self._items = collections.deque()
+			self._items.append(data)
+			self._size += len(data)
+
+	def extend(self, items):
+		for data in items:
+			self.append(data)
+
+	def own(self):
+		"""copies the memoryviews at the end of the queue, what is left of
+		a read buffer about to be reused. called after every append of one,
+		they are never further back"""
+		items = self._items
+		if items is None:
+			return
+		i = len(items) - 1
+		while i >= 0 and isinstance(items[i], memoryview):
+			items[i] = items[i].tobytes()
+			i -= 1
+
+	def peek(self, size):
+		"""up to size bytes from the front as bytes, left in the queue"""
+		chunks = []
+		n = 0
+		offset = self._offset
+		for item in self._items or ():
+			if n >= size or not isinstance(item, _BYTES):
+				break
+			chunk = item[offset:offset + size - n]
+			offset = 0
+			if isinstance(chunk, memoryview):
+				chunk = chunk.tobytes()
+			chunks.append(chunk)
+			n += len(chunk)
+		return b''.join(chunks)
+
+	def consume(self, n):
+		"""drops n bytes from the front, they went out some other way"""
+		items = self._items
+		self._size -= n
+		n += self._offset
+		while items and n >= len(items[0]):
+			n -= len(items.popleft())
+		self._offset = n
+		if not items:
+			self._items = None
+
+	def clear(self):
+		self._items = None
+		self._offset = 0
+		self._size = 0
+
+	def send(self, sock):
+		"""sends until the socket takes no more or nothing is left, returns
+		how many bytes went out. errors are raised, EAGAIN included, what was
+		sent before stays sent"""
+		items = self._items
+		total = 0
+		while items:
+			first = items[0]
+			if not isinstance(first, _BYTES):
+				if self._offset:
+					first = first[self._offset:]
+				want = len(first)
+				n = first.send(sock)
+			else:
+				if self._offset:
+					first = memoryview(first)[self._offset:]
+				buffers = [first]
+				want = len(first)
+				if _sendmsg:
+					for i in range(1, min(len(items), IOV_MAX)):
+						item = items[i]
+						if not isinstance(item, _BYTES):
+							break
+						buffers.append(item)
+						want += len(item)
+				if len(buffers) > 1:
+					n = sock.sendmsg(buffers)
+				else:
+					n = sock.send(first)
+			self.consume(n)
+			total += n
+			if n < want:
+				break
+		return total
+
+
+def test():
+	a, b = socket.socketpair()
+	a.setblocking(False)
+	q = WriteQueue()
+	assert not q
+	q.append(b'')
+	assert not q and q._items is None
+	data = [b'x' * 1000, b'y' * 10, b'z' * 100000]
+	q.extend(data)
+	assert len(q) == 101010
+
+	# fill the socket, then drain it: every byte once and in order
+	received = []
+	while q:
+		try:
+			q.send(a)
+		except (OSError, IOError):
+			pass
+		b.setblocking(False)
+		while True:
+			try:
+				chunk = b.recv(65536)
+			except (OSError, IOError):
+				break
+			received.append(chunk)
+	assert b''.join(received) == b''.join(data)
+	assert q._offset == 0 and q._items is None
+
+	# views are sent from as they are, until own() copies them
+	buf = bytearray(b'abcdef')
+	q.append(memoryview(buf)[:4])
+	q.append(b'gh')
+	q.append(memoryview(buf)[4:])
+	assert q.send(a) == 8 and not q
+	q.append(memoryview(buf))
+	q.append(memoryview(buf)[1:2])
+	q.own()
+	buf[:] = b'xxxxxx'
+	assert all(isinstance(item, bytes) for item in q._items)
+	assert q.send(a) == 7
+	b.setblocking(True)
+	assert b.recv(100) == b'abcdghefabcdefb'
+
+	# peeked at across items, then consumed as if sent
+	q.extend([b'abc', memoryview(b'defg'), b'hi'])
+	q.consume(1)
+	assert q.peek(5) == b'bcdef' and q.peek(100) == b'bcdefghi' and len(q) == 8
+	q.consume(5)
+	assert q.peek(100) == b'ghi' and len(q) == 3
+	q.consume(3)
+	assert not q and q._items is None and q._offset == 0
+
+	# an object that sends itself is sent alone, from the offset too
+	class Region(object):
+		def __init__(self, data):
+			self.data = data
+
+		def __len__(self):
+			return len(self.data)
+
+		def __getitem__(self, s):
+			return Region(self.data[s])
+
+		def send(self, sock):
+			return sock.send(self.data[:3])
+
+	q.extend([b'ab', Region(b'cdefgh'), b'ij'])
+	# a short send of the region stops there
+	assert q.send(a) == 5 and len(q) == 5
+	assert q.send(a) == 5 and not q
+	assert b.recv(100) == b'abcdefghij'
+	a.close()
+	b.close()
+
+
+if __name__ == '__main__':
+	test()